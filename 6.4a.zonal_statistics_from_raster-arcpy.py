@@ -34,7 +34,11 @@ def worker_process_year(args):
         args: Tuple containing (year, sts_ids, wb_var, tc_vars, processing_dir, out_geotiff, raster_dir, serial_id)
     """
     import gc  # Import garbage collector
+    import time
+    import traceback
+    from telemetryfunctions import log_event, peak_memory_mb
     year, sts_ids, wb_var, tc_vars, processing_dir, out_geotiff, raster_dir, serial_id = args
+    start = time.time()
     
     # Import arcpy within the worker process
     arcpy = setup_arcpy_environment()
@@ -144,10 +148,14 @@ def worker_process_year(args):
         gc.collect()
         
         print(f"\tYear {year} - Processing completed successfully!")
+        log_event("task", stage="zonal", task=year, seconds=time.time() - start, items=12 * len(sts_ids),
+                  unit="station-months", peak_memory_mb=peak_memory_mb())
         return f"Year {year} completed successfully"
         
     except Exception as e:
         print(f"Error processing year {year}: {str(e)}")
+        log_event("error", stage="zonal", task=year, seconds=time.time() - start, error=repr(e),
+                  traceback=traceback.format_exc())
         # Try to free up memory even on error
         try:
             arcpy.Delete_management("in_memory")
@@ -247,6 +255,10 @@ if __name__ == "__main__":
     print(f"\nUsing {max_processes} parallel processes")
     print(f"Processing {len(years)} years in batches of {batch_size}")
     
+    # Structured log of the workers (per-year time, peak memory and failures with their traceback)
+    from telemetryfunctions import start_telemetry, write_summary
+    log_path = start_telemetry(processing_dir + '\\zonal_statistics_telemetry.jsonl')
+
     # Execute parallel processing in batches
     print("\nStarting parallel processing...")
     
@@ -273,5 +285,7 @@ if __name__ == "__main__":
     print("="*60)
     for result in results:
         print(result)
+
+    write_summary(log_path)
     
     print("\nALL PROCESSING COMPLETED!!")
\ No newline at end of file
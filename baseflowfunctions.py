@@ -0,0 +1,598 @@
+# Batched baseflow analyses of the GRDC stations (4.3a/4.3b recession constants)
+# Streamflow is handled as a (dates x stations) matrix, e.g., the joined DataFrames of 0.2.CSS_flow_station_data
+# Recession segments follow hydrosignatures.baseflow_recession (ported from the TOSSH toolbox, Gnann et al., 2021)
+
+import numpy as np
+import pandas as pd
+
+
+# Function to apply one forward pass of the Lyne and Hollick filter to all the columns at once
+def lyne_hollick_forward(q, alpha=0.925):
+    """
+    Forward pass of the Lyne and Hollick filter along axis 0 (time) of a (dates x stations) array without NaN:
+        qf[0] = q[0] - min(q); qf[i] = alpha * qf[i-1] + 0.5 * (1 + alpha) * (q[i] - q[i-1])
+    Returns the filtered baseflow q - qf where qf > 0, else q (as hydrosignatures).
+    """
+    from scipy.signal import lfilter
+
+    q = np.asarray(q, dtype=np.float64)
+    qf = np.empty_like(q)
+    qf[0] = q[0] - q.min(axis=0)
+    if q.shape[0] > 1:
+        qf[1:] = lfilter([0.5 * (1 + alpha)], [1, -alpha], np.diff(q, axis=0), axis=0, zi=(alpha * qf[0])[np.newaxis])[0]
+
+    return np.where(qf > 0, q - qf, q)
+
+
+# Function to arrange the series of each station left-aligned, optionally restricted to a period per station
+def align_series(flows, periods=None):
+    """
+    Returns (q, lengths): q is a (max length x stations) array with the period of each station starting at row 0
+    (NaN after its length), and lengths is the number of rows of each station.
+
+    Args:
+        flows: DataFrame (dates x stations)
+        periods: Optional DataFrame indexed by station with "start_date" and "end_date" (e.g., the longest continuous
+                 periods of 4.3a). Without it, the whole series is used
+    """
+    values = flows.to_numpy(dtype=np.float64)
+    if periods is None:
+        return values.copy(), np.full(values.shape[1], values.shape[0])
+
+    starts = flows.index.get_indexer(pd.Index(periods.loc[flows.columns, "start_date"].astype(str)))
+    ends = flows.index.get_indexer(pd.Index(periods.loc[flows.columns, "end_date"].astype(str)))
+    lengths = np.where((starts >= 0) & (ends >= starts), ends - starts + 1, 0)
+
+    q = np.full((max(1, lengths.max()), values.shape[1]), np.nan)
+    rows = np.arange(q.shape[0])[:, np.newaxis]
+    src = starts[np.newaxis, :] + rows
+    inside = rows < lengths[np.newaxis, :]
+    q[inside] = values[src[inside], np.nonzero(inside)[1]]
+
+    return q, lengths
+
+
+# Function to detect the recession segments of all the stations at once
+def recession_segments(q, lengths=None, freq=1.0, recession_length=15, eps=0.0, lyne_hollick_smoothing=0.925, n_start=0):
+    """
+    Same rule as hydrosignatures (start_of_recession="baseflow"), vectorized over the stations.
+
+    Args:
+        q: (dates x stations) array, left-aligned (see align_series)
+        lengths: Number of valid rows of each station (default: all the rows)
+
+    Returns a DataFrame with one row per segment: column (station position), start and end (rows, inclusive)
+    """
+    q = np.asarray(q, dtype=np.float64)
+    n_rows, n_sts = q.shape
+    if lengths is None:
+        lengths = np.full(n_sts, n_rows)
+    rows = np.arange(n_rows)[:, np.newaxis]
+
+    # Decreasing flow and start point (first non-decreasing step) of each station
+    with np.errstate(invalid="ignore"):
+        decreasing = q[1:] < (q[:-1] + eps)
+    decreasing &= rows[:-1] < (lengths - 1)
+    start_point = np.argmax(~decreasing, axis=0)
+
+    # Changes of the decreasing flag after the start point, paired as (start, end) of every decreasing run
+    change = decreasing[:-1] != decreasing[1:]
+    change &= (rows[:-2] >= start_point) & (rows[:-2] < (lengths - 2))
+    sts, idx = np.nonzero(change.T)
+    rank = np.arange(sts.size) - np.searchsorted(sts, sts)
+    n_changes = np.bincount(sts, minlength=n_sts)
+    complete = rank < (n_changes[sts] // 2) * 2
+    sts, idx, rank = sts[complete], idx[complete], rank[complete]
+    col, start, end = sts[rank % 2 == 0], idx[rank % 2 == 0], idx[rank % 2 == 1]
+
+    keep = (end - start) >= recession_length / freq + n_start
+    col, start, end = col[keep], start[keep] + n_start, end[keep]
+
+    # Baseflow start of recession: the segment starts at its first day classified as baseflow (Lyne and Hollick)
+    pad_width = 10
+    last = q[np.maximum(lengths - 1, 0), np.arange(n_sts)]
+    filled = np.where(rows < lengths, q, last)
+    padded = np.concatenate([np.repeat(filled[:1], pad_width, axis=0), filled, np.repeat(last[np.newaxis], pad_width, axis=0)])
+    has_nan = np.isnan(np.where(rows < lengths, q, 0)).any(axis=0)
+    q_bf = lyne_hollick_forward(np.nan_to_num(padded), lyne_hollick_smoothing)[pad_width:-pad_width]
+    # As in hydrosignatures, series with NaN are not filtered (the filter returns the streamflow itself)
+    q_bf = np.where(has_nan, q, q_bf)
+    is_baseflow = np.isclose(q_bf, q)
+
+    # First baseflow row at or after each row (n_rows if none)
+    next_bf = np.where(is_baseflow, rows, n_rows)
+    next_bf = np.minimum.accumulate(next_bf[::-1], axis=0)[::-1]
+    first_bf = next_bf[start, col]
+
+    keep = first_bf <= end
+    col, start, end = col[keep], first_bf[keep], end[keep]
+    keep = (end - start) >= 3
+
+    return pd.DataFrame({"column": col[keep], "start": start[keep], "end": end[keep]})
+
+
+# Function to build the master recession curve with the non-parametric analytic method of hydrosignatures
+def nonparametric_mrc(series, sections):
+    """
+    Master recession curve (MRC) as a (points x 2) array of [time, flow], from one station series and its
+    recession sections (start, end). Port of hydrosignatures._nonparametric_analytic_mrc ("log" matching).
+    """
+    from scipy import interpolate, optimize, sparse
+
+    jitter_size, numflows = 1e-8, 500
+    rng = np.random.default_rng(42)
+
+    streamflow = np.array(series, dtype=np.float64)
+    segments = [streamflow[start:end + 1] for start, end in sections]
+    all_jitter = rng.normal(0, jitter_size, sum(len(segment) - 1 for segment in segments))
+
+    jitter_index = 0
+    for i, segment in enumerate(segments):
+        segment[1:] += all_jitter[jitter_index:jitter_index + len(segment) - 1]
+        jitter_index += len(segment) - 1
+        segments[i] = np.sort(np.abs(segment) + 1e-20)[::-1]
+
+    max_flow = max(seg[0] for seg in segments)
+    min_flow = max(min(seg[-1] for seg in segments), jitter_size)
+
+    frac_log = 0.2
+    gridspace = (max_flow - min_flow) / numflows
+    flow_vals = np.sort(np.concatenate([
+        np.linspace(max_flow - gridspace / 2, min_flow + gridspace / 2, numflows - int(frac_log * numflows)),
+        np.logspace(np.log10(max_flow), np.log10(min_flow), int(frac_log * numflows)),
+    ]))[::-1]
+    flow_vals[-1] = min_flow
+    flow_vals[0] = max_flow
+    flow_vals = np.sort(np.unique(flow_vals))[::-1]
+    numflows = len(flow_vals)
+
+    # Matching strip: lags of the segments and times of the flow values as a sparse least-squares problem
+    entries, b_matrix, mcount, bad_segs = [], [], 0, []
+    for i, segment in enumerate(segments):
+        fmax_index = np.argmax(segment[0] >= flow_vals)
+        fmin_index = numflows if segment[-1] <= flow_vals[-1] else np.argmax(segment[-1] > flow_vals) - 1
+        nf = fmin_index - fmax_index
+        if nf == 0:
+            bad_segs.append(i)
+            continue
+
+        interp_func = interpolate.interp1d(segment, np.arange(len(segment)), bounds_error=False, fill_value="extrapolate")
+        b_matrix.extend(interp_func(flow_vals[fmax_index:fmin_index]))
+        if i > 0:
+            entries.extend((j, i - 1, 1) for j in range(mcount, mcount + nf))
+        entries.extend((j, len(segments) + fmax_index + k - 1, -1) for j, k in enumerate(range(nf), start=mcount))
+        mcount += nf
+
+    rows, cols, data = zip(*entries)
+    m_sparse = sparse.coo_array((data, (rows, cols)), shape=(mcount, len(segments) - 1 + numflows))
+    for i in sorted(bad_segs, reverse=True):
+        m_sparse = m_sparse.tocsc()
+        m_sparse = m_sparse[:, list(range(i - 1)) + list(range(i, m_sparse.shape[1]))]
+
+    mrc_solve = optimize.lsq_linear(m_sparse, -np.array(b_matrix)).x
+    mrc_time = np.sort(mrc_solve[len(segments) - 1 - len(bad_segs):])
+    mrc_time -= np.min(mrc_time)
+
+    return np.column_stack((mrc_time, flow_vals))
+
+
+def worker_station_mrc(args):
+    """
+    Worker function to build the MRC of a single station (NaN-filled (1, 2) array if it fails).
+
+    Args:
+        args: Tuple containing (series, sections)
+    """
+    series, sections = args
+    try:
+        if len(sections) == 0:
+            raise ValueError("No recession segments found.")
+        return nonparametric_mrc(series, sections)
+    except Exception:
+        return np.full((1, 2), np.nan)
+
+
+# Function to fit y = a + b * x by (weighted) least squares for many stations at once
+def batched_linear_fit(x, y, w):
+    """
+    Args:
+        x, y, w: (stations x points) arrays; w are the weights of the squared residuals (0 for padding)
+    Returns (slope, intercept) per station
+    """
+    sw = w.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xm = (w * x).sum(axis=1) / sw
+        ym = (w * y).sum(axis=1) / sw
+        dx = np.where(w > 0, x - xm[:, np.newaxis], 0)
+        dy = np.where(w > 0, y - ym[:, np.newaxis], 0)
+        slope = (w * dx * dy).sum(axis=1) / (w * dx * dx).sum(axis=1)
+    return slope, ym - slope * xm
+
+
+# Function to calculate the Pearson correlation of many stations at once (masked points ignored)
+def batched_corr(a, b, mask):
+
+    n = mask.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        am = np.where(mask, a, 0).sum(axis=1) / n
+        bm = np.where(mask, b, 0).sum(axis=1) / n
+        da = np.where(mask, a - am[:, np.newaxis], 0)
+        db = np.where(mask, b - bm[:, np.newaxis], 0)
+        return (da * db).sum(axis=1) / np.sqrt((da * da).sum(axis=1) * (db * db).sum(axis=1))
+
+
+# Function to estimate the recession constants of all the stations (4.3a/4.3b)
+def recession_constants(flows, periods=None, freq=1.0, recession_length=15, processes=None):
+    """
+    Batched version of the station loops of 4.3a.daily_recession_constant_CSS and 4.3b.monthly_recession_constant_CSS.
+
+    Args:
+        flows: DataFrame (dates x stations), e.g., Joined_Daily_Sts_DFs.csv or Joined_Monthly_Sts_DFs.csv
+        periods: Optional DataFrame indexed by station with "start_date" and "end_date" (longest continuous periods)
+        freq: Frequency passed to hydrosignatures in the notebooks (1 daily, 30.4375 monthly)
+        recession_length: Minimum length of recessions [days]
+        processes: Number of processes for the master recession curves (default: number of CPUs - 1)
+
+    Returns a DataFrame with station, alpha_without_weights, R_sq_without_weights, alpha_with_weights, R_sq_with_weights
+    """
+    import os
+    from multiprocessing import Pool
+
+    q, lengths = align_series(flows, periods)
+    segments = recession_segments(q, lengths, freq, recession_length)
+
+    # Master recession curves (one least-squares problem per station) in parallel
+    grouped = {col: seg[["start", "end"]].to_numpy() for col, seg in segments.groupby("column")}
+    worker_args = [(q[:lengths[j], j], grouped.get(j, np.empty((0, 2), dtype=np.int64))) for j in range(q.shape[1])]
+
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+    if processes == 1:
+        mrcs = [worker_station_mrc(args) for args in worker_args]
+    else:
+        with Pool(processes=processes) as pool:
+            mrcs = pool.map(worker_station_mrc, worker_args, chunksize=max(1, len(worker_args) // (4 * processes)))
+
+    # Padded (stations x points) arrays of the MRCs
+    n_points = max(len(mrc) for mrc in mrcs)
+    x = np.zeros((len(mrcs), n_points))
+    y = np.ones((len(mrcs), n_points))
+    mask = np.zeros((len(mrcs), n_points), dtype=bool)
+    for j, mrc in enumerate(mrcs):
+        x[j, :len(mrc)], y[j, :len(mrc)] = mrc[:, 0], mrc[:, 1]
+        mask[j, :len(mrc)] = ~np.isnan(mrc[:, 0])
+    x, y = np.where(mask, x, 0), np.where(mask, y, 1)
+    log_y = np.log(y)
+
+    # Fits without weights (hydrosignatures' slope / freq) and with weights (np.polyfit with w = sqrt(y))
+    slope_without, _ = batched_linear_fit(x, log_y, mask.astype(np.float64))
+    slope_with, _ = batched_linear_fit(x, log_y, np.where(mask, y, 0))
+    alpha_without = -slope_without / freq
+    alpha_with = np.abs(slope_with)
+
+    # R^2 of the fitted exponential recessions starting at the intercept (first flow of the MRC)
+    intercept = y[:, :1]
+    r_without = batched_corr(y, np.exp(np.log(intercept) - alpha_without[:, np.newaxis] * x), mask)
+    r_with = batched_corr(y, np.exp(np.log(intercept) - alpha_with[:, np.newaxis] * x), mask)
+
+    failed = mask.sum(axis=1) < 2
+    results = pd.DataFrame({
+        "station": flows.columns,
+        "alpha_without_weights": np.where(failed, np.nan, alpha_without),
+        "R_sq_without_weights": np.where(failed, np.nan, r_without ** 2),
+        "alpha_with_weights": np.where(failed, np.nan, alpha_with),
+        "R_sq_with_weights": np.where(failed, np.nan, r_with ** 2),
+    })
+    return results
+
+
+# Function to build the k recessions table (e.g., monthly_k_recessions_df.csv) from the alpha values
+def k_recessions_table(results):
+
+    k_recessions = results[["station", "alpha_with_weights"]].copy()
+    k_recessions["k_recession"] = np.exp(-k_recessions["alpha_with_weights"])
+    return k_recessions.dropna().reset_index(drop=True)
+
+
+# Function to find the runs of consecutive valid rows of all the columns at once (run-length encoding)
+def valid_runs(valid):
+    """
+    Args:
+        valid: (rows x columns) boolean array (e.g., ~np.isnan(flows))
+
+    Returns a DataFrame with one row per run, ordered by column and start: column (position), start (row) and length
+    """
+    valid = np.asarray(valid, dtype=bool)
+    edges = np.diff(np.pad(valid, ((1, 1), (0, 0))).astype(np.int8), axis=0)
+    cols, starts = np.nonzero(edges.T == 1)
+    ends = np.nonzero(edges.T == -1)[1] # Same order: each run starts and ends once in its column
+    return pd.DataFrame({"column": cols, "start": starts, "length": ends - starts})
+
+
+# Function to get the longest run of consecutive valid rows of each column (the first one if there is a tie)
+def longest_runs(valid):
+    """
+    Returns (start, length) per column (start -1 and length 0 for columns without valid rows)
+    """
+    valid = np.asarray(valid, dtype=bool)
+    runs = valid_runs(valid)
+    order = np.lexsort((runs["start"].to_numpy(), -runs["length"].to_numpy(), runs["column"].to_numpy()))
+    cols = runs["column"].to_numpy()[order]
+    first = order[np.r_[True, cols[1:] != cols[:-1]]] if cols.size else order
+
+    start = np.full(valid.shape[1], -1)
+    length = np.zeros(valid.shape[1], dtype=np.int64)
+    start[runs["column"].to_numpy()[first]] = runs["start"].to_numpy()[first]
+    length[runs["column"].to_numpy()[first]] = runs["length"].to_numpy()[first]
+    return start, length
+
+
+# Function to arrange a DataFrame (dates x stations) on every month between its first and last dates
+def monthly_matrix(flows, columns=None):
+    """
+    Args:
+        flows: DataFrame with "YYYY-MM" labels or datetimes as index (e.g., Joined_Monthly_Sts_DFs.csv or the pivoted
+               zonal statistics of 10.baseflow_index)
+        columns: Stations to keep, in this order (missing ones are NaN). Default: all the columns
+
+    Returns (values, periods): (months x stations) float array and the periods of its rows (see storefunctions)
+    """
+    from storefunctions import periods_from_index
+
+    columns = flows.columns if columns is None else pd.Index(columns)
+    source = periods_from_index(flows.index)
+    periods = np.arange(source.min(), source.max() + 1, dtype=np.int32)
+    values = np.full((periods.size, len(columns)), np.nan)
+    values[source - periods[0]] = flows.reindex(columns=columns).to_numpy(dtype=np.float64)
+    return values, periods
+
+
+# Function to add the month and year columns of 10.baseflow_index (mth_int, Month and year) without row-wise apply
+def add_calendar_columns(flows):
+
+    import calendar
+    from storefunctions import periods_from_index
+
+    periods = periods_from_index(flows.index)
+    flows = flows.copy()
+    flows["mth_int"] = periods % 12 + 1
+    flows["Month"] = np.array(calendar.month_abbr)[periods % 12 + 1]
+    flows["year"] = periods // 12
+    return flows
+
+
+# Function to find the longest continuous period with data of each station (10.baseflow_index)
+def longest_periods(flows, start_date="1958-01", end_date="2023-12"):
+    """
+    Args:
+        flows: DataFrame (dates x stations) with monthly data (see monthly_matrix)
+        start_date, end_date: Analysis period ("YYYY-MM", None for no limit)
+
+    Returns a DataFrame [Station, StartDate, EndDate, NumMonths] of the stations with data, as
+    monthly_longest_continuos_df.csv
+    """
+    from storefunctions import period_codes, period_labels
+
+    stations = flows.columns.drop(["mth_int", "Month", "year"], errors="ignore")
+    values, periods = monthly_matrix(flows, stations)
+    keep = np.ones(periods.size, dtype=bool)
+    if start_date is not None:
+        keep &= periods >= period_codes(*map(int, start_date.split("-")))
+    if end_date is not None:
+        keep &= periods <= period_codes(*map(int, end_date.split("-")))
+    values, periods = values[keep], periods[keep]
+
+    start, length = longest_runs(~np.isnan(values))
+    has_data = length > 0
+    labels = period_labels(periods).to_numpy()
+    return pd.DataFrame({"Station": np.asarray(stations)[has_data], "StartDate": labels[start[has_data]],
+                         "EndDate": labels[start[has_data] + length[has_data] - 1],
+                         "NumMonths": length[has_data]})
+
+
+# Function to move the valid values of each column to its first rows (NaN after them)
+def compact_series(q, valid):
+    """
+    Returns (q, lengths) in the layout of align_series, keeping only the rows where "valid" is True (as dropna)
+    """
+    q = np.asarray(q, dtype=np.float64)
+    valid = np.asarray(valid, dtype=bool)
+    lengths = valid.sum(axis=0)
+    rows = np.cumsum(valid, axis=0) - 1
+    out = np.full((max(1, lengths.max(initial=0)), q.shape[1]), np.nan)
+    r, c = np.nonzero(valid)
+    out[rows[r, c], c] = q[r, c]
+    return out, lengths
+
+
+# Function to reverse the first "lengths" rows of each column (the rows after them repeat the new last value)
+def reverse_series(q, lengths):
+
+    rows = np.arange(q.shape[0])[:, np.newaxis]
+    src = np.clip(np.asarray(lengths) - 1 - rows, 0, None)
+    return np.take_along_axis(q, src, axis=0)
+
+
+# Function to apply one forward pass of the Eckhardt filter to all the columns at once
+def eckhardt_forward(q, alpha=0.925, bfi_max=0.8):
+    """
+    Forward pass of the Eckhardt (2005) filter along axis 0 (time) of a (dates x stations) array without NaN:
+        b[0] = min(q); b[i] = min(((1 - bfi_max) * alpha * b[i-1] + (1 - alpha) * bfi_max * q[i]) / (1 - alpha * bfi_max), q[i])
+    The constraint b <= q makes the filter non-linear, so the loop runs over time with all the stations at once.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    b = np.empty_like(q)
+    b[0] = q.min(axis=0)
+    a, c = (1 - bfi_max) * alpha / (1 - alpha * bfi_max), (1 - alpha) * bfi_max / (1 - alpha * bfi_max)
+    for i in range(1, q.shape[0]):
+        np.minimum(a * b[i - 1] + c * q[i], q[i], out=b[i])
+    return b
+
+
+# Function to separate the baseflow of all the stations at once with a recursive digital filter
+def baseflow_filter(q, lengths=None, alpha=0.925, n_passes=3, pad_width=10, method="lyne_hollick", bfi_max=0.8):
+    """
+    Batched version of hydrosignatures.baseflow: each series is padded with its edge values, filtered forward, then
+    (n_passes - 1) / 2 times backward and forward, and the baseflow below 0 is set to 0.
+
+    Args:
+        q: (dates x stations) array, left-aligned and without NaN in the first "lengths" rows of each station
+           (see align_series and compact_series)
+        lengths: Number of valid rows of each station (default: all the rows)
+        alpha: Filter parameter (0-1)
+        n_passes: Odd number of passes
+        pad_width: Number of edge values added at both ends of each series (warm up)
+        method: "lyne_hollick" (Lyne and Hollick, as hydrosignatures) or "eckhardt"
+        bfi_max: Maximum BFI of the Eckhardt filter
+
+    Returns the (dates x stations) baseflow (NaN after the length of each station)
+    """
+    if n_passes < 1 or n_passes % 2 == 0:
+        raise ValueError("n_passes must be an odd number")
+    if not 0 < alpha < 1:
+        raise ValueError("alpha must be between 0 and 1")
+    if method == "lyne_hollick":
+        forward = lambda x: lyne_hollick_forward(x, alpha)
+    elif method == "eckhardt":
+        forward = lambda x: eckhardt_forward(x, alpha, bfi_max)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    q = np.asarray(q, dtype=np.float64)
+    n_rows, n_sts = q.shape
+    lengths = np.full(n_sts, n_rows) if lengths is None else np.asarray(lengths)
+    rows = np.arange(n_rows + 2 * pad_width)[:, np.newaxis]
+
+    # Edge padding of each series; the rows after it repeat its last value, so they never change the minimum
+    src = np.clip(rows - pad_width, 0, np.maximum(lengths - 1, 0))
+    padded = np.take_along_axis(q, src, axis=0)
+    padded_lengths = lengths + 2 * pad_width
+
+    qb = forward(padded)
+    for _ in range(int(round(0.5 * (n_passes - 1)))):
+        # Backward pass (forward pass of the reversed series), then forward pass
+        qb = forward(reverse_series(forward(reverse_series(qb, padded_lengths)), padded_lengths))
+
+    qb = qb[pad_width:pad_width + n_rows]
+    qb[qb < 0] = 0.0
+    return np.where(rows[:n_rows] < lengths, qb, np.nan)
+
+
+# Function to calculate the baseflow index of each station and of each month of the year
+def series_bfi(q, qb, lengths, months=None, eps=1e-6):
+    """
+    Args:
+        q, qb: (dates x stations) streamflow and baseflow (see baseflow_filter)
+        lengths: Number of valid rows of each station
+        months: Optional (dates x stations) month (1-12) of each value
+
+    Returns the BFI per station (0 if the streamflow sums less than eps, as hydrosignatures; NaN without data) and,
+    with "months", the (12 x stations) BFI per month of the year (NaN for months without data)
+    """
+    inside = np.arange(q.shape[0])[:, np.newaxis] < lengths
+    q_sum = np.where(inside, q, 0).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bfi = np.where(q_sum < eps, 0.0, np.where(inside, qb, 0).sum(axis=0) / q_sum)
+    bfi[lengths == 0] = np.nan
+    if months is None:
+        return bfi
+
+    # Sums per (month, station) with one bincount over the flat indices
+    n_sts = q.shape[1]
+    idx = (np.where(inside, months, 1).astype(np.int64) - 1) * n_sts + np.arange(n_sts)
+    q_month = np.bincount(idx[inside], np.where(inside, q, 0)[inside], minlength=12 * n_sts).reshape(12, n_sts)
+    qb_month = np.bincount(idx[inside], np.where(inside, qb, 0)[inside], minlength=12 * n_sts).reshape(12, n_sts)
+    counts = np.bincount(idx[inside], minlength=12 * n_sts).reshape(12, n_sts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        monthly = np.where(counts == 0, np.nan, np.where(q_month < eps, 0.0, qb_month / q_month))
+    return bfi, monthly
+
+
+# Function to get the (months x stations) mask of the period of each station (all True without periods)
+def period_mask(month_periods, stations, periods=None):
+
+    from storefunctions import periods_from_index
+
+    if periods is None:
+        return np.ones((month_periods.size, len(stations)), dtype=bool)
+    by_station = periods.assign(Station=periods["Station"].astype(str)).set_index("Station")
+    start = periods_from_index(by_station.loc[stations, "StartDate"])
+    end = periods_from_index(by_station.loc[stations, "EndDate"])
+    return (month_periods[:, np.newaxis] >= start) & (month_periods[:, np.newaxis] <= end)
+
+
+# Function to calculate the baseflow index of all the stations, optionally over their longest continuous periods
+def baseflow_index(flows, periods=None, alpha=0.925, n_passes=3, pad_width=10, method="lyne_hollick", bfi_max=0.8):
+    """
+    Args:
+        flows: DataFrame (dates x stations) with monthly data (see monthly_matrix)
+        periods: Optional output of longest_periods. Without it, all the valid months of each station are used
+        alpha, n_passes, pad_width, method, bfi_max: See baseflow_filter
+
+    Returns a DataFrame indexed by station with the BFI, the number of months used and the BFI per month of the year
+    (Jan to Dec)
+    """
+    import calendar
+
+    stations = flows.columns.drop(["mth_int", "Month", "year"], errors="ignore")
+    if periods is not None:
+        stations = pd.Index(periods["Station"].astype(str)).intersection(stations.astype(str), sort=False)
+        flows = flows.rename(columns=str)
+    values, month_periods = monthly_matrix(flows, stations)
+    valid = ~np.isnan(values) & period_mask(month_periods, stations, periods)
+
+    q, lengths = compact_series(values, valid)
+    months, _ = compact_series(np.broadcast_to(month_periods[:, np.newaxis] % 12 + 1, valid.shape), valid)
+    qb = baseflow_filter(q, lengths, alpha, n_passes, pad_width, method, bfi_max)
+    bfi, monthly = series_bfi(q, qb, lengths, months)
+
+    df = pd.DataFrame({"bfi": bfi, "num_months": lengths}, index=pd.Index(stations, name="station_no"))
+    df[list(calendar.month_abbr[1:])] = monthly.T
+    return df
+
+
+# Function to build the BFI table of 10.baseflow_index (observed, simulated and runoff BFI of each station)
+def bfi_table(sf, sim, ro, periods, stations=None, alpha=0.925, n_passes=3, pad_width=10, method="lyne_hollick",
+              bfi_max=0.8):
+    """
+    For each station, the months of its longest continuous period where the three series have data (as dropna) are
+    filtered together.
+
+    Args:
+        sf, sim, ro: DataFrames (dates x stations) of observed streamflow, simulated streamflow and runoff (m³/s)
+        periods: Output of longest_periods (of the observed streamflow)
+        stations: Stations to include (e.g., final_sts). Default: the stations of "periods"
+        alpha, n_passes, pad_width, method, bfi_max: See baseflow_filter
+
+    Returns a DataFrame [station_no, bfi_sf, bfi_sim, bfi_ro, bfi_sim-ro, bfi_abs_sim-ro] of the stations with data
+    """
+    stations = pd.Index(periods["Station"].astype(str) if stations is None else [str(st) for st in stations])
+    stations = stations[stations.isin(periods["Station"].astype(str))]
+    sf, sim, ro = (df.rename(columns=str) for df in (sf, sim, ro))
+
+    # The three series on the same months
+    arrays = [monthly_matrix(df, stations) for df in (sf, sim, ro)]
+    first = min(p[0] for _, p in arrays)
+    last = max(p[-1] for _, p in arrays)
+    month_periods = np.arange(first, last + 1, dtype=np.int32)
+    values = []
+    for v, p in arrays:
+        full = np.full((month_periods.size, len(stations)), np.nan)
+        full[p[0] - first:p[-1] - first + 1] = v
+        values.append(full)
+
+    valid = period_mask(month_periods, stations, periods)
+    for v in values:
+        valid &= ~np.isnan(v)
+
+    bfis = []
+    for v in values:
+        q, lengths = compact_series(v, valid)
+        bfis.append(series_bfi(q, baseflow_filter(q, lengths, alpha, n_passes, pad_width, method, bfi_max), lengths))
+
+    has_data = lengths > 0
+    bfi_df = pd.DataFrame({"station_no": np.asarray(stations)[has_data], "bfi_sf": bfis[0][has_data],
+                           "bfi_sim": bfis[1][has_data], "bfi_ro": bfis[2][has_data]})
+    bfi_df["bfi_sim-ro"] = bfi_df["bfi_sim"] - bfi_df["bfi_ro"]
+    bfi_df["bfi_abs_sim-ro"] = abs(bfi_df["bfi_sim-ro"])
+    return bfi_df
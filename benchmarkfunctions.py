@@ -0,0 +1,414 @@
+# Benchmarks of the local workflow on synthetic data
+# A folder of synthetic inputs is generated once (TerraClimate-like ppt/pet/q GeoTIFFs, WHC and k rasters, nested
+# drainage areas {st}_DA.tif and GRDC daily text files), then every stage runs in its own process so that its wall
+# time and peak memory are measured separately. Results are saved as JSON and compared against a stored baseline
+
+import os
+import json
+import time
+import platform
+import numpy as np
+from multiprocessing import Pool
+
+from rasterfunctions import write_raster, monthly_path
+from wbfunctions import tc_vars, month_periods
+from telemetryfunctions import peak_memory_mb, start_telemetry, stop_telemetry, write_summary
+
+# Sizes of the synthetic data: (rows, columns), months and stations. "global" is the TerraClimate grid (1958-2023)
+bench_presets = {
+    "small": {"shape": (90, 180), "n_months": 24, "n_stations": 20},
+    "medium": {"shape": (720, 1440), "n_months": 120, "n_stations": 200},
+    "global": {"shape": (4320, 8640), "n_months": 792, "n_stations": 2000},
+}
+
+# Stages in the order they run (later stages read the outputs of earlier ones)
+bench_stages = ["tam", "baseflow_monthly", "baseflow_daily", "wyield", "zonal", "climatology", "stations", "recession",
+                "metrics"]
+
+# Name of the file with the configuration of a synthetic data folder
+synthetic_name = "synthetic.json"
+
+
+# Function to build the profile of a global lat/lon grid (same extent as TerraClimate)
+def synthetic_profile(shape):
+
+    from rasterio.transform import from_origin
+
+    ny, nx = shape
+    return {"driver": "GTiff", "height": ny, "width": nx, "count": 1, "dtype": "float32", "crs": "EPSG:4326",
+            "transform": from_origin(-180, 90, 360 / nx, 180 / ny), "nodata": np.nan}
+
+
+# Function to generate nested circular drainage areas: groups of stations whose areas contain each other
+def synthetic_watersheds(shape, n_stations, rng, depth=4):
+    """
+    Returns a list of (station, window, mask) with the (row_off, col_off, height, width) window of each area.
+    """
+    ny, nx = shape
+    areas = []
+    while len(areas) < n_stations:
+        # Outlet of the largest watershed of the group, away from the NoData rows of the south
+        radius = rng.uniform(0.01, 0.05) * ny
+        r = rng.uniform(0.15 * ny + radius, ny - radius)
+        c = rng.uniform(radius, nx - radius)
+        for level in range(min(depth, n_stations - len(areas))):
+            rad = max(1.0, radius * (1 - level / depth))
+            r0, c0 = int(max(0, r - rad)), int(max(0, c - rad))
+            r1, c1 = int(min(ny, r + rad + 1)), int(min(nx, c + rad + 1))
+            rr, cc = np.mgrid[r0:r1, c0:c1]
+            mask = (rr + 0.5 - r) ** 2 + (cc + 0.5 - c) ** 2 <= rad ** 2
+            mask[int(r) - r0, int(c) - c0] = True
+            areas.append((100001 + len(areas), (r0, c0, r1 - r0, c1 - c0), mask))
+            # The next (nested) watershed drains to a point inside this one
+            r, c = r + rng.uniform(-0.2, 0.2) * rad, c + rng.uniform(-0.2, 0.2) * rad
+    return areas
+
+
+# Function to write a GRDC daily text file (*_Q_Day.Cmd.txt) with the layout read by stationfunctions.read_grdc_file
+def write_grdc_daily(path, station, dates, values, downstream="-"):
+
+    lines = ["# Title:                 GRDC STATION DATA FILE",
+             f"# GRDC-No.:              {station}",
+             f"# Next downstream station:  {downstream}",
+             "# Unit of measure:                  m³/s",
+             "# DATA",
+             "YYYY-MM-DD;hh:mm; Value"]
+    values = np.where(np.isnan(values), -999, values)
+    lines += [f"{d};--:--;{v:10.3f}" for d, v in zip(dates, values)]
+    with open(path, "w", encoding="ISO-8859-1") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# Function to generate a folder of synthetic inputs (skipped if it already holds the same configuration)
+def generate_synthetic_data(folder, shape=(90, 180), n_months=24, n_stations=20, start_year=1958, seed=0):
+    """
+    Write the synthetic inputs of the benchmarks:
+        tc/{var}_{year}_{month}.tif: ppt, pet and q (mm) with seasonality and NoData in the southern rows
+        whc.tif (mm x 1000, as the WHC of 6.1), k.tif (monthly k) and daily_k.tif
+        da/{st}_DA.tif: nested drainage areas (see synthetic_watersheds) and da/stations.csv
+        grdc/{st}_Q_Day.Cmd.txt: daily flows with exponential recessions after random events
+
+    Args:
+        folder: Output folder
+        shape: (rows, columns) of the grid
+        n_months: Number of months from January of "start_year". Whole years only, since the zonal statistics and
+                  climatology stages read all the months of each year
+        n_stations: Number of stations (drainage areas and GRDC files)
+        seed: Seed of the random generator
+
+    Returns the configuration (also saved as synthetic.json)
+    """
+    import pandas as pd
+    from scipy.signal import lfilter
+
+    if n_months <= 0 or n_months % 12 != 0:
+        raise ValueError(f"n_months must be a positive multiple of 12 (whole years), not {n_months}")
+
+    config = {"shape": list(shape), "n_months": n_months, "n_stations": n_stations, "start_year": start_year, "seed": seed}
+    config_path = os.path.join(folder, synthetic_name)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) == config:
+                print("Synthetic data already generated: " + folder)
+                return config
+
+    ny, nx = shape
+    rng = np.random.default_rng(seed)
+    profile = synthetic_profile(shape)
+    dirs = {name: os.path.join(folder, name) for name in ["tc", "da", "grdc"]}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+
+    print(f"Generating synthetic data ({ny} x {nx}, {n_months} months, {n_stations} stations)......")
+
+    # NoData south of 60°S (as the land mask of TerraClimate leaves the oceans as NoData)
+    nodata_rows = int(round(ny * 30 / 180))
+    lat = np.linspace(90, -90, ny, dtype=np.float32)[:, np.newaxis]
+    wet = (0.3 + np.cos(np.radians(lat)) ** 2).astype(np.float32)
+
+    whc = rng.uniform(0, 400000, shape).round().astype(np.float32)
+    whc[-nodata_rows:] = np.nan
+    write_raster(os.path.join(folder, "whc.tif"), whc, profile)
+    write_raster(os.path.join(folder, "k.tif"), rng.uniform(0.2, 0.95, shape).astype(np.float32), profile)
+    write_raster(os.path.join(folder, "daily_k.tif"), rng.uniform(0.9, 0.995, shape).astype(np.float32), profile)
+    del whc
+
+    periods = bench_periods(config)
+    for i, (year, month) in enumerate(periods):
+        # Seasons of opposite sign in each hemisphere
+        season = (1 + 0.8 * np.sin(2 * np.pi * i / 12) * np.sign(lat)).astype(np.float32)
+        ppt = 120 * wet * season * rng.random(shape, dtype=np.float32) * np.float32(2)
+        pet = 150 * np.cos(np.radians(lat)).astype(np.float32) * (2 - season) * rng.random(shape, dtype=np.float32)
+        q = ppt * rng.random(shape, dtype=np.float32) * np.float32(0.5)
+        for var, values in zip(tc_vars, [ppt, pet, q]):
+            values[-nodata_rows:] = np.nan
+            write_raster(monthly_path(dirs["tc"], var, year, month), values, profile)
+
+    # Nested drainage areas, each one cropped to its bounding window as the rasters of 4.5
+    areas = synthetic_watersheds(shape, n_stations, rng)
+    for station, window, mask in areas:
+        write_raster(os.path.join(dirs["da"], f"{station}_DA.tif"), np.where(mask, 1, np.nan), profile, window)
+    pd.DataFrame({"grdcno_int": [a[0] for a in areas]}).to_csv(os.path.join(dirs["da"], "stations.csv"), index=False)
+
+    # Daily flows: random events routed through a linear reservoir (exponential recessions)
+    dates = pd.date_range(f"{start_year}-01-01", f"{periods[-1][0]}-12-31", freq="D").strftime("%Y-%m-%d")
+    for station, window, mask in areas:
+        alpha = rng.uniform(0.9, 0.99)
+        events = rng.exponential(50, len(dates)) * (rng.random(len(dates)) < 0.05)
+        flows = lfilter([1 - alpha], [1, -alpha], events) + rng.uniform(0.5, 5)
+        flows[rng.random(len(dates)) < 0.01] = np.nan # Gaps
+        write_grdc_daily(os.path.join(dirs["grdc"], f"{station}_Q_Day.Cmd.txt"), station, dates, flows)
+
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    return config
+
+
+# Function to list the months of a synthetic configuration
+def bench_periods(config):
+    n = config["n_months"]
+    return month_periods(f"{config['start_year']}-01", f"{config['start_year'] + (n - 1) // 12}-{(n - 1) % 12 + 1:02d}")
+
+
+# Function to format a month as "YYYY-MM"
+def period_label(period):
+    return f"{period[0]}-{period[1]:02d}"
+
+
+# Stage functions: bench_{stage}(data_dir, work_dir, config) runs the stage and returns (items, unit) processed
+
+def bench_tam(data_dir, work_dir, config):
+
+    from pipelinefunctions import run_pipeline
+
+    periods = bench_periods(config)
+    run_pipeline(os.path.join(data_dir, "tc"), os.path.join(data_dir, "whc.tif"), 0, os.path.join(work_dir, "tam"),
+                 period_label(periods[0]), period_label(periods[-1]), save_vars=("perc",))
+    return len(periods) * int(np.prod(config["shape"])), "pixel-months"
+
+
+def bench_baseflow_monthly(data_dir, work_dir, config):
+
+    from stagefunctions import stage_baseflow
+
+    periods = bench_periods(config)
+    out_dir = os.path.join(work_dir, "baseflow")
+    os.makedirs(out_dir, exist_ok=True)
+    stage_baseflow(out_dir, {"tam": os.path.join(work_dir, "tam")}, os.path.join(data_dir, "k.tif"),
+                   period_label(periods[0]), period_label(periods[-1]))
+    return len(periods) * int(np.prod(config["shape"])), "pixel-months"
+
+
+def bench_baseflow_daily(data_dir, work_dir, config):
+
+    from pipelinefunctions import run_daily_k_baseflow
+
+    periods = bench_periods(config)
+    run_daily_k_baseflow(os.path.join(work_dir, "tam", "perc"), os.path.join(data_dir, "daily_k.tif"),
+                         os.path.join(work_dir, "bflow_daily"), period_label(periods[0]), period_label(periods[-1]),
+                         save_state=False)
+    return len(periods) * int(np.prod(config["shape"])), "pixel-months"
+
+
+def bench_wyield(data_dir, work_dir, config):
+
+    from stagefunctions import stage_wyield
+
+    periods = bench_periods(config)
+    out_dir = os.path.join(work_dir, "wyield")
+    os.makedirs(out_dir, exist_ok=True)
+    stage_wyield(out_dir, {"baseflow": os.path.join(work_dir, "baseflow")}, os.path.join(data_dir, "tc"),
+                 period_label(periods[0]), period_label(periods[-1]))
+    return len(periods) * int(np.prod(config["shape"])), "pixel-months"
+
+
+def bench_zonal(data_dir, work_dir, config):
+
+    import pandas as pd
+    import zonalfunctions as zf
+
+    periods = bench_periods(config)
+    years = sorted({year for year, month in periods})
+    sts_ids = pd.read_csv(os.path.join(data_dir, "da", "stations.csv"))["grdcno_int"].tolist()
+    out_dir = os.path.join(work_dir, "zonal")
+    os.makedirs(out_dir, exist_ok=True)
+
+    index_path = os.path.join(out_dir, "station_index.npz")
+    zf.save_station_index(index_path, zf.build_station_index(os.path.join(data_dir, "da"), sts_ids,
+                                                             os.path.join(data_dir, "whc.tif")))
+    zf.run_zonal_statistics(index_path, os.path.join(work_dir, "wyield", "wyield"), "wyield", years, out_dir, processes=1)
+    return len(periods) * len(sts_ids), "station-months"
+
+
+def bench_climatology(data_dir, work_dir, config):
+
+    from climatologyfunctions import run_climatology
+
+    periods = bench_periods(config)
+    out_dir = os.path.join(work_dir, "climatology")
+    os.makedirs(out_dir, exist_ok=True)
+    run_climatology(os.path.join(work_dir, "wyield", "wyield"), "wyield", sorted({year for year, month in periods}),
+                    out_dir, processes=1)
+    return len(periods), "rasters"
+
+
+def bench_stations(data_dir, work_dir, config):
+
+    from stationfunctions import load_grdc_folder
+
+    periods = bench_periods(config)
+    flows, _ = load_grdc_folder(os.path.join(data_dir, "grdc"), "daily", st_yr=periods[0][0], ed_yr=periods[-1][0],
+                                      processes=1, cache_file=False)
+    flows.to_pickle(os.path.join(work_dir, "daily_flows.pkl"))
+    return int(flows.size), "station-days"
+
+
+def bench_recession(data_dir, work_dir, config):
+
+    import pandas as pd
+    from baseflowfunctions import recession_constants
+
+    flows = pd.read_pickle(os.path.join(work_dir, "daily_flows.pkl"))
+    recession_constants(flows, processes=1)
+    return int(flows.size), "station-days"
+
+
+def bench_metrics(data_dir, work_dir, config):
+
+    import pandas as pd
+    from metricfunctions import stats_table, stats_breakdown
+
+    # Monthly observed flows and a simulation with multiplicative errors
+    flows = pd.read_pickle(os.path.join(work_dir, "daily_flows.pkl"))
+    obs = flows.groupby(flows.index.str[:7]).mean()
+    rng = np.random.default_rng(config["seed"])
+    sim = obs * rng.lognormal(0, 0.3, obs.shape)
+    stats_table(obs, sim)
+    stats_breakdown(obs, sim, by="month")
+    return int(obs.size), "station-months"
+
+
+def worker_benchmark_stage(args):
+    """
+    Worker function to run and measure a single stage (in its own process, so the peak memory is its own).
+
+    Args:
+        args: Tuple containing (stage, data_dir, work_dir, config, repeat)
+    """
+    stage, data_dir, work_dir, config, repeat = args
+    func = globals()["bench_" + stage]
+    start_memory = peak_memory_mb()
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items, unit = func(data_dir, work_dir, config)
+        seconds.append(time.perf_counter() - start)
+
+    best = min(seconds)
+    return stage, {"seconds": best, "seconds_all": seconds, "items": items, "unit": unit,
+                   "throughput": items / best if best > 0 else None, "start_memory_mb": start_memory,
+                   "peak_memory_mb": peak_memory_mb()}
+
+
+# Function to compare benchmark results against a baseline
+def compare_benchmarks(results, baseline, tolerance=0.25, min_seconds=0.05):
+    """
+    Returns a list of regressions {stage, metric, baseline, value, ratio}: stages slower than the baseline by more than
+    "tolerance" (and by more than "min_seconds", to ignore timer noise) or with a larger peak memory.
+    A baseline of another configuration is not compared (empty list, with a warning).
+    """
+    if baseline.get("config") != results.get("config"):
+        print("\tWarning: The baseline was measured with another configuration; results not compared")
+        return []
+
+    regressions = []
+    for stage, res in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        checks = [("seconds", res["seconds"], base["seconds"], res["seconds"] - base["seconds"] > min_seconds),
+                  ("peak_memory_mb", res["peak_memory_mb"], base["peak_memory_mb"], True)]
+        for metric, value, ref, relevant in checks:
+            if value is None or not ref or not relevant:
+                continue
+            ratio = value / ref
+            if ratio > 1 + tolerance:
+                regressions.append({"stage": stage, "metric": metric, "baseline": ref, "value": value, "ratio": ratio})
+    return regressions
+
+
+# Function to run the benchmarks and save the results (non-interactive)
+def run_benchmarks(out_folder, preset="small", stages=None, baseline_path=None, update_baseline=False, tolerance=0.25,
+                   repeat=1, seed=0, telemetry=True, **sizes):
+    """
+    Args:
+        out_folder: Folder of the synthetic data (data), the stage outputs (work) and the results
+        preset: Name of bench_presets. "sizes" (shape, n_months, n_stations) override its values
+        stages: Stages to run (default: bench_stages). A stage needs the outputs of the stages before it
+        baseline_path: JSON of the baseline (default: {out_folder}/baseline_{preset}.json)
+        update_baseline: If True, the results are saved as the new baseline
+        tolerance: Relative slowdown (or memory increase) flagged as a regression
+        repeat: Number of runs of each stage (the fastest one is kept)
+        telemetry: If True, the stages also log their events to {out_folder}/telemetry.jsonl (see telemetryfunctions)
+
+    Returns the results dictionary (also saved as {out_folder}/benchmark_{timestamp}.json)
+    """
+    sizes = dict(bench_presets[preset], **sizes)
+    data_dir, work_dir = os.path.join(out_folder, "data"), os.path.join(out_folder, "work")
+    os.makedirs(work_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    config = generate_synthetic_data(data_dir, tuple(sizes["shape"]), sizes["n_months"], sizes["n_stations"], seed=seed)
+    generation = time.perf_counter() - start
+
+    print("")
+    print("************************************************************************")
+    print(f"         Benchmarks ({preset}: {config['shape'][0]} x {config['shape'][1]}, {config['n_months']} months, "
+          f"{config['n_stations']} stations)")
+    print("************************************************************************")
+    print("")
+
+    results = {"config": config, "preset": preset, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "platform": {"system": platform.system(), "machine": platform.machine(), "python": platform.python_version(),
+                            "numpy": np.__version__, "cpus": os.cpu_count()},
+               "generation_seconds": generation, "stages": {}}
+
+    if telemetry:
+        log_path = os.path.join(out_folder, "telemetry.jsonl")
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        start_telemetry(log_path)
+
+    for stage in stages or bench_stages:
+        # A fresh process per stage
+        with Pool(processes=1, maxtasksperchild=1) as pool:
+            name, res = pool.apply(worker_benchmark_stage, ((stage, data_dir, work_dir, config, repeat),))
+        results["stages"][name] = res
+        memory = f"{res['peak_memory_mb']:.0f} MB" if res["peak_memory_mb"] is not None else "n/a"
+        print(f"\t{name}: {res['seconds']:.2f} s, {res['throughput']:.3g} {res['unit']}/s, peak memory {memory}")
+
+    if telemetry:
+        stop_telemetry()
+        results["telemetry"] = write_summary(log_path)
+
+    baseline_path = baseline_path or os.path.join(out_folder, f"baseline_{preset}.json")
+    if os.path.exists(baseline_path) and not update_baseline:
+        with open(baseline_path) as f:
+            results["regressions"] = compare_benchmarks(results, json.load(f), tolerance)
+        for reg in results["regressions"]:
+            print(f"\tREGRESSION {reg['stage']}: {reg['metric']} {reg['value']:.3g} vs {reg['baseline']:.3g} "
+                  f"(x{reg['ratio']:.2f})")
+        if not results["regressions"]:
+            print("\tNo regressions against " + baseline_path)
+
+    results_path = os.path.join(out_folder, "benchmark_" + time.strftime("%Y%m%d_%H%M%S") + ".json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    if update_baseline or not os.path.exists(baseline_path):
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print("\tBaseline saved: " + baseline_path)
+
+    print("DONE!!!")
+    return results
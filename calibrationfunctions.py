@@ -0,0 +1,218 @@
+# Calibration of the monthly recession constant (k) and the WHC of the gauged watersheds (7.6.calibration_analysis)
+# Only the union of the drainage-area pixels of the stations (see zonalfunctions.build_station_index) is simulated.
+# Their TerraClimate inputs are read once into (months x pixels) arrays, and the T&M recursion (wbfunctions.run_tam)
+# runs for many candidates at once on (candidates x pixels) arrays. Candidates are scored per station against the
+# observed flows (mm/month) with KGE (2012) or PBIAS (see metricfunctions)
+
+import numpy as np
+import pandas as pd
+
+from rasterfunctions import read_raster, geotiff_reader
+from wbfunctions import tc_vars, month_periods, prepare_whc, run_tam
+from metricfunctions import skill_metrics
+import zonalfunctions as zf
+
+
+# Function to read the inputs of the indexed pixels for all the months
+def read_gauged_inputs(tc_folder, index, periods):
+    """
+    Returns {var: (months x pixels) float32 array} for ppt, pet and q, reading only the window of the station index.
+
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs, or a reader(var, year, month, out) of the window of the index
+                   (e.g., cubefunctions.cube_reader(store, window=index["window"]))
+        index: Station index (see zonalfunctions.build_station_index)
+        periods: List of (year, month)
+    """
+    h, w = index["window"][2:]
+    reader = tc_folder if callable(tc_folder) else geotiff_reader(tc_folder, window=index["window"])
+    block = np.empty((h, w), dtype=np.float32)
+
+    inputs = {var: np.empty((len(periods), index["pixels"].size), dtype=np.float32) for var in tc_vars}
+    for i, (year, month) in enumerate(periods):
+        for var in tc_vars:
+            reader(var, year, month, block)
+            inputs[var][i] = zf.gather_pixels(index, block, windowed=True)
+
+    return inputs
+
+
+# Function to save the gauged inputs (NPZ), so the rasters are read only once per calibration session
+def save_gauged_inputs(path, inputs, periods):
+    np.savez(path, periods=np.asarray(periods), **inputs)
+
+
+# Function to load the gauged inputs saved with save_gauged_inputs
+def load_gauged_inputs(path):
+
+    with np.load(path) as f:
+        return {var: f[var] for var in tc_vars}, [tuple(int(v) for v in p) for p in f["periods"]]
+
+
+# Function to simulate the station means of wyield for many candidates at once
+def simulate_candidates(inputs, periods, whc, k, matrix, columns=None, ffcb=0.1, bflow_ant=10, clamp=True,
+                        var="wyield"):
+    """
+    Run the T&M model on (candidates x pixels) arrays and return the station means as a (months x stations x candidates)
+    float32 array.
+
+    Args:
+        inputs: Gauged inputs (see read_gauged_inputs)
+        periods: List of (year, month) of the inputs
+        whc: WHC (mm) of the simulated pixels per candidate, (candidates x pixels)
+        k: Monthly recession constant per candidate, (candidates x 1) or (candidates x pixels)
+        matrix: Sparse (stations x simulated pixels) matrix used to average the pixels of each station
+        columns: Optional gauged pixel of each simulated pixel (e.g., one per station member). Default: all of them
+        var: Variable to average (see wbfunctions.tam_vars)
+    """
+    index = {"matrix": matrix}
+    month_index = {period: i for i, period in enumerate(periods)}
+    sim = np.empty((len(periods), matrix.shape[0], whc.shape[0]), dtype=np.float32)
+
+    def reader(var, year, month, out):
+        values = inputs[var][month_index[(year, month)]]
+        out[...] = values if columns is None else values[columns]
+        return out
+
+    def on_month(year, month, wb):
+        sim[month_index[(year, month)]] = zf.zonal_statistics(index, wb[var].T)[1]
+
+    run_tam(reader, whc, k, periods, ffcb, bflow_ant, on_month, clamp)
+    return sim
+
+
+# Function to score (months x stations x candidates) simulations against the observed flows
+def score_candidates(obs, sim, objective="KGE_2012"):
+    """
+    Returns (score, metrics): the score is lower-is-better ("KGE_2012": 1 - KGE, "PBIAS": |PBIAS|, "NSE": 1 - NSE),
+    and metrics is the dictionary of metricfunctions.skill_metrics with (stations x candidates) arrays.
+    """
+    metrics = skill_metrics(obs[:, :, np.newaxis], sim)
+    score = np.abs(metrics["PBIAS"]) if objective == "PBIAS" else 1 - metrics[objective]
+    return np.where(np.isnan(score), np.inf, score), metrics
+
+
+# Function to calibrate k and a WHC scaling factor per station
+def calibrate_stations(inputs, periods, whc, index, obs_df, k_range=(0.05, 0.99), whc_range=(0.5, 2.0), n_k=10,
+                       n_whc=4, n_rounds=3, objective="KGE_2012", score_period=None, ffcb=0.1, bflow_ant=10, clamp=True):
+    """
+    Grid search on the union of the gauged pixels followed by a per-station refinement.
+
+    The first round simulates a global grid of n_k x n_whc candidates (the same for every station) on the union of
+    the drainage-area pixels. Each refinement round then evaluates, for every station at the same time, the 3 x 3
+    candidates around its best one with half the previous step. Refinements simulate one copy of the pixels per
+    station member, so that each station has its own candidates even if watersheds are nested.
+
+    Args:
+        inputs: Gauged inputs (see read_gauged_inputs), with the months of "periods" (warm-up included)
+        periods: List of (year, month)
+        whc: WHC (mm) of the indexed pixels, already prepared with prepare_whc (see gauged_whc)
+        index: Station index (see zonalfunctions.build_station_index)
+        obs_df: Observed flows (mm/month) indexed by "YYYY-MM" with one column per station (e.g., Joined_Monthly_Sts_DFs_mm.csv)
+        k_range, whc_range: Limits of k and of the WHC scaling factor
+        n_k, n_whc: Size of the grid of the first round
+        n_rounds: Number of refinement rounds
+        objective: "KGE_2012", "NSE" or "PBIAS"
+        score_period: Optional ("YYYY-MM", "YYYY-MM") months used for the scores (default: all the months with data)
+        ffcb, bflow_ant, clamp: See wbfunctions.run_tam
+
+    Returns a DataFrame indexed by "Station" with k_recession_calibrated, whc_scale and the metrics of the best candidate
+    """
+    from scipy import sparse
+
+    dates = [f"{year}-{month:02d}" for year, month in periods]
+    stations = [str(st) for st in index["stations"]]
+    obs = obs_df.reindex(index=dates, columns=stations).to_numpy(dtype=np.float64)
+    if score_period is not None:
+        outside = (np.asarray(dates) < score_period[0]) | (np.asarray(dates) > score_period[1])
+        obs[outside] = np.nan
+
+    whc = np.asarray(whc, dtype=np.float32)
+    n_sts = len(stations)
+
+    # Round 0: the same grid for all the stations, on the union of the gauged pixels
+    k_grid, whc_grid = np.meshgrid(np.linspace(*k_range, n_k), np.geomspace(*whc_range, n_whc), indexing="ij")
+    k_grid, whc_grid = k_grid.reshape(-1), whc_grid.reshape(-1)
+    print(f"\tRound 0: {k_grid.size} candidates x {whc.size} pixels")
+    sim = simulate_candidates(inputs, periods, whc[np.newaxis] * whc_grid[:, np.newaxis].astype(np.float32),
+                              k_grid[:, np.newaxis], index["matrix"], ffcb=ffcb, bflow_ant=bflow_ant, clamp=clamp)
+    score, metrics = score_candidates(obs, sim, objective)
+
+    best = np.argmin(score, axis=1)
+    rows = np.arange(n_sts)
+    best_k, best_whc, best_score = k_grid[best], whc_grid[best], score[rows, best]
+    best_metrics = {name: value[rows, best] for name, value in metrics.items()}
+
+    # Station members: one simulated pixel per (station, pixel) pair
+    matrix = index["matrix"].tocsr()
+    columns = matrix.indices
+    member_station = np.repeat(rows, np.diff(matrix.indptr))
+    member_matrix = sparse.csr_matrix((np.ones(columns.size), np.arange(columns.size), matrix.indptr), shape=(n_sts, columns.size))
+
+    dk = (k_range[1] - k_range[0]) / max(1, n_k - 1)
+    dw = np.log(whc_range[1] / whc_range[0]) / max(1, n_whc - 1)
+    offsets_k, offsets_w = [v.reshape(-1) for v in np.meshgrid([-1, 0, 1], [-1, 0, 1], indexing="ij")]
+
+    for r in range(1, n_rounds + 1):
+        dk, dw = dk / 2, dw / 2
+        cand_k = np.clip(best_k[np.newaxis] + offsets_k[:, np.newaxis] * dk, *k_range)
+        cand_whc = np.clip(best_whc[np.newaxis] * np.exp(offsets_w[:, np.newaxis] * dw), *whc_range)
+        print(f"\tRound {r}: {cand_k.shape[0]} candidates x {columns.size} station pixels")
+
+        sim = simulate_candidates(inputs, periods, (whc[columns][np.newaxis] * cand_whc[:, member_station]).astype(np.float32),
+                                  cand_k[:, member_station], member_matrix, columns, ffcb, bflow_ant, clamp)
+        score, metrics = score_candidates(obs, sim, objective)
+
+        best = np.argmin(score, axis=1)
+        better = score[rows, best] < best_score
+        best_k = np.where(better, cand_k[best, rows], best_k)
+        best_whc = np.where(better, cand_whc[best, rows], best_whc)
+        best_score = np.where(better, score[rows, best], best_score)
+        for name, value in metrics.items():
+            best_metrics[name] = np.where(better, value[rows, best], best_metrics[name])
+
+    results = pd.DataFrame({"k_recession_calibrated": best_k, "whc_scale": best_whc, **best_metrics},
+                           index=pd.Index(stations, name="Station"))
+
+    # Stations without observations (or drainage area) keep no calibrated values
+    results.loc[~np.isfinite(best_score)] = np.nan
+    return results
+
+
+# Function to read the WHC (mm) of the indexed pixels
+def gauged_whc(whc_path, index, whc_scale=1000):
+    return zf.gather_pixels(index, prepare_whc(read_raster(whc_path, window=index["window"]), whc_scale), windowed=True)
+
+
+# Function to run the calibration from the rasters (7.6.calibration_analysis)
+def run_calibration(tc_folder, whc_path, station_index, obs_df, start_date="1958-01", end_date="2023-12",
+                    inputs_path=None, whc_scale=1000, **kwargs):
+    """
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs or a reader (see read_gauged_inputs)
+        whc_path: Water holding capacity raster
+        station_index: Station index or the path where it was saved (see zonalfunctions.save_station_index)
+        obs_df: Observed flows (mm/month), see calibrate_stations
+        start_date, end_date: Simulated period (the first months act as warm-up if they have no observations)
+        inputs_path: Optional NPZ of the gauged inputs. Created the first time, then reused
+        whc_scale: See pipelinefunctions.read_parameters
+        kwargs: Options of calibrate_stations
+    """
+    import os
+
+    if isinstance(station_index, str):
+        station_index = zf.load_station_index(station_index)
+    periods = month_periods(start_date, end_date)
+
+    if inputs_path is not None and os.path.exists(inputs_path):
+        inputs, saved_periods = load_gauged_inputs(inputs_path)
+        if saved_periods != periods:
+            raise ValueError(f"{inputs_path} has other months than {start_date} to {end_date}")
+    else:
+        print("Reading inputs of the gauged pixels......")
+        inputs = read_gauged_inputs(tc_folder, station_index, periods)
+        if inputs_path is not None:
+            save_gauged_inputs(inputs_path, inputs, periods)
+
+    whc = gauged_whc(whc_path, station_index, whc_scale)
+    return calibrate_stations(inputs, periods, whc, station_index, obs_df, **kwargs)
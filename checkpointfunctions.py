@@ -0,0 +1,146 @@
+# Run manifest and state checkpoints of long model runs (T&M monthly chain and daily-k baseflow)
+# A run folder keeps a small JSON manifest (run_manifest.json) with the configuration, the last completed month and
+# the latest state snapshots (state_YYYY-MM.npz). Files are written to a temporary name and then renamed, so an
+# interrupted run never leaves a half-written manifest or snapshot. Resuming reads the manifest and one snapshot,
+# instead of scanning the output folders, and a finished run can be extended with new months from its last state
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from wbfunctions import month_periods
+
+manifest_name = "run_manifest.json"
+
+
+# Function to replace a file atomically with a JSON document
+def atomic_write_json(path, data):
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Function to turn a setting into a JSON value that can be compared between runs
+def config_value(value):
+    """
+    Strings (e.g., paths) and None are kept, numbers become floats, and arrays (e.g., a k grid) a hash of their
+    shape and values
+    """
+    if value is None or isinstance(value, str):
+        return value
+    value = np.asarray(value, dtype=np.float64)
+    if value.ndim == 0:
+        return float(value)
+    return "sha1:" + hashlib.sha1(str(value.shape).encode() + np.ascontiguousarray(value).tobytes()).hexdigest()
+
+
+# Function to read the manifest of a run folder (None if the run has not started)
+def load_manifest(run_dir):
+
+    path = os.path.join(run_dir, manifest_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Function to open the manifest of a run, creating it if needed
+def open_manifest(run_dir, run_type, config):
+    """
+    Args:
+        run_dir: Folder of the manifest and the snapshots
+        run_type: Kind of run (e.g., "tam" or "daily_k")
+        config: Dictionary of the settings that must not change between resumed runs (paths, constants, start date)
+
+    Raises ValueError if the folder holds a run of another type or with another configuration
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    manifest = load_manifest(run_dir)
+
+    if manifest is None:
+        manifest = {"run_type": run_type, "config": config, "last_completed": None, "snapshots": []}
+        atomic_write_json(os.path.join(run_dir, manifest_name), manifest)
+        return manifest
+
+    if manifest["run_type"] != run_type:
+        raise ValueError(f"{run_dir} holds a '{manifest['run_type']}' run, not '{run_type}'")
+    changed = {key: (manifest["config"].get(key), value) for key, value in config.items() if manifest["config"].get(key) != value}
+    if changed:
+        raise ValueError(f"Configuration of {run_dir} does not match the run to resume: {changed}")
+
+    return manifest
+
+
+# Function to get the state of the last snapshot and the months still to run
+def resume_point(run_dir, manifest, start_date, end_date):
+    """
+    Returns (periods, state): the months after the last snapshot up to "end_date", and the arrays of that snapshot
+    (None for a new run). Raises FileNotFoundError if the manifest points to a missing snapshot, instead of falling
+    back to the initial conditions.
+    """
+    periods = month_periods(start_date, end_date)
+    if manifest["last_completed"] is None:
+        return periods, None
+
+    last = tuple(int(v) for v in manifest["last_completed"].split("-"))
+    path = os.path.join(run_dir, manifest["snapshots"][-1])
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Snapshot {path} of the run manifest is missing")
+
+    with np.load(path) as f:
+        state = {name: f[name] for name in f.files}
+
+    return [period for period in periods if period > last], state
+
+
+# Function to save a state snapshot and record the month as completed
+def save_snapshot(run_dir, manifest, year, month, arrays, keep=2):
+    """
+    Args:
+        run_dir: Folder of the run
+        manifest: Manifest of the run (see open_manifest), updated in place
+        year, month: Last month whose outputs are already saved
+        arrays: Dictionary of state arrays (e.g., {"sstor": ..., "bflow": ...})
+        keep: Number of snapshots kept (older ones are deleted)
+    """
+    name = f"state_{year}-{month:02d}.npz"
+    tmp = os.path.join(run_dir, name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(run_dir, name))
+
+    manifest["last_completed"] = f"{year}-{month:02d}"
+    manifest["snapshots"] = [s for s in manifest["snapshots"] if s != name] + [name]
+    old, manifest["snapshots"] = manifest["snapshots"][:-keep], manifest["snapshots"][-keep:]
+    atomic_write_json(os.path.join(run_dir, manifest_name), manifest)
+
+    for s in old:
+        if os.path.exists(os.path.join(run_dir, s)):
+            os.remove(os.path.join(run_dir, s))
+
+
+# Function that returns a checkpoint function to call after the outputs of each month are saved
+def checkpointer(run_dir, manifest, periods, every=12, keep=2, before_save=None):
+    """
+    Returns checkpoint(year, month, arrays), which saves a snapshot every "every" months and after the last month.
+    before_save() is called before each snapshot (e.g., to wait for the background writes of the outputs, so a
+    snapshot never records months whose rasters are not on disk yet).
+    """
+    last = periods[-1] if periods else None
+    count = {"months": 0}
+
+    def checkpoint(year, month, arrays):
+        count["months"] += 1
+        if count["months"] % every == 0 or (year, month) == last:
+            if before_save is not None:
+                before_save()
+            save_snapshot(run_dir, manifest, year, month, arrays, keep)
+
+    return checkpoint
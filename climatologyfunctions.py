@@ -0,0 +1,234 @@
+# Climatologies of the monthly inputs and outputs of the T&M model (replaces 8.average_inputs_outputs.py)
+# Every monthly raster ({var}_{year}_{month}.tif) is read once: running accumulators give the multiannual monthly means
+# ({var}_month_{month}.tif), the yearly totals ({var}_year_{year}.tif, SUM, or MEAN for t-variables) and the
+# multiannual mean ({var}_annual.tif), as CellStatistics with "DATA" (NoData ignored). The grid is split into tiles
+# that run in a process pool
+
+import os
+import time
+import numpy as np
+from multiprocessing import Pool
+
+from rasterfunctions import raster_profile, read_raster, write_raster, monthly_path
+from wbfunctions import tc_vars
+from pipelinefunctions import tile_windows
+from telemetryfunctions import stage_span
+
+# Options of variables (as in 8.average_inputs_outputs.py)
+weather_vars = {1: "ppt", 2: "pet", 3: "q", 4: "eprec", 5: "aet", 6: "perc", 7: "sstor", 8: "bflow", 9: "bflow3", 10: "wyield", 11: "wyield3"}
+
+# Optional statistics of the yearly values ({var}_annual_{stat}.tif)
+extra_stats = ["std", "min", "max", "trend"]
+
+# Bytes per pixel of one tile: float64 accumulators (12 months x 2, year x 2, annual x 7) plus the float32 raster block.
+# The yearly values add 8 bytes per year
+climatology_bytes_per_pixel = 8 * (2 * 12 + 2 + 7) + 4
+
+
+# Function to get the folder, file name and warm-up years of a variable (same rules as 8.average_inputs_outputs.py)
+def climatology_settings(name, tc_folder, tam_folder):
+
+    if name in tc_vars:
+        return tc_folder, name, 0
+    if name in ["bflow3", "wyield3"]:
+        return os.path.join(tam_folder, name), name[:-1], 6 # Remove the last character '3' from the variable name
+    return os.path.join(tam_folder, name), name, 6
+
+
+# Function to calculate the climatologies of one block for all the months of the years
+def reduce_block(folder, wv, years, stats=(), window=None):
+    """
+    Returns (month_mean, year_values, annual_mean, extras) for the window, reading each {wv}_{year}_{month}.tif once.
+    Missing rasters are skipped, like the file search of 8.average_inputs_outputs.py.
+
+    Args:
+        folder: Folder with {wv}_{year}_{month}.tif
+        wv: Variable of the file names
+        years: Years to process
+        stats: Optional statistics of the yearly values (see extra_stats)
+        window: Optional (row_off, col_off, height, width)
+    """
+    # Different math operation for temperatures
+    yearly_mean = wv[0] == "t"
+    shape = (window[2], window[3]) if window is not None else None
+
+    block = month_sum = month_count = None
+    year_values = []
+    for year in years:
+        year_sum = year_count = None
+        for month in range(1, 12 + 1):
+            path = monthly_path(folder, wv, year, month)
+            if not os.path.exists(path):
+                continue
+
+            block = read_raster(path, window=window, out=block)
+            if month_sum is None:
+                shape = block.shape
+                month_sum, month_count = np.zeros((12,) + shape), np.zeros((12,) + shape, dtype=np.int32)
+            if year_sum is None:
+                year_sum, year_count = np.zeros(shape), np.zeros(shape, dtype=np.int32)
+
+            valid = ~np.isnan(block)
+            values = np.where(valid, block, 0)
+            month_sum[month - 1] += values
+            month_count[month - 1] += valid
+            year_sum += values
+            year_count += valid
+
+        if year_sum is None:
+            year_values.append(None)
+            continue
+        with np.errstate(invalid="ignore", divide="ignore"):
+            total = year_sum / year_count if yearly_mean else year_sum
+        year_values.append(np.where(year_count > 0, total, np.nan))
+
+    if month_sum is None:
+        raise FileNotFoundError(f"No {wv}_{{year}}_{{month}} rasters found in {folder} for {years[0]}-{years[-1]}")
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        month_mean = np.where(month_count > 0, month_sum / month_count, np.nan)
+
+    # Accumulators of the yearly values (NoData ignored)
+    n = np.zeros(shape)
+    s, ss, st, stt, stx = (np.zeros(shape) for _ in range(5))
+    vmin, vmax = np.full(shape, np.inf), np.full(shape, -np.inf)
+    for t, values in enumerate(year_values):
+        if values is None:
+            continue
+        valid = ~np.isnan(values)
+        x = np.where(valid, values, 0)
+        n += valid
+        s += x
+        ss += x * x
+        st += t * valid
+        stt += t * t * valid
+        stx += t * x
+        np.fmin(vmin, values, out=vmin)
+        np.fmax(vmax, values, out=vmax)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        annual_mean = np.where(n > 0, s / n, np.nan)
+        extras = {
+            "std": np.where(n > 0, np.sqrt(np.maximum(ss / n - annual_mean ** 2, 0)), np.nan),
+            "min": np.where(n > 0, vmin, np.nan),
+            "max": np.where(n > 0, vmax, np.nan),
+            # Least-squares slope per year
+            "trend": np.where(n > 1, (n * stx - st * s) / (n * stt - st * st), np.nan),
+        }
+
+    year_values = [np.full(shape, np.nan) if v is None else v for v in year_values]
+    return month_mean, year_values, annual_mean, {stat: extras[stat] for stat in stats}
+
+
+def worker_climatology_tile(args):
+    """
+    Worker function to reduce a single tile and write it into the block of the output cube.
+
+    Args:
+        args: Tuple containing (tile_id, window, folder, wv, years, stats, cube_file)
+    """
+    tile_id, window, folder, wv, years, stats, cube_file = args
+    start = time.time()
+    r0, c0, h, w = window
+
+    with stage_span("climatology", "task", task=tile_id, variable=wv, items=12 * len(years) * h * w, unit="pixel-months"):
+        month_mean, year_values, annual_mean, extras = reduce_block(folder, wv, years, stats, window)
+        cube = np.load(cube_file, mmap_mode="r+")
+        cube[:12, r0:r0 + h, c0:c0 + w] = month_mean
+        cube[12:12 + len(years), r0:r0 + h, c0:c0 + w] = np.stack(year_values)
+        cube[12 + len(years), r0:r0 + h, c0:c0 + w] = annual_mean
+        for j, stat in enumerate(stats):
+            cube[13 + len(years) + j, r0:r0 + h, c0:c0 + w] = extras[stat]
+        cube.flush()
+
+    return tile_id, time.time() - start
+
+
+# Function to calculate the climatologies of one variable
+def run_climatology(folder, wv, years, out_folder=None, stats=(), max_memory_mb=1024, processes=None, ref_raster=None):
+    """
+    Args:
+        folder: Folder with {wv}_{year}_{month}.tif
+        wv: Variable of the file names (e.g., "bflow")
+        years: Years to process (e.g., range(1964, 2023 + 1) after a 6-yr warm-up)
+        out_folder: Output folder (default: "folder", as 8.average_inputs_outputs.py)
+        stats: Optional statistics of the yearly values (see extra_stats)
+        max_memory_mb: Memory limit of the accumulators of each worker
+        processes: Number of processes (default: number of CPUs - 1)
+        ref_raster: Optional raster with the grid (default: first raster of the first year)
+    """
+    years = list(years)
+    out_folder = out_folder or folder
+    stats = list(stats)
+    if ref_raster is None:
+        ref_raster = next(monthly_path(folder, wv, year, month) for year in years for month in range(1, 12 + 1)
+                          if os.path.exists(monthly_path(folder, wv, year, month)))
+    profile = raster_profile(ref_raster)
+    shape = (profile["height"], profile["width"])
+    windows = tile_windows(shape, max_memory_mb, climatology_bytes_per_pixel + 8 * len(years))
+
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+    processes = min(processes, len(windows))
+
+    print("")
+    print("************************************************************************")
+    print("         Reducing " + wv + " datasets (" + str(years[0]) + "-" + str(years[-1]) + ", "
+          + str(len(windows)) + " tiles)")
+    print("************************************************************************")
+    print("")
+
+    # Temporary cube: 12 months, the years, the multiannual mean and the extra statistics
+    cube_file = os.path.join(out_folder, wv + "_climatology.npy")
+    cube = np.lib.format.open_memmap(cube_file, mode="w+", dtype=np.float32, shape=(13 + len(years) + len(stats),) + shape)
+    del cube
+
+    worker_args = [(i, window, folder, wv, years, stats, cube_file) for i, window in enumerate(windows)]
+    with stage_span("climatology", variable=wv, tiles=len(windows)):
+        if processes == 1:
+            results = map(worker_climatology_tile, worker_args)
+            for tile_id, seconds in results:
+                print(f"\tTile {tile_id + 1} of {len(windows)} completed in {seconds:.1f} s")
+        else:
+            with Pool(processes=processes) as pool:
+                for tile_id, seconds in pool.imap_unordered(worker_climatology_tile, worker_args):
+                    print(f"\tTile {tile_id + 1} of {len(windows)} completed in {seconds:.1f} s")
+
+        # Same file names as 8.average_inputs_outputs.py
+        cube = np.load(cube_file, mmap_mode="r")
+        for month in range(1, 12 + 1):
+            write_raster(os.path.join(out_folder, wv + "_month_" + str(month) + ".tif"), cube[month - 1], profile)
+        for j, year in enumerate(years):
+            write_raster(os.path.join(out_folder, wv + "_year_" + str(year) + ".tif"), cube[12 + j], profile)
+        write_raster(os.path.join(out_folder, wv + "_annual.tif"), cube[12 + len(years)], profile)
+        for j, stat in enumerate(stats):
+            write_raster(os.path.join(out_folder, wv + "_annual_" + stat + ".tif"), cube[13 + len(years) + j], profile)
+
+        del cube
+    os.remove(cube_file)
+
+
+# Function to calculate the climatologies of many variables in one invocation (non-interactive)
+def run_climatologies(tc_folder, tam_folder, variables=None, range_years=None, stats=(), max_memory_mb=1024, processes=None):
+    """
+    Args:
+        tc_folder: Folder with the TerraClimate GeoTIFFs (ppt, pet, q)
+        tam_folder: Folder with one subfolder per T&M output (e.g., T&M_WBM\\bflow)
+        variables: Names or numbers of weather_vars (default: all of them)
+        range_years: Interval of years (e.g., "1958-2023"). By default, the period from 1958 (plus the warm-up years) to 2023
+        stats: Optional statistics of the yearly values (see extra_stats)
+        max_memory_mb, processes: See run_climatology
+    """
+    variables = list(weather_vars.values()) if variables is None else [weather_vars.get(v, v) for v in variables]
+
+    for name in variables:
+        folder, wv, warmup_yrs = climatology_settings(name, tc_folder, tam_folder)
+        if range_years is None:
+            years = range(1958 + warmup_yrs, 2023 + 1)
+        else:
+            first, last = range_years.split("-")
+            years = range(int(first), int(last) + 1)
+
+        run_climatology(folder, wv, years, stats=stats, max_memory_mb=max_memory_mb, processes=processes)
+
+    print("DONE!!!")
@@ -0,0 +1,245 @@
+# Chunked and compressed cubes (months, y, x) for the inputs and outputs of the T&M model
+# One Zarr array per variable ({store}/{var}.zarr) replaces the tens of thousands of {var}_{year}_{month}.tif files.
+# Chunking is selectable: "space" chunks (one month per chunk) serve map reads, while "time" chunks
+# (many months of a small block) serve time-series reads of stations
+# TerraClimate yearly NetCDF files (TerraClimate_{var}_{year}.nc) can also be read lazily, without 5.convert_NetCDF_to_GeoTIFF
+
+import os
+import numpy as np
+
+# Chunk shapes (months, rows, columns) of the presets
+chunk_presets = {
+    "space": (1, 1080, 1080),
+    "time": (120, 128, 128),
+}
+
+
+# Function to build the path of the cube of a variable
+def cube_store_path(store, var):
+    return os.path.join(store, var + ".zarr")
+
+
+# Function to resolve the chunk shape of a preset (or an explicit tuple) for a cube shape
+def cube_chunks(chunking, shape):
+
+    chunks = chunk_presets[chunking] if isinstance(chunking, str) else tuple(chunking)
+    return tuple(min(c, s) for c, s in zip(chunks, shape))
+
+
+# Function to create the cube of a variable
+def create_cube(store, var, periods, shape, chunking="space", profile=None):
+    """
+    Create an empty (NaN) float32 cube of shape (months, y, x).
+
+    Args:
+        store: Folder of the cube store
+        var: Variable name (e.g., "wyield")
+        periods: List of (year, month) of the time axis
+        shape: (y, x) of the grid
+        chunking: "space", "time" or an explicit (months, rows, columns) tuple
+        profile: Optional rasterio profile of the grid (transform and crs are kept as attributes)
+    """
+    import zarr
+
+    full_shape = (len(periods),) + tuple(shape)
+    cube = zarr.open_array(store=cube_store_path(store, var), mode="w", shape=full_shape,
+                           chunks=cube_chunks(chunking, full_shape), dtype="float32", fill_value=np.nan)
+
+    cube.attrs["periods"] = [f"{year}-{month:02d}" for year, month in periods]
+    if profile is not None:
+        cube.attrs["transform"] = list(profile["transform"])[:6]
+        cube.attrs["crs"] = str(profile["crs"])
+
+    return cube
+
+
+# Function to open the cube of a variable
+def open_cube(store, var, mode="r"):
+
+    import zarr
+
+    return zarr.open_array(store=cube_store_path(store, var), mode=mode)
+
+
+# Function to get the list of (year, month) of a cube
+def cube_periods(cube):
+    return [tuple(int(v) for v in period.split("-")) for period in cube.attrs["periods"]]
+
+
+# Function that returns a reader of cubes (e.g., ppt, pet, q) for the NumPy engine (see wbfunctions.run_tam)
+def cube_reader(store, window=None):
+    """
+    Returns reader(var, year, month, out) that fills "out" with the month of {store}/{var}.zarr.
+    """
+    cubes, index = {}, {}
+
+    def reader(var, year, month, out):
+        if var not in cubes:
+            cubes[var] = open_cube(store, var)
+            index[var] = {period: i for i, period in enumerate(cube_periods(cubes[var]))}
+
+        i = index[var][(year, month)]
+        if window is None:
+            out[...] = cubes[var][i]
+        else:
+            r0, c0, h, w = window
+            out[...] = cubes[var][i, r0:r0 + h, c0:c0 + w]
+        return out
+
+    return reader
+
+
+# Function that returns a lazy reader of TerraClimate yearly NetCDF files for the NumPy engine
+def netcdf_reader(tc_ds, window=None):
+    """
+    Returns reader(var, year, month, out) that fills "out" with the month of TerraClimate_{var}_{year}.nc.
+    Scale factors and fill values are decoded, and rows go from north to south as in the GeoTIFF files.
+    Only the requested month (and window) is read from disk.
+    """
+    import xarray as xr
+
+    datasets = {}
+
+    def reader(var, year, month, out):
+        key = (var, year)
+        if key not in datasets:
+            # Only one year per variable is kept open
+            for old in [k for k in datasets if k[0] == var]:
+                datasets.pop(old).close()
+            datasets[key] = xr.open_dataset(os.path.join(tc_ds, f"TerraClimate_{var}_{year}.nc"))
+
+        da = datasets[key][var]
+        if da["lat"].values[0] < da["lat"].values[-1]:
+            da = da.isel(lat=slice(None, None, -1))
+        da = da.isel(time=month - 1)
+        if window is not None:
+            r0, c0, h, w = window
+            da = da.isel(lat=slice(r0, r0 + h), lon=slice(c0, c0 + w))
+
+        out[...] = da.values
+        return out
+
+    return reader
+
+
+# Function to extend the time axis of a cube to "periods" (e.g., when a new TerraClimate year is released)
+def extend_cube(store, var, periods):
+
+    cube = open_cube(store, var, mode="r+")
+    labels = [f"{year}-{month:02d}" for year, month in periods]
+    if labels[:cube.shape[0]] != cube.attrs["periods"][:len(labels)]:
+        raise ValueError(f"Months of {cube_store_path(store, var)} do not match the periods of the run")
+
+    if cube.shape[0] < len(periods):
+        cube.resize((len(periods),) + tuple(cube.shape[1:]))
+        cube.attrs["periods"] = labels
+    return cube
+
+
+# Function to copy monthly inputs (GeoTIFF or NetCDF readers) into a cube
+def build_cube(reader, store, var, periods, shape, chunking="space", profile=None):
+    """
+    Write every month given by reader(var, year, month, out) into {store}/{var}.zarr.
+    With "time" chunking, months are buffered so each chunk is written once.
+    """
+    cube = create_cube(store, var, periods, shape, chunking, profile)
+    step = cube.chunks[0]
+    block = np.empty((step,) + tuple(shape), dtype=np.float32)
+
+    for start in range(0, len(periods), step):
+        n = min(step, len(periods) - start)
+        for j in range(n):
+            year, month = periods[start + j]
+            reader(var, year, month, block[j])
+        cube[start:start + n] = block[:n]
+        print(f"\t{var}: {periods[start + n - 1][0]}-{periods[start + n - 1][1]} written")
+
+    return cube
+
+
+# Function that returns an on_month function writing the T&M outputs into cubes (see wbfunctions.run_tam)
+def cube_writer(store, save_vars, periods, shape, chunking="space", profile=None, window=None, resume=False):
+    """
+    Creates the cubes of "save_vars" and returns on_month(year, month, wb).
+    With "time" chunking, prefer building the cube from a space cube (see rechunk_cube), since each month
+    write touches all the chunks of a time block.
+    With "resume", existing cubes are kept (and extended to "periods" if they are shorter), for resumed runs.
+    """
+    cubes = {}
+    for var in save_vars:
+        if resume and os.path.exists(cube_store_path(store, var)):
+            cubes[var] = extend_cube(store, var, periods)
+        else:
+            cubes[var] = create_cube(store, var, periods, shape, chunking, profile)
+    index = {period: i for i, period in enumerate(periods)}
+
+    def on_month(year, month, wb):
+        i = index[(year, month)]
+        for var in save_vars:
+            if window is None:
+                cubes[var][i] = wb[var]
+            else:
+                r0, c0, h, w = window
+                cubes[var][i, r0:r0 + h, c0:c0 + w] = wb[var]
+
+    return on_month
+
+
+# Function to copy a cube into another store with a different chunking (e.g., "space" -> "time")
+def rechunk_cube(store, var, out_store, chunking="time", max_memory_mb=2048):
+
+    src = open_cube(store, var)
+    periods = cube_periods(src)
+    profile = None
+    if "transform" in src.attrs:
+        from affine import Affine
+        profile = {"transform": Affine(*src.attrs["transform"]), "crs": src.attrs["crs"]}
+
+    dst = create_cube(out_store, var, periods, src.shape[1:], chunking, profile)
+
+    # Blocks of full time series, as many rows as fit in memory (multiple of the destination chunks)
+    row_chunk = dst.chunks[1]
+    rows = max(row_chunk, int(max_memory_mb * 1024 * 1024 // (4 * src.shape[0] * src.shape[2])) // row_chunk * row_chunk)
+    for r in range(0, src.shape[1], rows):
+        dst[:, r:r + rows] = src[:, r:r + rows]
+
+    return dst
+
+
+# Function to calculate the zonal statistics of all the stations and months straight from a cube
+def cube_zonal_statistics(store, var, index, serial_id="grdcno_int", max_memory_mb=512):
+    """
+    Returns the long-format table [serial_id, YEAR, MONTH, COUNT, MEAN] (see zonalfunctions.zonal_table).
+    Only the window of the station index is read, in blocks of whole chunks (the months of a time chunk and as many
+    rows as fit in "max_memory_mb"), and the sums of every block are added up, so memory does not grow with the
+    window or the number of months. Blocks without indexed pixels are not read.
+    """
+    from zonalfunctions import zonal_sums, zonal_table
+
+    cube = open_cube(store, var)
+    periods = cube_periods(cube)
+    r0, c0, h, w = index["window"]
+    n_sts = len(index["stations"])
+
+    # Indexed pixels are sorted, so the pixels of a block of rows are a slice of them
+    pixel_rows = np.asarray(index["pixels"]) // max(w, 1)
+    months = cube.chunks[0]
+    rows = max(cube.chunks[1], int(max_memory_mb * 1024 * 1024 // (4 * months * max(w, 1))) // cube.chunks[1] * cube.chunks[1])
+
+    count, total = np.zeros((n_sts, len(periods))), np.zeros((n_sts, len(periods)))
+    for t in range(0, len(periods), months):
+        for start in range(r0 // rows * rows, r0 + h, rows):
+            ra, rb = max(start, r0), min(start + rows, r0 + h)
+            a, b = np.searchsorted(pixel_rows, [ra - r0, rb - r0])
+            if a == b:
+                continue
+            block = cube[t:t + months, ra:rb, c0:c0 + w]
+            values = block.reshape(block.shape[0], -1)[:, index["pixels"][a:b] - (ra - r0) * w].T
+            block_count, block_total = zonal_sums(index, values, slice(a, b))
+            count[:, t:t + months] += block_count
+            total[:, t:t + months] += block_total
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+
+    return zonal_table(index, count.astype(np.int64), mean, periods, serial_id)
@@ -0,0 +1,225 @@
+# Ensemble mode of the T&M model and the baseflow: many parameter sets (members) in one pass over the inputs
+# Each member is a dictionary of the parameters that change between the output families (wyield/wyield2/...,
+# bflow/bflow2/...): WHC raster and scale, monthly k (raster or constant) and its multiplier, ffcb, the initial
+# baseflow, and optionally a daily k raster (daily-k baseflow of 6.2a instead of the monthly recursion of 6.2b).
+# ppt, pet and q are read once per month and broadcast over the members, whose state is a (members x pixels) array
+# (see wbfunctions.run_ensemble and pixelfunctions)
+
+import os
+import time
+import itertools
+import numpy as np
+
+from otherfunctions import folders_exist
+from rasterfunctions import raster_profile, read_raster, monthly_path, geotiff_reader, raster_writer
+from wbfunctions import month_periods, prepare_whc, run_ensemble, tc_vars
+from telemetryfunctions import stage_span, log_month
+import pixelfunctions as pf
+import zonalfunctions as zf
+
+# Parameters of a member and their default values (None: the whc_path, whc_scale and k of run_ensemble_pipeline)
+member_defaults = {"whc": None, "whc_scale": None, "k": None, "k_multiplier": 1.0, "ffcb": 0.1, "bflow_ant": 10,
+                   "daily_k": None}
+
+
+# Function to build the members of an ensemble as all the combinations of some parameter values
+def ensemble_members(**values):
+    """
+    ensemble_members(ffcb=[0.1, 0.5], k_multiplier=[0.9, 1.0, 1.1]) returns 6 members, named after their values
+    (e.g., "ffcb=0.1_k_multiplier=0.9"; rasters are named after their file names).
+
+    Args:
+        values: Lists of values of the parameters of member_defaults
+    """
+    unknown = set(values) - set(member_defaults)
+    if unknown:
+        raise ValueError(f"Unknown member parameters: {sorted(unknown)}")
+
+    def label(value):
+        return os.path.splitext(os.path.basename(value))[0] if isinstance(value, str) else str(value)
+
+    members = []
+    for combination in itertools.product(*values.values()):
+        member = dict(zip(values, combination))
+        member["name"] = "_".join(f"{key}={label(value)}" for key, value in member.items())
+        members.append(member)
+    return members
+
+
+# Function to read the rasters of the members once (the same path is shared by many members)
+def member_rasters(members, whc_path, k, whc_scale=1000):
+    """
+    Returns (members, grids): the members completed with the defaults and names, and {(path, scale): grid}
+    """
+    members = [{**member_defaults, "name": f"member_{i:02d}", **member} for i, member in enumerate(members)]
+    grids = {}
+    for member in members:
+        for key, default in [("whc", whc_path), ("whc_scale", whc_scale), ("k", k)]:
+            if member[key] is None:
+                member[key] = default
+        for key, scale in [("whc", member["whc_scale"]), ("k", None), ("daily_k", None)]:
+            if isinstance(member[key], str) and (member[key], scale) not in grids:
+                grid = read_raster(member[key])
+                grids[(member[key], scale)] = prepare_whc(grid, scale) if key == "whc" else grid
+    return members, grids
+
+
+# Function to stack the parameters of some members as (members x pixels) arrays
+def member_arrays(members, grids, pixel_index=None):
+    """
+    Returns a dictionary with whc and k (members x pixels, or members x rows x columns without pixel index),
+    ffcb and bflow_ant (members x 1), and daily_members, daily_k and daily_bflow_ant for the daily-k members
+    """
+    def values(member, key, scale=None):
+        value = member[key]
+        value = grids[(value, scale)] if isinstance(value, str) else np.float32(value)
+        return value if pixel_index is None else pf.to_vector(pixel_index, value)
+
+    whc = np.stack([values(m, "whc", m["whc_scale"]) for m in members])
+    k = np.empty_like(whc)
+    for i, m in enumerate(members):
+        k[i] = np.clip(values(m, "k") * np.float32(m["k_multiplier"]), 0, 1)
+
+    column = (len(members),) + (1,) * (whc.ndim - 1)
+    arrays = {"whc": whc, "k": k,
+              "ffcb": np.array([m["ffcb"] for m in members], dtype=np.float32).reshape(column),
+              "bflow_ant": np.array([m["bflow_ant"] for m in members], dtype=np.float32).reshape(column),
+              "daily_members": np.array([i for i, m in enumerate(members) if m["daily_k"] is not None], dtype=np.int64)}
+
+    if arrays["daily_members"].size:
+        daily = [members[i] for i in arrays["daily_members"]]
+        arrays["daily_k"] = np.stack([np.broadcast_to(values(m, "daily_k"), whc.shape[1:]) for m in daily])
+        arrays["daily_bflow_ant"] = arrays["bflow_ant"][arrays["daily_members"]]
+    else:
+        arrays["daily_k"] = arrays["daily_bflow_ant"] = None
+    return arrays
+
+
+# Function to run an ensemble of the monthly chain (6.1 -> 6.2a/6.2b -> 6.3) in one pass over the inputs
+def run_ensemble_pipeline(tc_folder, whc_path, k, out_dir, members, start_date="1958-01", end_date="2023-12",
+                          save_vars=(), station_index=None, station_vars=("wyield",), serial_id="grdcno_int",
+                          whc_scale=1000, clamp=True, valid_pixels=True, members_per_pass=None, output_options=None,
+                          async_writes=0):
+    """
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs ({var}_{year}_{month}.tif), or a reader(var, year, month, out)
+        whc_path: Water holding capacity raster (default WHC of the members, and reference grid of the outputs)
+        k: Monthly recession constant raster path, or a constant (default k of the members)
+        out_dir: Output folder. The outputs of each member go to {out_dir}/{name}/{var}/{var}_{year}_{month}.tif
+        members: List of dictionaries with the parameters that differ from member_defaults and an optional "name"
+                 (see ensemble_members)
+        start_date, end_date: First and last month "YYYY-MM"
+        save_vars: Variables saved as GeoTIFFs for every member (see wbfunctions.tam_vars)
+        station_index: Optional station index (see zonalfunctions.build_station_index) or the path where it was saved.
+                       If given, the catchment COUNT/MEAN of "station_vars" are accumulated for every member
+        station_vars: Variables aggregated per station ("bflow_ant" is the baseflow of the previous month)
+        serial_id: Name of the station ID column
+        whc_scale: Default WHC scale of the members
+        clamp: See wbfunctions.tam_step
+        valid_pixels: If True, members run on vectors of the valid pixels (see pixelfunctions). Without "save_vars",
+                      only the valid pixels of the catchments of "station_index" are simulated. Results are then those
+                      of run_pipeline with valid_pixels=True and the WHC of each member: the pixels are those where any
+                      member has WHC, and the outputs of a member are NaN where its own WHC is NaN (eprec, aet and perc
+                      can differ from the grid mode at the pixels left out); with False, those of the grid mode
+        members_per_pass: Maximum number of members of each pass over the inputs (memory: about 13 float32 arrays
+                          per member of the size of the pixels). Default: all the members in a single pass
+        output_options, async_writes: See pipelinefunctions.run_pipeline
+
+    Returns {name: {var: DataFrame [serial_id, YEAR, MONTH, COUNT, MEAN]}} if "station_index" is given, else None
+    """
+    periods = month_periods(start_date, end_date)
+    profile = raster_profile(whc_path)
+    shape = (profile["height"], profile["width"])
+    reader = tc_folder if callable(tc_folder) else geotiff_reader(tc_folder)
+    members, grids = member_rasters(members, whc_path, k, whc_scale)
+
+    if station_index is not None and isinstance(station_index, str):
+        station_index = zf.load_station_index(station_index)
+
+    pixel_index = None
+    if valid_pixels:
+        # Pixels with data for at least one member
+        whcs = [grid for key, grid in grids.items() if key[1] is not None]
+        pixel_index = pf.pixel_index_from_inputs(np.fmax.reduce(whcs), reader, periods[0])
+        if station_index is not None and not save_vars:
+            inside = np.isin(pixel_index["pixels"], zf.grid_pixels(station_index, shape))
+            pixel_index = dict(pixel_index, pixels=pixel_index["pixels"][inside])
+            print(f"Pixels within the catchments: {pixel_index['pixels'].size}")
+        reader = pf.vector_reader(reader, pixel_index)
+        if station_index is not None:
+            station_index = pf.vector_station_index(station_index, pixel_index)
+
+    n_pixels = pixel_index["pixels"].size if pixel_index is not None else shape[0] * shape[1]
+    members_per_pass = members_per_pass or len(members)
+    batches = [members[i:i + members_per_pass] for i in range(0, len(members), members_per_pass)]
+
+    print('\n############################################################')
+    print('\t\tINITIAL VARIABLES')
+    print('\tPeriod to be executed: ' + start_date + ' to ' + end_date + ' (' + str(len(periods)) + ' months)')
+    print('\tMembers: ' + str(len(members)) + ' in ' + str(len(batches)) + ' passes over the inputs')
+    print(f'\tBuffers: {13 * 4 * n_pixels * min(members_per_pass, len(members)) / 1024 ** 2:.0f} MB for {n_pixels} pixels')
+    print('############################################################')
+
+    out_dirs = {(m["name"], var): os.path.join(out_dir, m["name"], var) for m in members for var in save_vars}
+    folders_exist(list(out_dirs.values()))
+    writer = raster_writer(async_writes)
+    grid_buffers = {var: np.full(shape, np.nan, dtype=np.float32) for var in save_vars}
+
+    tables = {}
+    if station_index is not None:
+        flat = zf.grid_pixels(station_index, (1, n_pixels) if pixel_index is not None else shape)
+        n_sts = len(station_index["stations"])
+        month_index = {period: i for i, period in enumerate(periods)}
+
+    # Outputs that are NaN where the WHC of their member is NaN (the vectors hold the pixels of all the members)
+    masked_vars = [var for var in dict.fromkeys(tuple(save_vars) + tuple(station_vars if station_index is not None else ()))
+                   if var not in tc_vars]
+
+    for batch in batches:
+        arrays = member_arrays(batch, grids, pixel_index)
+        own_nodata = np.isnan(arrays["whc"]) if pixel_index is not None else None
+        if own_nodata is not None and not own_nodata.any():
+            own_nodata = None
+        if station_index is not None:
+            counts = {var: np.zeros((len(batch), n_sts, len(periods)), dtype=np.int64) for var in station_vars}
+            means = {var: np.full((len(batch), n_sts, len(periods)), np.nan) for var in station_vars}
+
+        last = {"time": time.perf_counter()}
+
+        def on_month(year, month, wb):
+            print("\t*Ensemble water balance for " + str(year) + "-" + str(month) + "*")
+            if own_nodata is not None:
+                for var in masked_vars:
+                    np.copyto(wb[var], np.nan, where=own_nodata)
+            for var in save_vars:
+                for i, member in enumerate(batch):
+                    values = wb[var][i] if pixel_index is None else pf.to_grid(pixel_index, wb[var][i], grid_buffers[var])
+                    writer.write(monthly_path(out_dirs[(member["name"], var)], var, year, month), values, profile,
+                                 options=output_options)
+
+            if station_index is not None:
+                j = month_index[(year, month)]
+                for var in station_vars:
+                    # One sparse product for all the members: (pixels x members) values
+                    count, mean = zf.zonal_statistics(station_index, wb[var].reshape(len(batch), -1)[:, flat].T)
+                    counts[var][:, :, j], means[var][:, :, j] = count.T, mean.T
+
+            now = time.perf_counter()
+            log_month("ensemble", year, month, now - last["time"], members=len(batch))
+            last["time"] = now
+
+        with stage_span("ensemble", items=len(periods) * n_pixels * len(batch), unit="pixel-months", members=len(batch)):
+            try:
+                run_ensemble(reader, arrays["whc"], arrays["k"], periods, arrays["ffcb"], arrays["bflow_ant"], on_month,
+                             clamp, arrays["daily_k"], arrays["daily_members"], arrays["daily_bflow_ant"])
+            finally:
+                writer.flush()
+
+        if station_index is not None:
+            for i, member in enumerate(batch):
+                tables[member["name"]] = {var: zf.zonal_table(station_index, counts[var][i], means[var][i], periods, serial_id)
+                                          for var in station_vars}
+
+    writer.close()
+    print("\nDONE!!")
+    return tables if station_index is not None else None
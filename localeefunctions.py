@@ -0,0 +1,337 @@
+# Local (NumPy) backend of the subset of the Earth Engine API used by otherfunctions.water_balance
+# local_ee.Image and local_ee.List mimic ee.Image and ee.List on in-memory arrays, so the GEE function of
+# 2.water_balance_GEE runs unchanged on local TerraClimate grids (water_balance(image, image_list, local_ee, whc, k)).
+# Bands are (y, x) arrays (or 0-d arrays for constant images) with a validity mask, and the image list keeps only
+# its last images instead of every month of the collection (the results are handed to a callback as they are added)
+
+import calendar
+import numpy as np
+from types import SimpleNamespace
+
+from wbfunctions import tc_vars, tam_vars, run_tam
+
+
+# Function to turn a value into (data, mask) of one band (NaN is NoData, like a masked pixel in GEE)
+def band_data(value):
+
+    data = np.asarray(value)
+    if data.dtype == bool:
+        return data, None
+    if data.dtype.kind in "iuf" and data.ndim == 0:
+        data = data.astype(np.float32) # Constant images (e.g., ee.Image(0)) do not change the type of the grids
+    mask = ~np.isnan(data) if data.dtype.kind == "f" and data.ndim > 0 else None
+    return data, (None if mask is None or mask.all() else mask)
+
+
+# Function to combine two masks (None means all the pixels are valid)
+def and_masks(a, b):
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a & b
+
+
+# Function to use comparison results in arithmetic (GEE returns 0/1 integer images)
+def numeric(data):
+    return data.astype(np.int16) if data.dtype == bool else data
+
+
+class Image:
+    """
+    NumPy version of ee.Image: a list of bands [name, data, mask] and a dictionary of properties.
+
+    Image(value) accepts an Image (returned as it is), a number (constant image with band "constant"), an array
+    (band "b1") or a list of them (bands concatenated, as ee.Image([...]))
+    """
+
+    def __new__(cls, value=0, bands=None, properties=None):
+
+        if isinstance(value, Image) and bands is None:
+            return value
+
+        self = super().__new__(cls)
+        if bands is not None:
+            self.bands = bands
+        elif isinstance(value, (list, tuple)):
+            self.bands = [band for image in value for band in Image(image).bands]
+        else:
+            data, mask = band_data(value)
+            self.bands = [["constant" if data.ndim == 0 else "b1", data, mask]]
+        self.properties = dict(properties or {})
+        return self
+
+    def copy(self, bands=None, keep_properties=True):
+        return Image(bands=bands if bands is not None else [list(band) for band in self.bands],
+                     properties=self.properties if keep_properties else None)
+
+    def bandNames(self):
+        return [band[0] for band in self.bands]
+
+    def get(self, name):
+        return self.properties.get(name)
+
+    def set(self, name, value):
+        image = self.copy()
+        image.properties[name] = value
+        return image
+
+    def select(self, selectors, names=None):
+        selectors = selectors if isinstance(selectors, (list, tuple)) else [selectors]
+        by_name = {band[0]: band for band in self.bands}
+        bands = [list(self.bands[s] if isinstance(s, int) else by_name[s]) for s in selectors]
+        if names is not None:
+            for band, name in zip(bands, names):
+                band[0] = name
+        return self.copy(bands)
+
+    def rename(self, *names):
+        names = names[0] if len(names) == 1 and isinstance(names[0], (list, tuple)) else names
+        return self.copy([[name, data, mask] for name, (_, data, mask) in zip(names, self.bands)])
+
+    def float(self):
+        return self.copy([[name, numeric(data).astype(np.float32), mask] for name, data, mask in self.bands])
+
+    def addBands(self, image):
+        return self.copy(self.bands + [list(band) for band in Image(image).bands])
+
+    # Band-wise operation with another image or a number (bands paired as in GEE; the longer image names the output)
+    def binary(self, other, op):
+        if isinstance(other, (int, float)):
+            return self.copy([[name, op(numeric(data), other), mask] for name, data, mask in self.bands], False)
+
+        other = Image(other)
+        a, b = self.bands, other.bands
+        if len(a) == 1 and len(b) > 1:
+            a, names = a * len(b), [band[0] for band in b]
+        else:
+            b, names = (b * len(a) if len(b) == 1 else b), [band[0] for band in a]
+        if len(a) != len(b):
+            raise ValueError(f"Images with {len(a)} and {len(b)} bands cannot be combined")
+
+        return Image(bands=[[name, op(numeric(da), numeric(db)), and_masks(ma, mb)]
+                            for name, (_, da, ma), (_, db, mb) in zip(names, a, b)])
+
+    def add(self, other):
+        return self.binary(other, np.add)
+
+    def subtract(self, other):
+        return self.binary(other, np.subtract)
+
+    def multiply(self, other):
+        return self.binary(other, np.multiply)
+
+    def divide(self, other):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.binary(other, np.divide)
+
+    def max(self, other):
+        return self.binary(other, np.maximum)
+
+    def min(self, other):
+        return self.binary(other, np.minimum)
+
+    def gt(self, other):
+        return self.binary(other, np.greater)
+
+    def gte(self, other):
+        return self.binary(other, np.greater_equal)
+
+    def lt(self, other):
+        return self.binary(other, np.less)
+
+    def lte(self, other):
+        return self.binary(other, np.less_equal)
+
+    def eq(self, other):
+        return self.binary(other, np.equal)
+
+    def neq(self, other):
+        return self.binary(other, np.not_equal)
+
+    def And(self, other):
+        return self.binary(other, lambda a, b: (a != 0) & (b != 0))
+
+    def Or(self, other):
+        return self.binary(other, lambda a, b: (a != 0) | (b != 0))
+
+    def Not(self):
+        return self.copy([[name, data == 0, mask] for name, data, mask in self.bands], False)
+
+    def abs(self):
+        return self.copy([[name, np.abs(numeric(data)), mask] for name, data, mask in self.bands], False)
+
+    def exp(self):
+        return self.copy([[name, np.exp(numeric(data)), mask] for name, data, mask in self.bands], False)
+
+    # Replace the pixels where "test" is nonzero with "value" (masked test or value pixels keep the input)
+    def where(self, test, value):
+        test, value = Image(test), Image(value)
+        bands = []
+        for i, (name, data, mask) in enumerate(self.bands):
+            _, td, tm = test.bands[i if len(test.bands) > 1 else 0]
+            _, vd, vm = value.bands[i if len(value.bands) > 1 else 0]
+            replace = and_masks(and_masks(td != 0, tm), vm)
+            bands.append([name, np.where(replace, vd, data).astype(np.result_type(data, vd)),
+                          None if mask is None else mask | replace])
+        return self.copy(bands)
+
+    # Mask the pixels where "mask" is zero or masked
+    def updateMask(self, mask):
+        _, md, mm = Image(mask).bands[0]
+        valid = and_masks(md != 0, mm)
+        return self.copy([[name, data, and_masks(m, valid)] for name, data, m in self.bands])
+
+
+class List:
+    """
+    NumPy version of ee.List for the accumulation of ImageCollection.iterate.
+
+    List(items, keep=None, sink=None): "keep" limits the number of items kept (e.g., 1 keeps only the last image,
+    which is the only one water_balance reads), and sink(item) receives every item added. List(a List) returns it
+    """
+
+    def __new__(cls, items=(), keep=None, sink=None):
+
+        if isinstance(items, List):
+            return items
+
+        self = super().__new__(cls)
+        self.items = list(items)[-keep:] if keep else list(items)
+        self.keep = keep
+        self.sink = sink
+        return self
+
+    def get(self, i):
+        return self.items[i]
+
+    def size(self):
+        return len(self.items)
+
+    def add(self, item):
+        if self.sink is not None:
+            self.sink(item)
+        return List(self.items + [item], self.keep, self.sink)
+
+    def remove(self, item):
+        return List([x for x in self.items if x is not item], self.keep, self.sink)
+
+
+# Module passed as "ee" to otherfunctions.water_balance
+local_ee = SimpleNamespace(Image=Image, List=List)
+
+
+# Function to get the bands of an image as (y, x) float arrays, with NaN in the masked pixels
+def image_arrays(image, shape, bands=None):
+
+    arrays = {}
+    for name, data, mask in image.bands:
+        if bands is None or name in bands:
+            values = np.broadcast_to(numeric(data), shape).astype(np.float32)
+            arrays[name] = values if mask is None else np.where(np.broadcast_to(mask, shape), values, np.nan)
+    return arrays
+
+
+# Function to get the system:time_start (ms) of the first day of a month
+def time_start(year, month):
+    return calendar.timegm((year, month, 1, 0, 0, 0)) * 1000
+
+
+# Function to run the GEE water balance (otherfunctions.water_balance) on local grids
+def run_local_water_balance(reader, whc, k, periods, ffcb=0.1, bflow_ant=10, on_month=None, keep=1, pet_scale=0.1,
+                            water_balance=None):
+    """
+    Build the initial image and iterate over the months as 2.water_balance_GEE does with ImageCollection.iterate.
+
+    Args:
+        reader: Function reader(var, year, month, out) that fills "out" with ppt, pet or q in mm
+                (e.g., rasterfunctions.geotiff_reader)
+        whc: Water holding capacity (mm), already prepared with prepare_whc
+        k: Monthly recession constant (scalar or array)
+        periods: List of (year, month)
+        ffcb: Initial soil water storage expressed as a fraction of WHC [0-1]
+        bflow_ant: Base flow of the previous month (mm)
+        on_month: Optional function on_month(year, month, image) called with the image of each month
+        keep: Number of images kept in the list (None keeps all of them, as in GEE)
+        pet_scale: Scale factor of the PET of TerraClimate in GEE (water_balance multiplies "pet" by 0.1)
+        water_balance: Function to iterate (default: otherfunctions.water_balance)
+
+    Returns the image list after the last month
+    """
+    if water_balance is None:
+        from otherfunctions import water_balance
+
+    whc = np.asarray(whc, dtype=np.float32)
+    whc_im = Image(whc)
+    k_im = Image(k)
+
+    # Initial image, as in 2.water_balance_GEE
+    time0 = time_start(*periods[0])
+    initial_image = Image(0).set("system:time_start", time0).select([0], ["wyield"]).float()
+    for name, value in [("pr", 0), ("pet", 0), ("ro", 0), ("eprec", 0), ("aet", 0), ("sstor", whc * np.float32(ffcb)),
+                        ("perc", 0), ("bflow", bflow_ant)]:
+        initial_image = initial_image.addBands(Image(value).select([0], [name]).float())
+    initial_image = initial_image.set("system:time_start", time0)
+
+    date = {}
+
+    def sink(image):
+        if on_month is not None:
+            on_month(*date["period"], image)
+
+    image_list = List([initial_image], keep, sink)
+    buffer = np.empty(whc.shape, dtype=np.float32)
+    for year, month in periods:
+        bands = []
+        for var, name in zip(tc_vars, ["pr", "pet", "ro"]):
+            reader(var, year, month, buffer)
+            values = buffer / np.float32(pet_scale) if var == "pet" else buffer.copy()
+            bands.append(Image(values).select([0], [name]))
+        image = Image(bands).set("system:time_start", time_start(year, month))
+
+        date["period"] = (year, month)
+        image_list = water_balance(image, image_list, local_ee, whc_im, k_im)
+
+    return image_list
+
+
+# Function to compare the GEE water balance on local grids against run_tam (clamp=False) over synthetic months
+def check_local_water_balance(shape=(60, 120), n_months=120, seed=0):
+    """
+    Returns the maximum absolute difference per variable between otherfunctions.water_balance run with local_ee
+    and wbfunctions.run_tam with the same zone logic (clamp=False).
+    """
+    rng = np.random.default_rng(seed)
+    whc = rng.uniform(0, 400, shape).astype(np.float32)
+    whc[whc < 1] = 1 / 1000000
+    k = rng.uniform(0.2, 0.99, shape).astype(np.float32)
+
+    inputs = {}
+    periods = [(2000 + i // 12, i % 12 + 1) for i in range(n_months)]
+    for i, period in enumerate(periods):
+        season = np.float32(1 + 0.8 * np.sin(2 * np.pi * i / 12))
+        ppt = (rng.gamma(1.2, 60, shape) * season).astype(np.float32)
+        inputs[("ppt",) + period] = ppt
+        inputs[("pet",) + period] = (rng.uniform(0, 180, shape) * (2 - season)).astype(np.float32)
+        inputs[("q",) + period] = (ppt * rng.uniform(0, 0.5, shape)).astype(np.float32)
+
+    def reader(var, year, month, out):
+        out[...] = inputs[(var, year, month)]
+        return out
+
+    local = {}
+
+    def on_image(year, month, image):
+        local[(year, month)] = image_arrays(image, shape, tam_vars)
+
+    run_local_water_balance(reader, whc, k, periods, on_month=on_image)
+
+    max_diff = dict.fromkeys(tam_vars, 0.0)
+
+    def on_month(year, month, wb):
+        for var in tam_vars:
+            max_diff[var] = max(max_diff[var], float(np.nanmax(np.abs(wb[var] - local[(year, month)][var]))))
+
+    run_tam(reader, whc, k, periods, on_month=on_month, clamp=False)
+    return max_diff
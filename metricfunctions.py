@@ -0,0 +1,150 @@
+# Metrics of hydrologic skill of all the stations at once (7.2a/7.2b)
+# Same definitions as HydroErr (mae, rmse, pearson_r, d1, nse, kge_2012) and the pbias of the notebooks, computed
+# over the aligned (months x stations) observed and simulated arrays with a validity mask instead of a per-station dropna
+
+import numpy as np
+import pandas as pd
+
+# Metrics (columns of runoff_monthly_stats_based-on_monthly_k.csv)
+metric_names = ["MAE", "RMSE", "Pearson_R", "D1", "NSE", "KGE_2012", "PBIAS"]
+
+
+# Function to calculate all the metrics along one axis (time) of masked arrays
+def skill_metrics(obs, sim, mask=None, axis=0):
+    """
+    Vectorized metrics; pairs where "mask" is False (or obs/sim is NaN) are skipped, as the dropna of the notebooks.
+
+    Args:
+        obs, sim: Observed and simulated arrays (broadcastable), e.g., (months, stations) or (months, stations, variants)
+        mask: Optional boolean array of valid pairs
+        axis: Time axis
+
+    Returns a dictionary {metric: array} without the time axis. Metrics are NaN for stations without valid pairs
+    """
+    obs, sim = np.broadcast_arrays(np.asarray(obs, dtype=np.float64), np.asarray(sim, dtype=np.float64))
+    valid = ~(np.isnan(obs) | np.isnan(sim))
+    if mask is not None:
+        valid = valid & mask
+    obs, sim = np.where(valid, obs, 0), np.where(valid, sim, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = valid.sum(axis=axis, keepdims=True).astype(np.float64)
+        n = np.where(n > 0, n, np.nan)
+        mean_obs = obs.sum(axis=axis, keepdims=True) / n
+        mean_sim = sim.sum(axis=axis, keepdims=True) / n
+
+        err = sim - obs
+        obs_dev = np.where(valid, obs - mean_obs, 0)
+        sim_dev = np.where(valid, sim - mean_sim, 0)
+
+        sum_abs_err = np.abs(err).sum(axis=axis, keepdims=True)
+        sum_sq_err = (err * err).sum(axis=axis, keepdims=True)
+        ss_obs = (obs_dev * obs_dev).sum(axis=axis, keepdims=True)
+        ss_sim = (sim_dev * sim_dev).sum(axis=axis, keepdims=True)
+        r = (obs_dev * sim_dev).sum(axis=axis, keepdims=True) / np.sqrt(ss_obs * ss_sim)
+
+        # d1: |sim - mean_obs| + |obs - mean_obs| in the denominator
+        d1_den = np.where(valid, np.abs(sim - mean_obs) + np.abs(obs_dev), 0).sum(axis=axis, keepdims=True)
+
+        # KGE (2012): r, bias ratio and variability ratio of the coefficients of variation (std with ddof=0)
+        beta = mean_sim / mean_obs
+        gamma = (np.sqrt(ss_sim / n) / mean_sim) / (np.sqrt(ss_obs / n) / mean_obs)
+
+        metrics = {
+            "MAE": sum_abs_err / n,
+            "RMSE": np.sqrt(sum_sq_err / n),
+            "Pearson_R": r,
+            "D1": 1 - sum_abs_err / d1_den,
+            "NSE": 1 - sum_sq_err / ss_obs,
+            "KGE_2012": 1 - np.sqrt((r - 1) ** 2 + (gamma - 1) ** 2 + (beta - 1) ** 2),
+            "PBIAS": err.sum(axis=axis, keepdims=True) / obs.sum(axis=axis, keepdims=True) * 100,
+        }
+
+    return {name: np.squeeze(np.where(np.isnan(n), np.nan, value), axis=axis) for name, value in metrics.items()}
+
+
+# Function to split a merged DataFrame ({station}_obs and {station}_sim columns) into aligned obs and sim DataFrames
+def split_merged(merged_df, stations=None):
+
+    if stations is None:
+        stations = [c[:-4] for c in merged_df.columns if c.endswith("_obs") and c[:-4] + "_sim" in merged_df.columns]
+    stations = [str(st) for st in stations if f"{st}_obs" in merged_df.columns and f"{st}_sim" in merged_df.columns]
+
+    obs = merged_df[[f"{st}_obs" for st in stations]].set_axis(stations, axis=1)
+    sim = merged_df[[f"{st}_sim" for st in stations]].set_axis(stations, axis=1)
+    return obs, sim
+
+
+# Function to build the stats table (as runoff_monthly_stats_based-on_monthly_k.csv) of (months x stations) DataFrames
+def stats_table(obs_df, sim_df, mask=None):
+    """
+    Same table as calculate_stats of 7.2a/7.2b: one row per station (index "Station") and one column per metric.
+
+    Args:
+        obs_df, sim_df: DataFrames (months x stations) with the same index and columns (see split_merged)
+        mask: Optional boolean array (months x stations) of the pairs to use
+    """
+    metrics = skill_metrics(obs_df.to_numpy(), sim_df.to_numpy(), mask)
+    return pd.DataFrame(metrics, index=pd.Index(obs_df.columns, name="Station"))[metric_names]
+
+
+# Function to build the stats tables of groups of months (month of the year or periods)
+def stats_breakdown(obs_df, sim_df, by="month", periods=None):
+    """
+    Long table with one row per group and station: [by, Station, metrics...].
+
+    Args:
+        obs_df, sim_df: DataFrames (months x stations) indexed by "YYYY-MM"
+        by: "month" (month of the year, 1-12) or "period"
+        periods: Dictionary {name: (start, end)} of "YYYY-MM" limits (inclusive), used with by="period"
+    """
+    dates = pd.Index(obs_df.index.astype(str))
+    if by == "month":
+        groups = {month: np.asarray(dates.str[5:7].astype(int) == month) for month in range(1, 12 + 1)}
+    else:
+        groups = {name: np.asarray((dates >= start) & (dates <= end)) for name, (start, end) in periods.items()}
+
+    tables = []
+    for name, rows in groups.items():
+        df = stats_table(obs_df, sim_df, np.broadcast_to(rows[:, np.newaxis], obs_df.shape)).reset_index()
+        df.insert(0, by.upper(), name)
+        tables.append(df)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+# Function to calculate bootstrap confidence intervals of the metrics of every station
+def bootstrap_ci(obs_df, sim_df, n_boot=1000, ci=0.95, seed=42, batch_size=100):
+    """
+    Resample the valid (obs, sim) pairs of each station with replacement (n_boot times) and return, per station,
+    the {metric}_lower and {metric}_upper percentiles. Samples are processed in batches to bound memory.
+    """
+    obs, sim = obs_df.to_numpy(dtype=np.float64), sim_df.to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(obs) | np.isnan(sim))
+    n_valid = valid.sum(axis=0)
+    n_sts = obs.shape[1]
+
+    # Valid pairs of each station moved to the top rows (stable order)
+    order = np.argsort(~valid, axis=0, kind="stable")
+    obs_c = np.take_along_axis(obs, order, axis=0)
+    sim_c = np.take_along_axis(sim, order, axis=0)
+    length = max(1, n_valid.max())
+    rows = np.arange(length)[:, np.newaxis]
+
+    rng = np.random.default_rng(seed)
+    samples = {name: np.empty((n_boot, n_sts)) for name in metric_names}
+    for b0 in range(0, n_boot, batch_size):
+        nb = min(batch_size, n_boot - b0)
+        idx = (rng.random((nb, length, n_sts)) * n_valid).astype(np.int64)
+        cols = np.arange(n_sts)
+        metrics = skill_metrics(obs_c[idx, cols], sim_c[idx, cols], rows < n_valid, axis=1)
+        for name in metric_names:
+            samples[name][b0:b0 + nb] = metrics[name]
+
+    q = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+    table = {}
+    for name in metric_names:
+        lower, upper = np.nanpercentile(samples[name], q, axis=0) if n_boot else (np.nan, np.nan)
+        table[f"{name}_lower"], table[f"{name}_upper"] = lower, upper
+
+    return pd.DataFrame(table, index=pd.Index(obs_df.columns, name="Station"))
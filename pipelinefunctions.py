@@ -0,0 +1,450 @@
+# Drivers of the local (NumPy) T&M workflow
+# The global grid is split into spatial blocks (tiles). Each pixel only depends on its own previous sstor and bflow,
+# so every tile runs all the months on its own, with the state kept in memory, in a separate process
+
+import os
+import time
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import Pool
+
+from otherfunctions import folders_exist
+from rasterfunctions import raster_profile, read_raster, monthly_path, geotiff_reader, raster_writer
+from wbfunctions import tc_vars, tam_vars, month_periods, prepare_whc, allocate_buffers, run_tam, run_daily_k, spin_up
+from checkpointfunctions import open_manifest, resume_point, checkpointer, config_value
+from telemetryfunctions import stage_span, log_month
+import zonalfunctions as zf
+
+# Bytes per pixel used by one tile: buffers of wbfunctions.allocate_buffers (14 float32 + 2 bool) plus whc, k and 1 - k
+tile_bytes_per_pixel = 4 * (len(tc_vars) + len(tam_vars) + 5 + 3) + 2
+
+
+# Function to split a grid into blocks whose buffers fit in "max_memory_mb"
+def tile_windows(shape, max_memory_mb=1024, bytes_per_pixel=tile_bytes_per_pixel):
+    """
+    Returns a list of windows (row_off, col_off, height, width) covering the grid.
+    Blocks are full-width row strips (cheap to read from GeoTIFF) unless a single row does not fit.
+    """
+    ny, nx = shape
+    max_pixels = max(1, int(max_memory_mb * 1024 * 1024 // bytes_per_pixel))
+
+    width = min(nx, max_pixels)
+    height = max(1, min(ny, max_pixels // width))
+
+    return [(r, c, min(height, ny - r), min(width, nx - c))
+            for r in range(0, ny, height) for c in range(0, nx, width)]
+
+
+# Function to read WHC and k for a window. k can be a raster path or a constant
+def read_parameters(whc_path, k, window=None, whc_scale=1000):
+
+    whc = prepare_whc(read_raster(whc_path, window=window), whc_scale)
+    if isinstance(k, str):
+        k = read_raster(k, window=window)
+    return whc, np.asarray(k, dtype=np.float32)
+
+
+# Function to create the output cubes (months, y, x) of the variables to be saved
+def create_output_cubes(out_dir, save_vars, n_months, shape):
+
+    folders_exist([os.path.join(out_dir, var) for var in save_vars])
+    for var in save_vars:
+        cube = np.lib.format.open_memmap(cube_path(out_dir, var), mode="w+", dtype=np.float32, shape=(n_months,) + tuple(shape))
+        del cube
+
+
+# Function to build the path of the output cube of a variable
+def cube_path(out_dir, var):
+    return os.path.join(out_dir, var, var + "_cube.npy")
+
+
+def worker_run_tile(args):
+    """
+    Worker function to run the water balance over all the months for a single tile.
+    The state (sstor, bflow) stays in memory; the outputs are written into the block of the output cubes.
+
+    Args:
+        args: Tuple containing (tile_id, window, tc_folder, whc_path, k, periods, out_dir, save_vars, ffcb, bflow_ant, clamp, whc_scale)
+    """
+    tile_id, window, tc_folder, whc_path, k, periods, out_dir, save_vars, ffcb, bflow_ant, clamp, whc_scale = args
+    start = time.time()
+    r0, c0, h, w = window
+
+    whc, k = read_parameters(whc_path, k, window, whc_scale)
+    cubes = {var: np.load(cube_path(out_dir, var), mmap_mode="r+") for var in save_vars}
+    index = {period: i for i, period in enumerate(periods)}
+
+    def on_month(year, month, wb):
+        i = index[(year, month)]
+        for var in save_vars:
+            cubes[var][i, r0:r0 + h, c0:c0 + w] = wb[var]
+
+    with stage_span("tam_tiled", "task", task=tile_id, items=len(periods) * h * w, unit="pixel-months"):
+        run_tam(geotiff_reader(tc_folder, window), whc, k, periods, ffcb, bflow_ant, on_month, clamp)
+
+        for cube in cubes.values():
+            cube.flush()
+
+    return tile_id, time.time() - start
+
+
+# Function to run the T&M model tile by tile in a process pool
+def run_tiled(tc_folder, whc_path, k, out_dir, start_date="1958-01", end_date="2023-12", save_vars=("wyield",),
+              max_memory_mb=1024, processes=None, ffcb=0.1, bflow_ant=10, clamp=True, whc_scale=1000):
+    """
+    Run the water balance for the whole grid split into tiles, one tile per task of a process pool.
+    Results are bit-identical whatever the number of tiles, because every pixel is computed with the same operations.
+
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs ({var}_{year}_{month}.tif)
+        whc_path: Water holding capacity raster (multiplied by "whc_scale")
+        k: Recession constant raster path, or a constant
+        out_dir: Folder where one cube per variable is saved ({out_dir}/{var}/{var}_cube.npy)
+        start_date, end_date: First and last month "YYYY-MM"
+        save_vars: Variables to save (see wbfunctions.tam_vars)
+        max_memory_mb: Memory limit of the buffers of each worker
+        processes: Number of processes (default: number of CPUs - 1). With 1, tiles run in this process
+        ffcb, bflow_ant, clamp: See wbfunctions.run_tam
+    """
+    periods = month_periods(start_date, end_date)
+    profile = raster_profile(whc_path)
+    shape = (profile["height"], profile["width"])
+    windows = tile_windows(shape, max_memory_mb)
+
+    if processes is None:
+        processes = max(1, mp.cpu_count() - 1)
+    processes = min(processes, len(windows))
+
+    print('\n############################################################')
+    print('\t\tINITIAL VARIABLES')
+    print('\tPeriod to be executed: ' + start_date + ' to ' + end_date + ' (' + str(len(periods)) + ' months)')
+    print('\tGrid: ' + str(shape[0]) + ' x ' + str(shape[1]) + ' in ' + str(len(windows)) + ' tiles')
+    print('\tProcesses: ' + str(processes))
+    print('############################################################')
+
+    create_output_cubes(out_dir, save_vars, len(periods), shape)
+
+    worker_args = [(i, window, tc_folder, whc_path, k, periods, out_dir, list(save_vars), ffcb, bflow_ant, clamp, whc_scale)
+                   for i, window in enumerate(windows)]
+
+    with stage_span("tam_tiled", tiles=len(windows), processes=processes):
+        if processes == 1:
+            results = map(worker_run_tile, worker_args)
+            for tile_id, seconds in results:
+                print(f"\tTile {tile_id + 1} of {len(windows)} completed in {seconds:.1f} s")
+        else:
+            with Pool(processes=processes) as pool:
+                for tile_id, seconds in pool.imap_unordered(worker_run_tile, worker_args):
+                    print(f"\tTile {tile_id + 1} of {len(windows)} completed in {seconds:.1f} s")
+
+    print("\nDONE!!")
+    return periods
+
+
+# Function to save the months of an output cube as GeoTIFFs ({var}_{year}_{month}.tif) for the downstream notebooks
+def export_geotiffs(out_dir, var, periods, profile, years=None, output_options=None, async_writes=0):
+
+    writer = raster_writer(async_writes)
+    cube = np.load(cube_path(out_dir, var), mmap_mode="r")
+    try:
+        for i, (year, month) in enumerate(periods):
+            if years is None or year in years:
+                writer.write(monthly_path(os.path.join(out_dir, var), var, year, month), cube[i], profile,
+                             options=output_options)
+    finally:
+        writer.close()
+
+
+# Function to run the fast daily-k baseflow (6.2a) from the percolation rasters of the T&M model
+def run_daily_k_baseflow(perc_dir, k_path, bflow_dir, start_date="1958-01", end_date="2023-12", bflow_ant=10, save_state=True,
+                         checkpoint_dir=None, checkpoint_every=12, output_options=None, async_writes=0):
+    """
+    Same outputs as process_dates of 6.2a.baseflow_calculation_daily-to-monthly, computing each month in a
+    single step (see wbfunctions.daily_k_step) instead of one raster operation per day.
+
+    Args:
+        perc_dir: Folder with perc_{year}_{month}.tif
+        k_path: Daily recession constant raster (e.g., daily_k_recession_all.tif)
+        bflow_dir: Output folder of bflow_{year}_{month}.tif
+        start_date, end_date: First and last month "YYYY-MM"
+        bflow_ant: Daily baseflow before the first day (mm). A constant, or the path of a saved
+                   temp\\bflow_ant_YYYY-MM-DD.tif to resume a previous run
+        save_state: If True, the end-of-month daily baseflow is saved as temp\\bflow_ant_YYYY-MM-DD.tif (resume state)
+        checkpoint_dir: Optional folder of the run manifest (see checkpointfunctions). If given, the daily baseflow is
+                        saved every "checkpoint_every" months, and a new call resumes (or extends to a later
+                        "end_date") from the last snapshot
+        checkpoint_every: Months between snapshots
+        output_options: Optional options of the bflow rasters (compressed COG, optionally int16, see
+                        rasterfunctions.output_options). The resume state is always saved as float32
+        async_writes: Maximum number of rasters waiting to be written by a background thread while the next months
+                      are computed (0 writes them synchronously, see rasterfunctions.raster_writer)
+    """
+    import calendar
+
+    temp_dir = os.path.join(bflow_dir, "temp")
+    folders_exist([bflow_dir, temp_dir])
+
+    profile = raster_profile(k_path)
+    k = read_raster(k_path)
+    periods = month_periods(start_date, end_date)
+    writer = raster_writer(async_writes)
+
+    if checkpoint_dir is not None:
+        config = {"perc_dir": perc_dir, "k_path": k_path, "start_date": start_date, "bflow_ant": config_value(bflow_ant)}
+        manifest = open_manifest(checkpoint_dir, "daily_k", config)
+        manifest["end_date"] = end_date
+        periods, state = resume_point(checkpoint_dir, manifest, start_date, end_date)
+        if state is not None:
+            bflow_ant = state["bflow_ant"]
+            print("Resuming after " + manifest["last_completed"] + " (" + str(len(periods)) + " months to run)")
+        checkpoint = checkpointer(checkpoint_dir, manifest, periods, checkpoint_every, before_save=writer.flush)
+
+    if isinstance(bflow_ant, str):
+        bflow_ant = read_raster(bflow_ant)
+
+    def reader(year, month, out):
+        return read_raster(monthly_path(perc_dir, "perc", year, month), out=out)
+
+    last = {"time": time.perf_counter()}
+
+    def on_month(year, month, bflow_month, state):
+        output_path = monthly_path(bflow_dir, "bflow", year, month)
+        writer.write(output_path, bflow_month, profile, options=output_options)
+        print("\tSaving bflow raster: " + output_path)
+
+        if save_state:
+            date_str = f"{year}-{month:02d}-{calendar.monthrange(year, month)[1]:02d}"
+            writer.write(os.path.join(temp_dir, f"bflow_ant_{date_str}.tif"), state, profile)
+
+        if checkpoint_dir is not None:
+            checkpoint(year, month, {"bflow_ant": state})
+
+        now = time.perf_counter()
+        log_month("baseflow_daily", year, month, now - last["time"])
+        last["time"] = now
+
+    with stage_span("baseflow_daily", items=len(periods) * k.size, unit="pixel-months"):
+        try:
+            run_daily_k(reader, k, periods, bflow_ant, on_month)
+        finally:
+            writer.close()
+
+    print("\nDONE!!")
+
+
+# Function to get the equilibrium state of a spin-up, cached by WHC, k, inputs and settings
+def spin_up_state(tc_folder, whc, k, periods, cache_dir=None, mode="climatology", tol=0.01, max_cycles=200,
+                  ffcb=0.1, bflow_ant=10, clamp=True, pixel_index=None):
+    """
+    Returns buffers with the equilibrium state (see wbfunctions.spin_up), loading it from
+    {cache_dir}/spinup_{key}.npz when the same spin-up was already done.
+
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs, or a reader(var, year, month, out). The cache is only used
+                   with a folder, whose files (names, sizes, modification times) are part of the key
+        whc, k: Arrays of the grid (whc already prepared with prepare_whc)
+        periods: Months of the spin-up (e.g., the first 6 years)
+        cache_dir: Optional folder of the cached states
+        mode, tol, max_cycles, ffcb, bflow_ant, clamp: See wbfunctions.spin_up
+        pixel_index: Optional pixel index (see pixelfunctions) when whc and k are vectors of valid pixels
+    """
+    import hashlib
+    import json
+
+    whc = np.asarray(whc, dtype=np.float32)
+    path = None
+    if cache_dir is not None and not callable(tc_folder):
+        from stationfunctions import files_key
+
+        files = [monthly_path(tc_folder, var, year, month) for var in tc_vars for year, month in periods]
+        sha = hashlib.sha1()
+        sha.update(whc.tobytes())
+        sha.update(np.broadcast_to(np.asarray(k, dtype=np.float32), whc.shape).tobytes())
+        sha.update(files_key(files).encode())
+        sha.update(json.dumps([periods, mode, tol, max_cycles, ffcb, float(bflow_ant), clamp]).encode())
+        path = os.path.join(cache_dir, "spinup_" + sha.hexdigest()[:16] + ".npz")
+
+    if path is not None and os.path.exists(path):
+        print("Reading spin-up state: " + path)
+        wb = allocate_buffers(whc)
+        with np.load(path) as f:
+            wb["sstor"][...] = f["sstor"]
+            wb["bflow"][...] = f["bflow"]
+        return wb
+
+    reader = tc_folder if callable(tc_folder) else geotiff_reader(tc_folder)
+    if pixel_index is not None:
+        from pixelfunctions import vector_reader
+        reader = vector_reader(reader, pixel_index)
+    wb, cycles, converged = spin_up(reader, whc, k, periods, mode, tol, max_cycles, ffcb, bflow_ant, clamp)
+    print(f"Spin-up: {cycles} cycles, {converged * 100:.2f}% of the pixels converged (tolerance {tol} mm)")
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, sstor=wb["sstor"], bflow=wb["bflow"])
+        os.replace(tmp, path)
+
+    return wb
+
+
+# Function to run the whole monthly chain (6.1 -> 6.2b -> 6.3) in a single pass over the TerraClimate inputs
+def run_pipeline(tc_folder, whc_path, k, tam_out_dir, start_date="1958-01", end_date="2023-12", save_vars=("wyield",),
+                 out_names=None, ffcb=0.1, bflow_ant=10, clamp=True, whc_scale=1000,
+                 station_index=None, station_vars=("wyield", "bflow", "perc", "bflow_ant"), serial_id="grdcno_int",
+                 cube_store=None, chunking="space", checkpoint_dir=None, checkpoint_every=12,
+                 spin_up_years=0, spin_up_cache=None, spin_up_mode="climatology", output_options=None, async_writes=0,
+                 valid_pixels=False):
+    """
+    Streaming mode from ppt/pet/q to wyield: every month is read once, eprec, aet, sstor, perc, bflow and wyield
+    are computed in memory, and only "save_vars" are written to disk as {var}_{year}_{month}.tif
+    (or as cubes, see cubefunctions).
+
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs ({var}_{year}_{month}.tif), or a reader(var, year, month, out)
+                   such as cubefunctions.netcdf_reader or cubefunctions.cube_reader
+        whc_path: Water holding capacity raster (multiplied by "whc_scale")
+        k: Monthly recession constant raster path (e.g., monthly_k_recession_all_FINAL.tif), or a constant
+        tam_out_dir: Output folder. Each variable goes to its own subfolder, as in 6.1, 6.2b and 6.3
+        start_date, end_date: First and last month "YYYY-MM"
+        save_vars: Variables to save (see wbfunctions.tam_vars). The rest stay in memory only
+        out_names: Optional subfolder names per variable, e.g., {"bflow": "bflow2", "wyield": "wyield2"}
+        ffcb, bflow_ant, clamp: See wbfunctions.run_tam
+        station_index: Optional station index (see zonalfunctions.build_station_index) or the path where it was saved.
+                       If given, the catchment COUNT/MEAN of "station_vars" are accumulated while simulating
+        station_vars: Variables aggregated per station ("bflow_ant" is the baseflow of the previous month)
+        serial_id: Name of the station ID column
+        cube_store: Optional folder of a cube store. If given, "save_vars" are written to {cube_store}/{var}.zarr
+                    instead of GeoTIFF files
+        chunking: Chunking of the output cubes (see cubefunctions.create_cube)
+        checkpoint_dir: Optional folder of the run manifest (see checkpointfunctions). If given, sstor and bflow are
+                        saved every "checkpoint_every" months, and a new call resumes (or extends to a later
+                        "end_date") from the last snapshot. Station tables then cover the months run by the call.
+                        A call with other parameters or spin-up settings raises ValueError (the manifest also
+                        records the "end_date" of the last call)
+        checkpoint_every: Months between snapshots
+        spin_up_years: If > 0, the run starts from the equilibrium state of a spin-up over its first years
+                       (see spin_up_state) instead of ffcb and bflow_ant, so no warm-up years need to be discarded
+        spin_up_cache: Optional folder of the cached spin-up states
+        spin_up_mode: "climatology" or "cycle" (see wbfunctions.spin_up)
+        output_options: Optional options of the GeoTIFF outputs (compressed COG, optionally int16 with a scale and
+                        offset, see rasterfunctions.output_options)
+        async_writes: Maximum number of GeoTIFFs waiting to be written by a background thread while the next months
+                      are computed (0 writes them synchronously, see rasterfunctions.raster_writer)
+        valid_pixels: If True, the model runs on 1-D vectors of the valid pixels (see pixelfunctions), which are
+                      scattered into the grid only to save the outputs. The returned buffers (and the checkpoint
+                      snapshots) are then vectors. It can also be a pixel index (or the path where it was saved).
+                      Outputs are the same as in the grid mode at the indexed pixels and NaN elsewhere (the grid mode
+                      can give finite eprec, aet and perc there, see pixelfunctions)
+
+    Returns the buffers with the state of the last month (see wbfunctions.run_tam) and, if "station_index" is given,
+    a dictionary {var: DataFrame [serial_id, YEAR, MONTH, COUNT, MEAN]} (see zonalfunctions.save_zonal_table)
+    """
+    out_names = out_names or {}
+    out_dirs = {var: os.path.join(tam_out_dir, out_names.get(var, var)) for var in save_vars}
+
+    periods = month_periods(start_date, end_date)
+    profile = raster_profile(whc_path)
+    # The spin-up window is part of the configuration, since it can be cut by "end_date"
+    spin_up_periods = periods[:12 * spin_up_years]
+    config = {"whc_path": whc_path, "k": config_value(k), "start_date": start_date, "ffcb": config_value(ffcb),
+              "bflow_ant": config_value(bflow_ant), "clamp": clamp, "whc_scale": whc_scale,
+              "spin_up_years": spin_up_years, "spin_up_mode": spin_up_mode if spin_up_years > 0 else None,
+              "spin_up_end": "%d-%02d" % spin_up_periods[-1] if spin_up_periods else None}
+    whc, k = read_parameters(whc_path, k, whc_scale=whc_scale)
+    reader = tc_folder if callable(tc_folder) else geotiff_reader(tc_folder)
+
+    pixel_index = None
+    if valid_pixels:
+        import pixelfunctions as pf
+        if isinstance(valid_pixels, str):
+            pixel_index = pf.load_pixel_index(valid_pixels)
+        elif isinstance(valid_pixels, dict):
+            pixel_index = valid_pixels
+        else:
+            pixel_index = pf.pixel_index_from_inputs(whc, reader, periods[0])
+        whc, k = pf.to_vector(pixel_index, whc), pf.to_vector(pixel_index, k)
+        reader = pf.vector_reader(reader, pixel_index)
+        grids = {var: np.full(pixel_index["shape"], np.nan, dtype=np.float32) for var in save_vars}
+    # Snapshots of vectors cannot resume a grid run, and vice versa (None matches the manifests of grid runs)
+    config["valid_pixels"] = None if pixel_index is None else int(pixel_index["pixels"].size)
+
+    writer = raster_writer(async_writes)
+
+    wb = None
+    if checkpoint_dir is not None:
+        manifest = open_manifest(checkpoint_dir, "tam", config)
+        manifest["end_date"] = end_date
+        periods, state = resume_point(checkpoint_dir, manifest, start_date, end_date)
+        if state is not None:
+            wb = allocate_buffers(whc)
+            wb["sstor"][...] = state["sstor"]
+            wb["bflow"][...] = state["bflow"]
+            print("Resuming after " + manifest["last_completed"] + " (" + str(len(periods)) + " months to run)")
+        checkpoint = checkpointer(checkpoint_dir, manifest, periods, checkpoint_every, before_save=writer.flush)
+
+    resumed = wb is not None
+    if spin_up_years > 0 and not resumed:
+        wb = spin_up_state(tc_folder, whc, k, spin_up_periods, spin_up_cache, spin_up_mode,
+                           ffcb=ffcb, bflow_ant=bflow_ant, clamp=clamp, pixel_index=pixel_index)
+
+    if cube_store is not None:
+        from cubefunctions import cube_writer
+        write_cubes = cube_writer(cube_store, save_vars, month_periods(start_date, end_date),
+                                  (profile["height"], profile["width"]), chunking, profile, resume=resumed)
+    else:
+        folders_exist(list(out_dirs.values()))
+
+    print('\n############################################################')
+    print('\t\tINITIAL VARIABLES')
+    print('\tPeriod to be executed: ' + start_date + ' to ' + end_date + ' (' + str(len(periods)) + ' months)')
+    print('\tVariables to be saved: ' + ', '.join(save_vars))
+    print('############################################################')
+
+    if station_index is not None:
+        if isinstance(station_index, str):
+            station_index = zf.load_station_index(station_index)
+        if pixel_index is not None:
+            station_index = pf.vector_station_index(station_index, pixel_index)
+        flat = zf.grid_pixels(station_index, whc.shape if pixel_index is None else (1, whc.size))
+        n_sts = len(station_index["stations"])
+        month_index = {period: i for i, period in enumerate(periods)}
+        counts = {var: np.zeros((n_sts, len(periods)), dtype=np.int64) for var in station_vars}
+        means = {var: np.full((n_sts, len(periods)), np.nan) for var in station_vars}
+
+    last = {"time": time.perf_counter()}
+
+    def on_month(year, month, wb):
+        print("\t*Water balance for " + str(year) + "-" + str(month) + "*")
+        outputs = wb if pixel_index is None else {var: pf.to_grid(pixel_index, wb[var], grids[var]) for var in save_vars}
+        if cube_store is not None:
+            write_cubes(year, month, outputs)
+        else:
+            for var in save_vars:
+                writer.write(monthly_path(out_dirs[var], var, year, month), outputs[var], profile, options=output_options)
+
+        if station_index is not None:
+            i = month_index[(year, month)]
+            for var in station_vars:
+                counts[var][:, i], means[var][:, i] = zf.zonal_statistics(station_index, wb[var].reshape(-1).take(flat))
+
+        if checkpoint_dir is not None:
+            checkpoint(year, month, {"sstor": wb["sstor"], "bflow": wb["bflow"]})
+
+        now = time.perf_counter()
+        log_month("tam", year, month, now - last["time"])
+        last["time"] = now
+
+    with stage_span("tam", items=len(periods) * whc.size, unit="pixel-months"):
+        try:
+            wb = run_tam(reader, whc, k, periods, ffcb, bflow_ant, on_month, clamp, wb)
+        finally:
+            writer.close()
+
+    print("\nDONE!!")
+    if station_index is None:
+        return wb
+
+    tables = {var: zf.zonal_table(station_index, counts[var], means[var], periods, serial_id) for var in station_vars}
+    return wb, tables
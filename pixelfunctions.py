@@ -0,0 +1,119 @@
+# Valid-pixel vector mode of the T&M model
+# Most pixels of the global grids are oceans or NoData. The valid (land) pixels are indexed once from WHC and the first
+# TerraClimate month, and the state (sstor, bflow), the parameters (whc, k) and every monthly input and output are kept
+# as 1-D float32 arrays over those pixels. The NumPy engine (wbfunctions) works on arrays of any shape, so it runs on
+# them unchanged; values are scattered back to the grid only to export them (GeoTIFFs, cubes)
+# Both modes give the same values at the indexed pixels. A pixel left out is NaN in every output of the vector mode,
+# while the grid mode can still give finite values there for the outputs that do not need the whole state: eprec
+# (ppt - q), aet (pet in wet months) and perc (0 in dry months) in the months with inputs, and, where WHC is NaN,
+# bflow and wyield until the first wet month. sstor is NaN at those pixels in both modes
+
+import os
+import numpy as np
+
+from wbfunctions import tc_vars
+
+
+# Function to build the index of the valid pixels of a grid
+def build_pixel_index(whc, inputs=()):
+    """
+    Returns a dictionary with:
+        shape: (rows, columns) of the grid
+        pixels: sorted int64 flat indices of the pixels where WHC and all the "inputs" are not NaN
+
+    Args:
+        whc: Water holding capacity grid (NoData as NaN)
+        inputs: Other grids that must have data (e.g., ppt, pet and q of the first month)
+    """
+    whc = np.asarray(whc)
+    valid = ~np.isnan(whc)
+    for grid in inputs:
+        valid &= ~np.isnan(grid)
+    return {"shape": whc.shape, "pixels": np.flatnonzero(valid)}
+
+
+# Function to build the index of the valid pixels from WHC and the inputs of the first month
+def pixel_index_from_inputs(whc, reader, period):
+    """
+    Args:
+        whc: Water holding capacity grid
+        reader: Function reader(var, year, month, out) of the grid (see rasterfunctions.geotiff_reader)
+        period: (year, month) of the first simulated month
+    """
+    inputs = [reader(var, *period, np.empty(np.shape(whc), dtype=np.float32)) for var in tc_vars]
+    index = build_pixel_index(whc, inputs)
+    print(f"Valid pixels: {index['pixels'].size} of {np.prod(index['shape'])} "
+          f"({index['pixels'].size / max(1, np.prod(index['shape'])) * 100:.1f}%)")
+    return index
+
+
+# Function to save the pixel index (NPZ), so it is built only once
+def save_pixel_index(path, index):
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, shape=np.asarray(index["shape"]), pixels=index["pixels"])
+
+
+# Function to load a pixel index saved with save_pixel_index
+def load_pixel_index(path):
+
+    with np.load(path) as f:
+        return {"shape": tuple(int(n) for n in f["shape"]), "pixels": f["pixels"]}
+
+
+# Function to gather the valid pixels of a grid (scalars, e.g., a constant k, are returned as they are)
+def to_vector(index, grid, out=None):
+
+    grid = np.asarray(grid)
+    if grid.ndim == 0:
+        return grid
+    return np.take(grid.reshape(-1), index["pixels"], out=out)
+
+
+# Function to scatter a vector of valid pixels into a grid (NaN, or "fill", elsewhere)
+def to_grid(index, values, out=None, fill=np.nan):
+    """
+    Args:
+        out: Optional grid buffer. Only its valid pixels are written, so a buffer filled once with "fill" can be
+             reused for every month
+    """
+    if out is None:
+        out = np.full(index["shape"], fill, dtype=np.float32)
+    out.reshape(-1)[index["pixels"]] = values
+    return out
+
+
+# Function that returns a reader of vectors from a reader of grids (see wbfunctions.run_tam)
+def vector_reader(reader, index):
+    """
+    Returns reader(var, year, month, out) that fills the vector "out" with the valid pixels of the grid read by "reader".
+    """
+    grid = np.empty(index["shape"], dtype=np.float32)
+
+    def read(var, year, month, out):
+        reader(var, year, month, grid)
+        return to_vector(index, grid, out=out)
+
+    return read
+
+
+# Function to adapt a station index (see zonalfunctions.build_station_index) to the vectors of a pixel index
+def vector_station_index(station_index, index):
+    """
+    Pixels left out of the pixel index are removed from the station index (so COUNT can be lower than in the grid
+    mode for eprec, aet and perc, see the header), and its pixels become positions in the vectors, so
+    zonalfunctions.grid_pixels(station_index, (1, n)) gives the positions to take from each vector.
+    """
+    import zonalfunctions as zf
+
+    flat = zf.grid_pixels(station_index, index["shape"])
+    positions = np.searchsorted(index["pixels"], flat)
+    positions = np.minimum(positions, max(0, index["pixels"].size - 1))
+    keep = index["pixels"][positions] == flat if index["pixels"].size else np.zeros(flat.size, dtype=bool)
+
+    vector_index = {"stations": station_index["stations"], "window": (0, 0, 1, index["pixels"].size),
+                    "pixels": positions[keep]}
+    if "membership" in station_index:
+        return zf.add_sub_basins(vector_index, station_index["sub_basins"][keep], station_index["membership"])
+    vector_index["matrix"] = station_index["matrix"][:, keep].tocsr()
+    return vector_index
@@ -0,0 +1,201 @@
+# Raster input/output helpers shared by the local (NumPy) versions of the T&M workflow
+# GeoTIFF files follow the naming used across the numbered notebooks: {var}_{year}_{month}.tif
+# rasterio is only needed by the functions that touch the disk
+# Outputs can be saved as tiled, compressed cloud-optimized GeoTIFFs (optionally int16 with a scale and offset, see
+# output_options), and written by background threads (see raster_writer) so the next month is computed meanwhile
+
+import os
+import time
+import threading
+import numpy as np
+
+from telemetryfunctions import io_counters
+
+
+# Function to build the path of a monthly raster as saved by 5.convert_NetCDF_to_GeoTIFF and the T&M notebooks
+def monthly_path(folder, var, year, month, wildcard=".tif"):
+    return os.path.join(folder, var + "_" + str(year) + "_" + str(month) + wildcard)
+
+
+# Function to read the profile (shape, transform, crs, nodata) of a reference raster, e.g., "ppt_2023_1.tif"
+def raster_profile(path):
+
+    import rasterio
+
+    with rasterio.open(path) as src:
+        return src.profile.copy()
+
+
+# Function to read a single-band raster as float32, with NoData converted to NaN
+def read_raster(path, window=None, out=None):
+    """
+    Read band 1 of a raster into a float32 array.
+
+    Args:
+        path: Path to the raster
+        window: Optional (row_off, col_off, height, width) tuple to read a block only
+        out: Optional preallocated float32 array that receives the values (no new allocation)
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        win = None if window is None else Window(window[1], window[0], window[3], window[2])
+        if out is None:
+            out = src.read(1, window=win, out_dtype="float32")
+        else:
+            src.read(1, window=win, out=out)
+        if src.nodata is not None and not np.isnan(src.nodata):
+            out[out == src.nodata] = np.nan
+        # Scaled outputs (see output_options)
+        scale, offset = src.scales[0], src.offsets[0]
+        if scale != 1 or offset != 0:
+            out *= np.float32(scale)
+            out += np.float32(offset)
+
+    io_counters["rasters_read"] += 1
+    io_counters["bytes_read"] += out.nbytes
+    io_counters["read_seconds"] += time.perf_counter() - start
+    return out
+
+
+# Function to build the output options of write_raster (tiled and compressed cloud-optimized GeoTIFF)
+def output_options(compress="zstd", scale=None, offset=0.0, blocksize=512, overviews=True, level=3):
+    """
+    Args:
+        compress: "zstd", "deflate" or "lzw"
+        scale, offset: If scale is given, values are saved as int16 round((value - offset) / scale), with -32768 as
+                       NoData and the scale and offset declared in the file (read_raster and GDAL return the values).
+                       E.g., scale=0.1 keeps 0.05 mm of precision from -3276.7 to 3276.7 mm (out of range values are clipped)
+        blocksize: Size of the tiles (pixels)
+        overviews: If True, overviews are added (for quick display of the global grids)
+        level: Compression level (None for the GDAL default, slower with zstd)
+    """
+    return {"compress": compress, "scale": scale, "offset": offset, "blocksize": blocksize, "overviews": overviews,
+            "level": level}
+
+
+# Function to encode float values as int16 with a scale and offset (NaN as -32768)
+def encode_int16(array, scale, offset=0.0):
+
+    with np.errstate(invalid="ignore"):
+        scaled = np.clip(np.rint((np.asarray(array, dtype=np.float32) - np.float32(offset)) / np.float32(scale)), -32767, 32767)
+    return np.where(np.isnan(scaled), -32768, scaled).astype(np.int16)
+
+
+# Lock of the raster I/O counters (write_raster also runs in the threads of raster_writer)
+io_lock = threading.Lock()
+
+
+# Function to save an array as a single-band float32 GeoTIFF using a reference profile
+def write_raster(path, array, profile, window=None, options=None):
+    """
+    Save an array as GeoTIFF. NaN is kept as NoData.
+
+    Args:
+        path: Output path
+        array: 2-D array to save
+        profile: rasterio profile of the reference raster (see raster_profile)
+        window: Optional (row_off, col_off, height, width) when the array is a block of the reference grid
+        options: Optional output options (see output_options). Without them, an uncompressed float32 GeoTIFF is saved
+    """
+    import rasterio
+
+    prof = profile.copy()
+    prof.update(driver="GTiff", count=1, dtype="float32", nodata=np.nan)
+    if window is not None:
+        from rasterio.windows import Window, transform
+        prof.update(height=window[2], width=window[3],
+                    transform=transform(Window(window[1], window[0], window[3], window[2]), profile["transform"]))
+
+    start = time.perf_counter()
+    if options is None:
+        with rasterio.open(path, "w", **prof) as dst:
+            dst.write(np.asarray(array, dtype="float32"), 1)
+        size = prof["height"] * prof["width"] * 4
+    else:
+        for key in ["tiled", "blockxsize", "blockysize", "compress", "interleave", "predictor"]:
+            prof.pop(key, None)
+        prof.update(driver="COG", compress=options["compress"].upper(), predictor="YES", blocksize=options["blocksize"],
+                    overviews="AUTO" if options["overviews"] else "NONE", bigtiff="IF_SAFER")
+        if options["level"] is not None:
+            prof["level"] = options["level"]
+        if options["scale"] is not None:
+            prof.update(dtype="int16", nodata=-32768)
+            array = encode_int16(array, options["scale"], options["offset"])
+        with rasterio.open(path, "w", **prof) as dst:
+            dst.write(np.asarray(array, dtype=prof["dtype"]), 1)
+            if options["scale"] is not None:
+                dst.scales = (options["scale"],)
+                dst.offsets = (options["offset"],)
+        size = os.path.getsize(path)
+
+    with io_lock:
+        io_counters["rasters_written"] += 1
+        io_counters["bytes_written"] += size
+        io_counters["write_seconds"] += time.perf_counter() - start
+
+
+# Function that returns a writer of rasters in background threads, with a bounded number of pending writes
+def raster_writer(max_pending=4, threads=1):
+    """
+    Returns a writer with:
+        write(path, array, profile, window=None, options=None): same as write_raster. The array is copied, so the
+            caller can reuse its buffer at once. If "max_pending" writes are waiting, it blocks until one is done
+            (backpressure when the disk falls behind the model)
+        flush(): waits for the pending writes (and raises the first error of a write)
+        close(): flush and stop the threads
+
+    Args:
+        max_pending: Maximum number of arrays waiting to be written (memory: max_pending copies of a grid).
+                     0 writes synchronously, as write_raster
+        threads: Number of writing threads (GDAL compresses without holding the GIL)
+    """
+    from types import SimpleNamespace
+
+    if max_pending <= 0:
+        return SimpleNamespace(write=write_raster, flush=lambda: None, close=lambda: None)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    slots = threading.BoundedSemaphore(max_pending)
+    pending = []
+
+    def check(wait=False):
+        for future in [f for f in pending if wait or f.done()]:
+            pending.remove(future)
+            future.result() # Raises the error of a failed write
+
+    def write(path, array, profile, window=None, options=None):
+        check()
+        start = time.perf_counter()
+        slots.acquire()
+        with io_lock:
+            io_counters["write_wait_seconds"] += time.perf_counter() - start
+        future = executor.submit(write_raster, path, np.array(array, dtype=np.float32), profile, window, options)
+        future.add_done_callback(lambda f: slots.release())
+        pending.append(future)
+
+    def flush():
+        check(wait=True)
+
+    def close():
+        try:
+            flush()
+        finally:
+            executor.shutdown(wait=True)
+
+    return SimpleNamespace(write=write, flush=flush, close=close)
+
+
+# Function that returns a reader of monthly TerraClimate GeoTIFFs (ppt, pet, q) for the NumPy engine
+def geotiff_reader(folder, window=None):
+    """
+    Returns reader(var, year, month, out) that fills "out" with {var}_{year}_{month}.tif.
+    """
+    def reader(var, year, month, out):
+        return read_raster(monthly_path(folder, var, year, month), window=window, out=out)
+
+    return reader
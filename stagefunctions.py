@@ -0,0 +1,237 @@
+# Stage graph (DAG) of the workflow with a content-hashed artifact cache
+# 5 -> 6.1 -> 6.2a/6.2b -> 6.3 -> 6.4a -> 7.x: each stage has a key made of the content hashes of its input files,
+# its parameters and the keys of the stages it depends on. Outputs go to {cache_dir}/{stage}/{key}, so a stage runs
+# again only when something it depends on changes (e.g., a new monthly k reruns baseflow and the stages after it),
+# identical reruns are no-ops, and earlier versions stay available instead of copies such as wyield2, wyield3, ...
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from checkpointfunctions import atomic_write_json
+from telemetryfunctions import stage_span
+
+# Name of the file that marks a completed stage folder
+stage_marker = "_stage.json"
+
+
+# Function to calculate the SHA-1 of a file, reusing the memo while its size and modification time do not change
+def hash_file(path, memo):
+
+    stat = os.stat(path)
+    entry = memo.get(path)
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        return entry[2]
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    memo[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    return memo[path][2]
+
+
+# Function to calculate the content hash of a list of files (named relative to "root")
+def hash_files(paths, root, memo):
+
+    sha = hashlib.sha1()
+    for file_path in paths:
+        sha.update(f"{os.path.relpath(file_path, root)}|{hash_file(file_path, memo)}\n".encode())
+    return sha.hexdigest()
+
+
+# Function to calculate the content hash of a file or a folder (all the files below it)
+def hash_path(path, memo):
+
+    if os.path.isfile(path):
+        return hash_file(path, memo)
+
+    paths = []
+    for root, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        paths.extend(os.path.join(root, filename) for filename in sorted(filenames))
+    return hash_files(paths, path, memo)
+
+
+# Function to define a stage
+def stage(name, func, deps=(), inputs=None, params=None, input_files=None):
+    """
+    Args:
+        name: Stage name (e.g., "baseflow")
+        func: Function func(out_dir, deps, **inputs, **params) that writes the outputs of the stage into out_dir.
+              deps is a dictionary {stage name: output folder} of the stages it depends on
+        deps: Names of the stages it depends on
+        inputs: Dictionary {argument: file or folder path} hashed by content (e.g., the k raster)
+        params: Dictionary {argument: value} of other parameters (must be JSON serializable)
+        input_files: Optional dictionary {argument: list of files} hashed instead of the whole folder of an input
+                     (e.g., only the TerraClimate months of the period, so other files written to the folder do not
+                     change the key)
+    """
+    return {"name": name, "func": func, "deps": list(deps), "inputs": dict(inputs or {}), "params": dict(params or {}),
+            "input_files": {arg: list(files) for arg, files in (input_files or {}).items()}}
+
+
+# Function to calculate the key of a stage
+def stage_key(st, dep_keys, memo):
+
+    document = {
+        "stage": st["name"],
+        "func": f"{st['func'].__module__}.{st['func'].__qualname__}",
+        "inputs": {arg: hash_files(st["input_files"][arg], path, memo) if arg in st["input_files"] else hash_path(path, memo)
+                   for arg, path in sorted(st["inputs"].items())},
+        "params": st["params"],
+        "deps": {dep: dep_keys[dep] for dep in st["deps"]},
+    }
+    return hashlib.sha1(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Function to run the stages that are not cached yet
+def run_stages(stages, cache_dir, force=()):
+    """
+    Run a list of stages in dependency order, skipping those whose key already has a completed folder.
+
+    Args:
+        stages: List of stages (see stage)
+        cache_dir: Folder of the artifact cache
+        force: Names of the stages to run again even if cached (in the same folder)
+
+    Returns a dictionary {stage name: output folder}
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    memo_path = os.path.join(cache_dir, "file_hashes.json")
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+
+    by_name = {st["name"]: st for st in stages}
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle in the stages at '{name}'")
+        visiting.add(name)
+        for dep in by_name[name]["deps"]:
+            visit(dep)
+        order.append(name)
+
+    for st in stages:
+        visit(st["name"])
+
+    keys, out_dirs = {}, {}
+    for name in order:
+        st = by_name[name]
+        keys[name] = stage_key(st, keys, memo)
+        out_dir = os.path.join(cache_dir, name, keys[name][:16])
+        out_dirs[name] = out_dir
+        marker = os.path.join(out_dir, stage_marker)
+
+        if os.path.exists(marker) and name not in force:
+            print(f"\tStage {name}: cached ({keys[name][:16]})")
+            continue
+
+        print(f"\tStage {name}: running ({keys[name][:16]})")
+        os.makedirs(out_dir, exist_ok=True)
+        with stage_span("stage_" + name, key=keys[name][:16]):
+            st["func"](out_dir, {dep: out_dirs[dep] for dep in st["deps"]}, **st["inputs"], **st["params"])
+        atomic_write_json(marker, {"stage": name, "key": keys[name], "deps": {dep: keys[dep] for dep in st["deps"]},
+                                   "inputs": st["inputs"], "params": st["params"]})
+
+    atomic_write_json(memo_path, memo)
+    atomic_write_json(os.path.join(cache_dir, "latest.json"), out_dirs)
+    return out_dirs
+
+
+# Stage functions of the monthly chain (6.1 -> 6.2b -> 6.3 -> 6.4a)
+
+# Function of the T&M stage (6.1): percolation does not depend on k, so only perc is kept
+def stage_tam(out_dir, deps, tc_folder, whc_path, start_date="1958-01", end_date="2023-12", whc_scale=1000):
+
+    from pipelinefunctions import run_pipeline
+
+    run_pipeline(tc_folder, whc_path, 0, out_dir, start_date, end_date, save_vars=("perc",), whc_scale=whc_scale)
+
+
+# Function of the monthly baseflow stage (6.2b): BFi = BFi-1 * k + PERC * (1 - k)
+def stage_baseflow(out_dir, deps, k_path, start_date="1958-01", end_date="2023-12", bflow_ant=10):
+
+    from rasterfunctions import raster_profile, read_raster, write_raster, monthly_path
+    from wbfunctions import month_periods
+
+    perc_dir = os.path.join(deps["tam"], "perc")
+    bflow_dir = os.path.join(out_dir, "bflow")
+    os.makedirs(bflow_dir, exist_ok=True)
+
+    profile = raster_profile(k_path)
+    k = read_raster(k_path)
+    bflow = np.full(k.shape, bflow_ant, dtype=np.float32)
+    for year, month in month_periods(start_date, end_date):
+        perc = read_raster(monthly_path(perc_dir, "perc", year, month))
+        bflow = bflow * k + perc * (np.float32(1) - k)
+        write_raster(monthly_path(bflow_dir, "bflow", year, month), bflow, profile)
+
+
+# Function of the water yield stage (6.3): WYIELD = Q + BFLOW
+def stage_wyield(out_dir, deps, tc_folder, start_date="1958-01", end_date="2023-12"):
+
+    from rasterfunctions import raster_profile, read_raster, write_raster, monthly_path
+    from wbfunctions import month_periods
+
+    bflow_dir = os.path.join(deps["baseflow"], "bflow")
+    wyield_dir = os.path.join(out_dir, "wyield")
+    os.makedirs(wyield_dir, exist_ok=True)
+
+    periods = month_periods(start_date, end_date)
+    profile = raster_profile(monthly_path(bflow_dir, "bflow", *periods[0]))
+    for year, month in periods:
+        wyield = read_raster(monthly_path(tc_folder, "q", year, month)) + read_raster(monthly_path(bflow_dir, "bflow", year, month))
+        write_raster(monthly_path(wyield_dir, "wyield", year, month), wyield, profile)
+
+
+# Function of the zonal statistics stage (6.4a) of the stations of a selection CSV
+def stage_zonal(out_dir, deps, stations_csv, raster_dir, ref_raster, serial_id="grdcno_int", start_year=1958, end_year=2023):
+
+    import pandas as pd
+    import zonalfunctions as zf
+
+    sts_ids = pd.read_csv(stations_csv)[serial_id].tolist()
+    index_path = os.path.join(out_dir, "station_index.npz")
+    zf.save_station_index(index_path, zf.build_station_index(raster_dir, sts_ids, ref_raster))
+    zf.run_zonal_statistics(index_path, os.path.join(deps["wyield"], "wyield"), "wyield", range(start_year, end_year + 1),
+                            out_dir, serial_id)
+
+
+# Function to build the stages of the monthly chain
+def water_balance_stages(tc_folder, whc_path, k_path, stations_csv, raster_dir, start_date="1958-01", end_date="2023-12",
+                         serial_id="grdcno_int", bflow_ant=10, whc_scale=1000):
+    """
+    Stages tam (6.1) -> baseflow (6.2b) -> wyield (6.3) -> zonal (6.4a). A new k raster reruns baseflow, wyield and
+    zonal; a new station selection reruns zonal only. Analysis stages (7.x) can be appended with stage(..., deps=["zonal"]).
+
+    Args:
+        tc_folder: Folder with TerraClimate GeoTIFFs
+        whc_path: Water holding capacity raster
+        k_path: Monthly recession constant raster
+        stations_csv: CSV with the selected stations (column "serial_id")
+        raster_dir: Folder with the rasterized drainage areas ({st}_DA.tif)
+    """
+    from rasterfunctions import monthly_path
+    from wbfunctions import month_periods, tc_vars
+
+    period = {"start_date": start_date, "end_date": end_date}
+    ref_raster = whc_path
+    # Only the ppt/pet/q months of the period are hashed: climatologies and zonal tables may be written to tc_folder
+    periods = month_periods(start_date, end_date)
+    tc_files = {var: [monthly_path(tc_folder, var, year, month) for year, month in periods] for var in tc_vars}
+    return [
+        stage("tam", stage_tam, inputs={"tc_folder": tc_folder, "whc_path": whc_path}, params=dict(period, whc_scale=whc_scale),
+              input_files={"tc_folder": [path for var in tc_vars for path in tc_files[var]]}),
+        stage("baseflow", stage_baseflow, deps=["tam"], inputs={"k_path": k_path}, params=dict(period, bflow_ant=bflow_ant)),
+        stage("wyield", stage_wyield, deps=["baseflow"], inputs={"tc_folder": tc_folder}, params=period,
+              input_files={"tc_folder": tc_files["q"]}),
+        stage("zonal", stage_zonal, deps=["wyield"], inputs={"stations_csv": stations_csv, "raster_dir": raster_dir, "ref_raster": ref_raster},
+              params={"serial_id": serial_id, "start_year": int(start_date[:4]), "end_year": int(end_date[:4])}),
+    ]
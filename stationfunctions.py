@@ -0,0 +1,225 @@
+# Functions to work with GRDC streamflow stations
+# Bulk reading of the GRDC text files (*_Q_Day / *_Q_Month) of 0.2.CSS_flow_station_data and 4.4a, with a columnar cache
+
+import os
+import io
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from telemetryfunctions import stage_span
+
+# TerraClimate available period
+terra_st_yr = 1958
+terra_ed_yr = 2023
+
+
+# Function to read the header ("# key: value" lines) of a GRDC file
+def parse_grdc_header(lines):
+
+    header = {}
+    for line in lines:
+        if not line.startswith("#") or ":" not in line:
+            continue
+        key, value = line[1:].split(":", 1)
+        key, value = key.strip(), value.strip()
+        if key:
+            header[key] = value
+    return header
+
+
+# Function to get the next downstream station from a GRDC header (NaN when it is "-"), as 4.4a does
+def next_downstream_station(header):
+
+    for key, value in header.items():
+        if "downstream" in key.lower():
+            return np.nan if value in ["-", ""] else value
+    return np.nan
+
+
+# Function to build the date index of the TerraClimate period ("YYYY-MM-DD" daily, "YYYY-MM" monthly)
+def period_index(freq="daily", st_yr=terra_st_yr, ed_yr=terra_ed_yr):
+
+    if freq == "daily":
+        return pd.date_range(f"{st_yr}-01-01", f"{ed_yr}-12-31", freq="D").strftime("%Y-%m-%d")
+    return pd.date_range(f"{st_yr}-01-01", f"{ed_yr}-12-01", freq="MS").strftime("%Y-%m")
+
+
+# Function to read one GRDC text file
+def read_grdc_file(path, freq="daily", st_yr=terra_st_yr):
+    """
+    Read the header and the data of a GRDC file in one go.
+
+    Args:
+        path: GRDC text file (e.g., 1234_Q_Day.Cmd.txt or 1234_Q_Month.txt)
+        freq: "daily" (value in the last column) or "monthly" (value in the second to last column, "Calculated")
+        st_yr: First year of the period; rows are returned as positions from January 1st (or January) of that year
+
+    Returns (station, header, positions, values). -999 values are returned as NaN
+    """
+    station = os.path.basename(path).split("_")[0]
+
+    # Specify encoding explicitly
+    with open(path, "r", encoding="ISO-8859-1") as inFile:
+        text = inFile.read()
+
+    lines = text.split("\n")
+    n_header = 0
+    while n_header < len(lines) and not lines[n_header][:1].isdigit():
+        n_header += 1
+    header = parse_grdc_header(lines[:n_header])
+
+    body = "\n".join(lines[n_header:]).strip()
+    if not body:
+        return station, header, np.empty(0, dtype=np.int64), np.empty(0)
+
+    # Only the value column (and the dates, if needed) is parsed (C parser)
+    n_cols = lines[n_header].count(";") + 1
+    col = n_cols - 1 if freq == "daily" else n_cols - 2
+    rows = body.split("\n")
+    first, last = rows[0].split(";")[0].strip(), rows[-1].split(";")[0].strip()
+
+    # GRDC series are usually complete: consecutive dates from the first to the last row
+    try:
+        if freq == "daily":
+            first_pos = (np.datetime64(first, "D") - np.datetime64(f"{st_yr}-01-01", "D")).astype(np.int64)
+            span = (np.datetime64(last, "D") - np.datetime64(first, "D")).astype(np.int64)
+        else:
+            # Monthly dates are YYYY-MM-00
+            first_pos = (int(first[:4]) - st_yr) * 12 + int(first[5:7]) - 1
+            span = (int(last[:4]) - st_yr) * 12 + int(last[5:7]) - 1 - first_pos
+        consecutive = span == len(rows) - 1
+    except ValueError:
+        consecutive = False
+
+    data = pd.read_csv(io.StringIO(body), sep=";", header=None, usecols=[col] if consecutive else [0, col], skipinitialspace=True)
+
+    # Values; invalid ones are skipped and -999 (no-data) becomes NaN
+    values = data[col]
+    if not pd.api.types.is_numeric_dtype(values):
+        values = pd.to_numeric(values.str.strip(), errors="coerce")
+    values = values.to_numpy(dtype=np.float64, copy=True)
+    values[np.trunc(values) == -999] = np.nan
+
+    # Positions in the period
+    if consecutive:
+        positions = first_pos + np.arange(len(values), dtype=np.float64)
+    elif freq == "daily":
+        days = pd.to_datetime(data[0].str.strip(), format="%Y-%m-%d", errors="coerce").to_numpy(dtype="datetime64[D]")
+        positions = (days - np.datetime64(f"{st_yr}-01-01", "D")).astype(np.float64)
+        positions[np.isnat(days)] = np.nan
+    else:
+        months = data[0].str.strip()
+        positions = ((pd.to_numeric(months.str[:4], errors="coerce") - st_yr) * 12
+                     + pd.to_numeric(months.str[5:7], errors="coerce") - 1).to_numpy(dtype=np.float64)
+
+    # Rows with invalid dates are skipped (invalid values stay as NaN)
+    keep = ~np.isnan(positions)
+    return station, header, positions[keep].astype(np.int64), values[keep]
+
+
+def worker_read_grdc(args):
+    """
+    Worker function to read a single GRDC file.
+
+    Args:
+        args: Tuple containing (path, freq, st_yr)
+    """
+    return read_grdc_file(*args)
+
+
+# Function to compute the key of a set of files (names, sizes and modification times) to invalidate the cache
+def files_key(files):
+
+    sha = hashlib.sha1()
+    for path in sorted(files):
+        stat = os.stat(path)
+        sha.update(f"{os.path.basename(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+
+# Function to read all the GRDC files of a folder into a (dates x stations) DataFrame
+def load_grdc_folder(folder, freq="daily", stations=None, ext="*.txt", st_yr=terra_st_yr, ed_yr=terra_ed_yr,
+                     processes=None, cache_file=None):
+    """
+    Parse every GRDC file of a folder in parallel and fill one preallocated (dates x stations) array.
+
+    Args:
+        folder: Folder with GRDC text files
+        freq: "daily" or "monthly"
+        stations: Optional list of station IDs to read (other files are skipped)
+        ext: File pattern
+        st_yr, ed_yr: TerraClimate period
+        processes: Number of processes (default: number of CPUs - 1)
+        cache_file: NPZ cache (default: {folder}/_DataFrames/grdc_{freq}_cache.npz). It is reused while the files
+                    (names, sizes, modification times) do not change. Use False to disable it
+
+    Returns (flows, headers): flows has the TerraClimate dates as index ("YYYY-MM-DD" or "YYYY-MM") and one column per
+    station with data (as 0.2.CSS_flow_station_data); headers has one row per station with the GRDC header fields
+    """
+    from multiprocessing import Pool
+
+    files = sorted(glob.glob(os.path.join(folder, ext)))
+    if stations is not None:
+        stations = {str(st) for st in stations}
+        files = [f for f in files if os.path.basename(f).split("_")[0] in stations]
+
+    index = period_index(freq, st_yr, ed_yr)
+    key = files_key(files) + f"|{freq}|{st_yr}|{ed_yr}"
+
+    if cache_file is None:
+        cache_file = os.path.join(folder, "_DataFrames", f"grdc_{freq}_cache.npz")
+
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as f:
+            if str(f["key"]) == key:
+                print("Reading GRDC data from cache: " + cache_file)
+                flows = pd.DataFrame(f["values"], index=pd.Index(index, name=index_name(freq)), columns=f["stations"])
+                headers = pd.DataFrame(json.loads(str(f["headers"]))).set_index("station")
+                return flows, headers
+
+    print(f"Reading {len(files)} GRDC files......")
+    worker_args = [(path, freq, st_yr) for path in files]
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+
+    with stage_span("stations", items=len(files), unit="files", freq=freq):
+        if processes == 1 or len(files) < 2:
+            results = [worker_read_grdc(args) for args in worker_args]
+        else:
+            with Pool(processes=min(processes, len(files))) as pool:
+                results = pool.map(worker_read_grdc, worker_args, chunksize=max(1, len(files) // (4 * processes)))
+
+    values = np.full((len(index), len(results)), np.nan)
+    names, header_rows = [], []
+
+    for j, (station, header, positions, vals) in enumerate(results):
+        inside = (positions >= 0) & (positions < len(index))
+        values[positions[inside], j] = vals[inside]
+        names.append(station)
+        header_rows.append(dict(header, station=station, Next_Downstream_Station=next_downstream_station(header)))
+
+    # Drop stations with no data at all in the period
+    has_data = ~np.isnan(values).all(axis=0)
+    values = values[:, has_data]
+    names = [n for n, keep in zip(names, has_data) if keep]
+
+    flows = pd.DataFrame(values, index=pd.Index(index, name=index_name(freq)), columns=names)
+    headers = pd.DataFrame(header_rows).set_index("station") if header_rows else pd.DataFrame()
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        # Written to a temporary file and renamed, so an interrupted run never leaves a truncated cache
+        with open(cache_file + ".tmp", "wb") as f:
+            np.savez(f, key=key, values=values, stations=np.asarray(names, dtype=str),
+                     headers=json.dumps(header_rows, default=str))
+        os.replace(cache_file + ".tmp", cache_file)
+
+    return flows, headers
+
+
+# Function to get the name of the date index used in the notebooks
+def index_name(freq):
+    return "YYYY-MM-DD" if freq == "daily" else "YYYY-MM"
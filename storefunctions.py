@@ -0,0 +1,222 @@
+# Station-month store of the zonal statistics (replaces the per-year CSV concatenation of 7.1a, 7.4 and 7.5)
+# Each variable is one Parquet file ({store}/variable={var}/part-0.parquet) in long format with typed columns:
+# station (int32), period (int32, months since year 0: year * 12 + month - 1), count (int32) and mean (float64).
+# Loaded variables are dense (months x stations) arrays, from which the wide, long and lagged (bflow_ant) views of
+# the notebooks are built, and flows are converted between mm/month and m³/s with a days-in-month array and the
+# catchment areas, without row-wise DataFrame.apply
+
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+
+# Function to encode (year, month) as an integer period (year * 12 + month - 1)
+def period_codes(years, months):
+    return (np.asarray(years, dtype=np.int32) * 12 + np.asarray(months, dtype=np.int32) - 1).astype(np.int32)
+
+
+# Function to get the "YYYY-MM" labels of periods
+def period_labels(periods):
+
+    periods = np.asarray(periods)
+    return pd.Index([f"{y}-{m:02d}" for y, m in zip(periods // 12, periods % 12 + 1)], name="YYYY-MM")
+
+
+# Function to get the periods of "YYYY-MM" labels or datetimes (e.g., the index of Joined_Monthly_Sts_DFs.csv)
+def periods_from_index(index):
+
+    dates = pd.DatetimeIndex(pd.to_datetime(pd.Index(index).astype(str), format="mixed"))
+    return period_codes(dates.year, dates.month)
+
+
+# Function to get the number of days of the month of each period
+def days_in_month(periods):
+
+    months = np.datetime64("0000-01", "M") + np.asarray(periods, dtype=np.int64)
+    return ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(np.int32)
+
+
+# Function to get the path of the Parquet file of a variable
+def store_path(store, var):
+    return os.path.join(store, f"variable={var}", "part-0.parquet")
+
+
+# Function to write a variable in long format [serial_id, YEAR, MONTH, COUNT, MEAN] (see zonalfunctions.zonal_table)
+def write_station_months(store, var, df, serial_id="grdcno_int"):
+    """
+    Args:
+        store: Folder of the store
+        var: Variable name (e.g., "wyield", "bflow2" or "perc")
+        df: DataFrame [serial_id, YEAR, MONTH, COUNT, MEAN], e.g., the concatenation of {var}_zonal_statistics_{year}.csv
+            or the tables returned by pipelinefunctions.run_pipeline
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    periods = period_codes(df["YEAR"].to_numpy(), df["MONTH"].to_numpy())
+    stations = df[serial_id].to_numpy().astype(np.int32)
+    order = np.lexsort((stations, periods))
+
+    table = pa.table({
+        "station": stations[order],
+        "period": periods[order],
+        "count": df["COUNT"].to_numpy().astype(np.int32)[order],
+        "mean": df["MEAN"].to_numpy().astype(np.float64)[order],
+    })
+
+    path = store_path(store, var)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+# Function to import the yearly zonal statistics CSVs of a variable into the store
+def import_zonal_csvs(store, folder, prefix, years, var=None, serial_id="grdcno_int"):
+    """
+    Args:
+        store: Folder of the store
+        folder: Folder with {prefix}_zonal_statistics_{year}.csv (e.g., T&M_WBM\\bflow2)
+        prefix: Variable of the file names (e.g., "bflow")
+        years: Years to import (missing files are skipped, as the glob of 7.1a/7.5)
+        var: Name of the variable in the store (default: the name of the folder, e.g., "bflow2")
+    """
+    var = var or os.path.basename(os.path.normpath(folder))
+    files = sorted(f for year in years for f in glob.glob(os.path.join(folder, f"{prefix}_zonal_statistics_{year}.csv")))
+    if not files:
+        raise FileNotFoundError(f"No {prefix}_zonal_statistics_{{year}}.csv files in {folder}")
+
+    dtypes = {serial_id: np.int32, "YEAR": np.int32, "MONTH": np.int32, "COUNT": np.int32, "MEAN": np.float64}
+    df = pd.concat([pd.read_csv(f, usecols=list(dtypes), dtype=dtypes) for f in files], ignore_index=True)
+    print(f"\t{var}: {len(files)} files, {len(df)} station-months")
+    return write_station_months(store, var, df, serial_id)
+
+
+# Function to list the variables of the store
+def store_variables(store):
+    return sorted(d.split("=", 1)[1] for d in os.listdir(store) if d.startswith("variable="))
+
+
+# Function to load a variable as dense (months x stations) arrays
+def load_station_months(store, var, stations=None):
+    """
+    Returns a dictionary with:
+        stations: int32 station IDs (columns), all the stations of the variable or "stations" in the given order
+        periods: int32 periods (rows), every month from the first to the last one
+        count: (months x stations) int32 pixel counts (0 where there is no value)
+        mean: (months x stations) float64 means (NaN where there is no value)
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(store_path(store, var))
+    st = table.column("station").to_numpy()
+    per = table.column("period").to_numpy()
+
+    if stations is None:
+        stations, cols = np.unique(st, return_inverse=True)
+        keep = np.ones(st.size, dtype=bool)
+    else:
+        stations = np.asarray(stations, dtype=np.int32)
+        order = np.argsort(stations)
+        pos = np.clip(np.searchsorted(stations[order], st), 0, max(0, stations.size - 1))
+        keep = stations[order][pos] == st if stations.size else np.zeros(st.size, dtype=bool)
+        cols = order[pos]
+
+    periods = np.arange(per.min(), per.max() + 1, dtype=np.int32) if per.size else np.empty(0, dtype=np.int32)
+    rows = per - (periods[0] if per.size else 0)
+
+    count = np.zeros((periods.size, stations.size), dtype=np.int32)
+    mean = np.full((periods.size, stations.size), np.nan)
+    count[rows[keep], cols[keep]] = table.column("count").to_numpy()[keep]
+    mean[rows[keep], cols[keep]] = table.column("mean").to_numpy()[keep]
+
+    return {"stations": stations.astype(np.int32), "periods": periods, "count": count, "mean": mean}
+
+
+# Function to get a variable in wide format: "YYYY-MM" index and one column per station (str), as 7.5
+def wide_view(data, values=None):
+
+    values = data["mean"] if values is None else values
+    return pd.DataFrame(values, index=period_labels(data["periods"]), columns=data["stations"].astype(str))
+
+
+# Function to get a variable in long format [YEAR, MONTH, DATE, COUNT, MEAN] indexed by "station_no", as 7.1a
+def long_view(data, **columns):
+    """
+    Args:
+        data: Output of load_station_months
+        columns: Other (months x stations) arrays to add as columns (e.g., FLOW_CMS=...)
+    """
+    valid = data["count"] > 0
+    rows, cols = np.nonzero(valid.T) # Station by station
+    periods = data["periods"][cols]
+
+    df = pd.DataFrame({"YEAR": periods // 12, "MONTH": periods % 12 + 1, "DATE": period_labels(data["periods"]).to_numpy()[cols],
+                       "COUNT": data["count"][cols, rows], "MEAN": data["mean"][cols, rows]},
+                      index=pd.Index(data["stations"][rows], name="station_no"))
+    for name, values in columns.items():
+        df[name] = np.asarray(values)[cols, rows]
+    return df
+
+
+# Function to get the previous month of a variable for each month (the bflow_ant of 7.5), with "initial" in the first one
+def lagged_view(data, initial=10):
+
+    lagged = np.empty_like(data["mean"])
+    lagged[0] = initial
+    lagged[1:] = data["mean"][:-1]
+    return wide_view(data, lagged)
+
+
+# Function to get the catchment areas (km²) of some stations (NaN if missing)
+def area_vector(stations, catchments, area_field="CATCHMENT_SIZE2", id_field="station_no"):
+    """
+    Args:
+        stations: Station IDs
+        catchments: DataFrame with the station IDs (column or index "id_field") and the areas (e.g., CSS_FINAL_SELECTION-MERGE_WITH_ALL.csv)
+    """
+    areas = catchments.set_index(id_field)[area_field] if id_field in catchments.columns else catchments[area_field]
+    areas.index = areas.index.astype(np.int64)
+    return areas.reindex(np.asarray(stations, dtype=np.int64)).to_numpy(dtype=np.float64)
+
+
+# Function to convert (months x stations) flows from mm/month to m³/s (calculate_streamflow of 7.1a)
+def mm_to_cms(values, periods, area_km2):
+    return np.asarray(values) * np.asarray(area_km2) * 1000 / (days_in_month(periods)[:, np.newaxis] * 24 * 60 * 60)
+
+
+# Function to convert (months x stations) flows from m³/s to mm/month (convert_to_mm of 7.4)
+def cms_to_mm(values, periods, area_km2):
+    return np.asarray(values) * (days_in_month(periods)[:, np.newaxis] * 24 * 60 * 60) / (np.asarray(area_km2) * 1000)
+
+
+# Function to convert a wide DataFrame (dates x stations) of observed flows from m³/s to mm/month, as 7.4
+def wide_cms_to_mm(flows, catchments, area_field="CATCHMENT_SIZE2", id_field="station_no"):
+    """
+    Args:
+        flows: DataFrame with a date index (e.g., Joined_Monthly_Sts_DFs.csv) and one column per station
+        catchments: See area_vector. Only the stations with an area are kept, in its order
+
+    Returns a DataFrame with the same index and the stations of "catchments" (str) in mm/month
+    """
+    ids = np.asarray(catchments[id_field] if id_field in catchments.columns else catchments.index)
+    areas = area_vector(ids, catchments, area_field, id_field)
+    has_area = ~np.isnan(areas)
+    columns = [str(st) for st in ids[has_area]]
+    values = flows.reindex(columns=columns).to_numpy(dtype=np.float64)
+    mm = cms_to_mm(values, periods_from_index(flows.index), areas[has_area])
+    return pd.DataFrame(mm, index=flows.index, columns=columns)
+
+
+# Function to load a variable of mm/month and get its flows in m³/s (FLOW_CMS of 7.1a)
+def load_flows_cms(store, var, catchments, area_field="CATCHMENT_SIZE2", id_field="station_no"):
+    """
+    Returns (data, flows): the output of load_station_months for the stations of "catchments" with an area, and their
+    (months x stations) flows in m³/s
+    """
+    data = load_station_months(store, var)
+    areas = area_vector(data["stations"], catchments, area_field, id_field)
+    has_area = ~np.isnan(areas)
+    data = dict(data, stations=data["stations"][has_area], count=data["count"][:, has_area], mean=data["mean"][:, has_area])
+    return data, mm_to_cms(data["mean"], data["periods"], areas[has_area])
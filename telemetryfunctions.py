@@ -0,0 +1,242 @@
+# Instrumentation of the workflow stages: a JSONL event log shared by the main process and the pool workers
+# start_telemetry(path) sets the log path in an environment variable, so workers started afterwards (fork or spawn)
+# append their own events to the same file. Without it, every call below returns at once.
+# Events: "stage" (a whole stage: run_pipeline, zonal statistics, ...), "task" (one task of a worker, e.g., a year
+# or a tile), "month" (one month of a stage) and "error" (with the traceback, before the exception is raised again).
+# Each event has the wall time, the raster bytes read/written and the peak resident memory of its process
+
+import os
+import json
+import time
+import traceback
+from contextlib import contextmanager
+
+# Environment variable with the path of the event log
+log_env = "WB_TELEMETRY_LOG"
+
+# Raster I/O of this process (updated by rasterfunctions.read_raster and write_raster)
+# write_wait_seconds is the time blocked by a full queue of background writes (see rasterfunctions.raster_writer)
+io_counters = {"rasters_read": 0, "rasters_written": 0, "bytes_read": 0, "bytes_written": 0, "read_seconds": 0.0,
+               "write_seconds": 0.0, "write_wait_seconds": 0.0}
+
+
+# Function to start logging events to a JSONL file (also for the workers created afterwards)
+def start_telemetry(path):
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.environ[log_env] = os.path.abspath(path)
+    return os.environ[log_env]
+
+
+# Function to stop logging events
+def stop_telemetry():
+    os.environ.pop(log_env, None)
+
+
+# Function to check if events are being logged
+def telemetry_enabled():
+    return bool(os.environ.get(log_env))
+
+
+# Function to get the peak resident memory (MB) of the current process (None if it cannot be measured)
+def peak_memory_mb():
+
+    try:
+        import resource
+        import platform
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if platform.system() == "Darwin" else peak / 1024 # Bytes on macOS, KB on Linux
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2 # Windows
+    except (ImportError, AttributeError):
+        return None
+
+
+# Function to append an event to the log
+def log_event(event, **fields):
+
+    path = os.environ.get(log_env)
+    if not path:
+        return
+    record = {"time": time.time(), "event": event, "pid": os.getpid(), **fields}
+    with open(path, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n") # One write per line, so workers do not interleave lines
+
+
+# Function to log the time and the outputs of one month of a stage
+def log_month(stage, year, month, seconds, **fields):
+    log_event("month", stage=stage, period=f"{year}-{month:02d}", seconds=seconds, **fields)
+
+
+# Context manager that logs a stage (or a task of a worker) with its time, raster I/O and peak memory
+@contextmanager
+def stage_span(stage, event="stage", **fields):
+    """
+    with stage_span("zonal", items=..., unit="station-months") as span: ...
+
+    The block can update "span" (e.g., span["items"] once they are known). Exceptions are logged as "error" events
+    with the traceback and raised again.
+
+    Args:
+        stage: Stage name
+        event: "stage" or "task"
+        fields: Other fields of the event (e.g., task="1958", items, unit)
+    """
+    span = dict(fields)
+    if not telemetry_enabled():
+        yield span
+        return
+
+    io_start = dict(io_counters)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        # Only the innermost span logs the error
+        if not getattr(e, "telemetry_logged", False):
+            log_event("error", stage=stage, seconds=time.perf_counter() - start, error=repr(e),
+                      traceback=traceback.format_exc(), **span)
+            try:
+                e.telemetry_logged = True
+            except AttributeError:
+                pass
+        raise
+
+    seconds = time.perf_counter() - start
+    io = {key: io_counters[key] - io_start[key] for key in io_counters}
+    if span.get("items") and seconds > 0:
+        span["throughput"] = span["items"] / seconds
+    log_event(event, stage=stage, seconds=seconds, peak_memory_mb=peak_memory_mb(), **io, **span)
+
+
+# Function to read the events of a log
+def read_events(path):
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Function to summarize an event log: time, I/O and throughput per stage, worker skew and errors
+def summarize_events(path):
+    """
+    Returns a dictionary with:
+        stages: {stage: seconds, calls, items, unit, throughput, rasters/s, MB read/written, share of time in raster I/O,
+                 peak memory (MB)}
+        tasks: {stage: number of tasks and workers, median/max task seconds, skew (max/median) and the busiest worker}
+        slowest_stage: stage with the largest total time
+        errors: list of (stage, error) of the error events
+    """
+    import numpy as np
+
+    events = read_events(path)
+    stages, tasks = {}, {}
+
+    for e in events:
+        if e["event"] == "stage":
+            s = stages.setdefault(e["stage"], {"seconds": 0.0, "calls": 0, "items": 0, "unit": e.get("unit"),
+                                               "rasters": 0, "bytes_read": 0, "bytes_written": 0, "io_seconds": 0.0,
+                                               "peak_memory_mb": 0.0})
+            s["seconds"] += e["seconds"]
+            s["calls"] += 1
+            s["items"] += e.get("items") or 0
+            s["rasters"] += e.get("rasters_read", 0) + e.get("rasters_written", 0)
+            s["bytes_read"] += e.get("bytes_read", 0)
+            s["bytes_written"] += e.get("bytes_written", 0)
+            s["io_seconds"] += e.get("read_seconds", 0) + e.get("write_seconds", 0)
+            s["peak_memory_mb"] = max(s["peak_memory_mb"], e.get("peak_memory_mb") or 0)
+        elif e["event"] == "task":
+            tasks.setdefault(e["stage"], []).append(e)
+
+    for stage, rows in tasks.items():
+        if stage in stages:
+            # Items and I/O of the tasks that ran in other processes (pool workers) are added to their stage
+            s = stages[stage]
+            stage_pids = {e["pid"] for e in events if e["event"] == "stage" and e["stage"] == stage}
+            if not s["items"]:
+                s["items"], s["unit"] = sum(r.get("items") or 0 for r in rows), rows[0].get("unit")
+            for r in rows:
+                if r["pid"] not in stage_pids:
+                    s["rasters"] += r.get("rasters_read", 0) + r.get("rasters_written", 0)
+                    s["bytes_read"] += r.get("bytes_read", 0)
+                    s["bytes_written"] += r.get("bytes_written", 0)
+                    s["io_seconds"] += r.get("read_seconds", 0) + r.get("write_seconds", 0)
+                    s["peak_memory_mb"] = max(s["peak_memory_mb"], r.get("peak_memory_mb") or 0)
+        else:
+            # Stages that only ran as tasks are summarized from them
+            stages[stage] = {"seconds": max(r["time"] for r in rows) - min(r["time"] - r["seconds"] for r in rows),
+                             "calls": 1, "items": sum(r.get("items") or 0 for r in rows), "unit": rows[0].get("unit"),
+                             "rasters": sum(r.get("rasters_read", 0) + r.get("rasters_written", 0) for r in rows),
+                             "bytes_read": sum(r.get("bytes_read", 0) for r in rows),
+                             "bytes_written": sum(r.get("bytes_written", 0) for r in rows),
+                             "io_seconds": sum(r.get("read_seconds", 0) + r.get("write_seconds", 0) for r in rows),
+                             "peak_memory_mb": max(r.get("peak_memory_mb") or 0 for r in rows)}
+
+    summary = {"stages": {}, "tasks": {}, "slowest_stage": None, "errors": []}
+    for stage, s in stages.items():
+        seconds = s["seconds"]
+        summary["stages"][stage] = {
+            "seconds": seconds, "calls": s["calls"], "items": s["items"], "unit": s["unit"],
+            "throughput": s["items"] / seconds if s["items"] and seconds > 0 else None,
+            "rasters_per_s": s["rasters"] / seconds if seconds > 0 else None,
+            "mb_read": s["bytes_read"] / 1024 ** 2, "mb_written": s["bytes_written"] / 1024 ** 2,
+            # Share of the time in raster I/O (more than 1 if the I/O of many workers overlaps)
+            "io_share": s["io_seconds"] / seconds if seconds > 0 else None,
+            "peak_memory_mb": s["peak_memory_mb"],
+        }
+
+    for stage, rows in tasks.items():
+        seconds = np.array([r["seconds"] for r in rows])
+        by_worker = {}
+        for r in rows:
+            by_worker[r["pid"]] = by_worker.get(r["pid"], 0.0) + r["seconds"]
+        busiest = max(by_worker, key=by_worker.get)
+        median = float(np.median(seconds))
+        summary["tasks"][stage] = {
+            "tasks": len(rows), "workers": len(by_worker), "median_seconds": median, "max_seconds": float(seconds.max()),
+            "skew": float(seconds.max()) / median if median > 0 else None,
+            "busiest_worker": {"pid": busiest, "seconds": by_worker[busiest]},
+            "worker_peak_memory_mb": max(r.get("peak_memory_mb") or 0 for r in rows),
+        }
+
+    if summary["stages"]:
+        summary["slowest_stage"] = max(summary["stages"], key=lambda stage: summary["stages"][stage]["seconds"])
+    summary["errors"] = [(e["stage"], e["error"]) for e in events if e["event"] == "error"]
+    return summary
+
+
+# Function to print (and save as JSON) the summary of an event log
+def write_summary(path, out_path=None):
+
+    summary = summarize_events(path)
+
+    print("")
+    print("************************************************************************")
+    print("         Telemetry summary: " + path)
+    print("************************************************************************")
+    for stage, s in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        line = f"\t{stage}: {s['seconds']:.1f} s"
+        if s["throughput"]:
+            line += f", {s['throughput']:.3g} {s['unit']}/s"
+        if s["rasters_per_s"]:
+            line += f", {s['rasters_per_s']:.1f} rasters/s"
+        if s["io_share"] is not None:
+            line += f", {s['io_share'] * 100:.0f}% raster I/O"
+        print(line + f", peak memory {s['peak_memory_mb']:.0f} MB")
+    for stage, t in summary["tasks"].items():
+        skew = f"{t['skew']:.2f}" if t["skew"] is not None else "n/a"
+        print(f"\t{stage} tasks: {t['tasks']} on {t['workers']} workers, median {t['median_seconds']:.2f} s, "
+              f"max {t['max_seconds']:.2f} s (skew {skew})")
+    if summary["slowest_stage"] is not None:
+        print("\tSlowest stage: " + summary["slowest_stage"])
+    for stage, error in summary["errors"]:
+        print(f"\tERROR in {stage}: {error}")
+
+    out_path = out_path or os.path.splitext(path)[0] + "_summary.json"
+    with open(out_path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    return summary
@@ -0,0 +1,57 @@
+# The function modules live at the root of the repository, next to the notebooks
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def synthetic():
+    """
+    36 months of ppt/pet/q on a 20 x 30 grid, with NaN ppt in the first month only at rows 0-4 x columns 0-4,
+    and WHC (mm) with NaN at rows 10-12 x columns 10-13. reader(var, year, month, out) fills "out" with a month
+    """
+    from wbfunctions import month_periods, tc_vars
+
+    shape, periods = (20, 30), month_periods("2000-01", "2002-12")
+    rng = np.random.default_rng(0)
+    data = {}
+    for year, month in periods:
+        for var in tc_vars:
+            grid = rng.gamma(2, 40, shape).astype(np.float32)
+            if (year, month) == periods[0] and var == "ppt":
+                grid[:5, :5] = np.nan
+            data[(var, year, month)] = grid
+    whc = rng.uniform(50, 300, shape).astype(np.float32)
+    whc[10:13, 10:14] = np.nan
+
+    def reader(var, year, month, out):
+        out[...] = data[(var, year, month)]
+        return out
+
+    return SimpleNamespace(shape=shape, periods=periods, whc=whc, reader=reader)
+
+
+@pytest.fixture
+def synthetic_files(synthetic, tmp_path):
+    """
+    The synthetic inputs plus whc.tif (whc_scale=1) and a station index in tmp_path. Station 1 has data at all its
+    pixels, station 2 covers the pixels without WHC and station 3 those with NaN inputs in the first month only
+    """
+    from benchmarkfunctions import synthetic_profile
+    from rasterfunctions import write_raster
+    from zonalfunctions import station_index_from_members
+
+    shape = synthetic.shape
+    whc_path = str(tmp_path / "whc.tif")
+    write_raster(whc_path, synthetic.whc, synthetic_profile(shape))
+
+    rows = np.repeat([0, 1, 2], [40, 18, 25])
+    pixels = np.concatenate([np.arange(200, 240), (np.arange(10, 13)[:, None] * shape[1] + np.arange(9, 15)).ravel(),
+                             (np.arange(5)[:, None] * shape[1] + np.arange(5)).ravel()])
+    station_index = station_index_from_members([1, 2, 3], rows, pixels, shape)
+    return SimpleNamespace(**vars(synthetic), whc_path=whc_path, station_index=station_index, folder=tmp_path)
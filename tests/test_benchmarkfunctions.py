@@ -0,0 +1,11 @@
+import pytest
+
+import benchmarkfunctions as bf
+
+
+@pytest.mark.parametrize("n_months", [0, 14])
+def test_synthetic_data_needs_whole_years(tmp_path, n_months):
+    with pytest.raises(ValueError, match="multiple of 12"):
+        bf.generate_synthetic_data(str(tmp_path), shape=(10, 20), n_months=n_months, n_stations=2)
+
+    assert not any(tmp_path.iterdir())
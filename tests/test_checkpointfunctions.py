@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from checkpointfunctions import config_value, load_manifest
+from pipelinefunctions import run_pipeline
+
+
+def test_config_value():
+    k = np.full((3, 4), 0.9, dtype=np.float32)
+
+    assert config_value("k.tif") == "k.tif"
+    assert config_value(None) is None
+    assert config_value(np.float32(0.5)) == 0.5
+    assert config_value(k) == config_value(k.copy())
+    assert config_value(k) != config_value(k.reshape(4, 3))
+    assert config_value(k) != config_value(np.where(np.eye(3, 4) > 0, 0.8, k))
+
+
+def test_resume_rejects_other_spin_up_settings(synthetic_files):
+    reader, whc_path, tmp_path = synthetic_files.reader, synthetic_files.whc_path, synthetic_files.folder
+    k = np.full(synthetic_files.shape, 0.9, dtype=np.float32)
+    settings = dict(save_vars=(), whc_scale=1, checkpoint_dir=str(tmp_path / "run"), checkpoint_every=6,
+                    spin_up_years=1)
+
+    run_pipeline(reader, whc_path, k, str(tmp_path / "tam"), "2000-01", "2001-06", **settings)
+    manifest = load_manifest(str(tmp_path / "run"))
+    assert manifest["config"]["spin_up_end"] == "2000-12" and manifest["end_date"] == "2001-06"
+
+    # Extending to a later end date resumes from the last snapshot
+    wb = run_pipeline(reader, whc_path, k, str(tmp_path / "tam"), "2000-01", "2002-12", **settings)
+    assert load_manifest(str(tmp_path / "run"))["last_completed"] == "2002-12"
+    assert np.isfinite(wb["sstor"]).any()
+
+    with pytest.raises(ValueError, match="spin_up_mode"):
+        run_pipeline(reader, whc_path, k, str(tmp_path / "tam"), "2000-01", "2002-12",
+                     **dict(settings, spin_up_mode="cycle"))
+    with pytest.raises(ValueError, match="'k'"):
+        run_pipeline(reader, whc_path, k * 0.5, str(tmp_path / "tam"), "2000-01", "2002-12", **settings)
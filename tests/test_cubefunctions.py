@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import zonalfunctions as zf
+
+zarr = pytest.importorskip("zarr")
+import cubefunctions as cf  # noqa: E402
+
+PERIODS = [(2000 + i // 12, i % 12 + 1) for i in range(30)]
+SHAPE = (50, 40)
+
+
+@pytest.fixture
+def cube(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2, 10, (len(PERIODS),) + SHAPE).astype(np.float32)
+    values[:, 20:25, 10:15] = np.nan
+    values[3, 30:35] = np.nan
+    return str(tmp_path), values
+
+
+def station_indexes():
+    rng = np.random.default_rng(1)
+    rows = np.repeat(np.arange(4), 150)
+    pixels = np.concatenate([(rng.integers(8, 45, 150) * SHAPE[1] + rng.integers(5, 30, 150)) for _ in range(4)])
+    by_members = zf.station_index_from_members([11, 12, 13, 14], rows, pixels, SHAPE)
+
+    labels = np.zeros((30, 20), dtype=np.int64)
+    labels[:10], labels[10:25, :12], labels[10:25, 12:] = 1, 2, 3
+    membership = pd.DataFrame({"station": [11, 11, 11, 12, 13], "sub_basin": [1, 2, 3, 2, 3]})
+    by_labels = zf.station_index_from_labels([11, 12, 13], labels, (12, 9, 30, 20), membership)
+    return [by_members, by_labels]
+
+
+@pytest.mark.parametrize("chunking", ["space", (7, 8, 8)])
+@pytest.mark.parametrize("index", station_indexes())
+def test_cube_zonal_statistics_matches_whole_window(cube, chunking, index):
+    store, values = cube
+    cf.create_cube(store, "wyield", PERIODS, SHAPE, chunking)[...] = values
+
+    r0, c0, h, w = index["window"]
+    window = values[:, r0:r0 + h, c0:c0 + w].reshape(len(PERIODS), -1)[:, index["pixels"]].T
+    expected = zf.zonal_table(index, *zf.zonal_statistics(index, window), PERIODS)
+
+    # A tiny memory budget reads the window in many blocks of rows
+    table = cf.cube_zonal_statistics(store, "wyield", index, max_memory_mb=0.01)
+    pd.testing.assert_frame_equal(table, expected, rtol=1e-12)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import ensemblefunctions as ef
+from pipelinefunctions import run_pipeline
+
+MEMBERS = [{"name": "base"}, {"name": "wet", "ffcb": 0.5, "bflow_ant": 20}, {"name": "slow", "k_multiplier": 1.05}]
+
+
+def pipeline_tables(files, member, valid_pixels):
+    member = {**ef.member_defaults, **member}
+    _, tables = run_pipeline(files.reader, files.whc_path, 0.9 * member["k_multiplier"], str(files.folder / "tam"),
+                             "2000-01", "2002-12", save_vars=(), ffcb=member["ffcb"], bflow_ant=member["bflow_ant"],
+                             whc_scale=1, station_index=files.station_index, station_vars=("perc",),
+                             valid_pixels=valid_pixels)
+    return tables["perc"]
+
+
+@pytest.mark.parametrize("valid_pixels", [False, True])
+def test_ensemble_matches_run_pipeline(synthetic_files, valid_pixels):
+    files = synthetic_files
+    tables = ef.run_ensemble_pipeline(files.reader, files.whc_path, 0.9, str(files.folder / "ensemble"), MEMBERS,
+                                      "2000-01", "2002-12", station_index=files.station_index, station_vars=("perc",),
+                                      whc_scale=1, valid_pixels=valid_pixels, members_per_pass=2)
+
+    for member in MEMBERS:
+        expected = pipeline_tables(files, member, valid_pixels)
+        pd.testing.assert_frame_equal(tables[member["name"]]["perc"], expected, rtol=1e-6)
+
+
+def test_perc_counts_differ_between_modes_at_excluded_pixels(synthetic_files):
+    grid = pipeline_tables(synthetic_files, MEMBERS[0], False)
+    vector = pipeline_tables(synthetic_files, MEMBERS[0], True)
+
+    # Station 1 has no excluded pixels; perc of the excluded pixels of stations 2 and 3 is only counted in grid mode
+    grid_counts = grid.groupby("grdcno_int")["COUNT"].sum()
+    vector_counts = vector.groupby("grdcno_int")["COUNT"].sum().reindex(grid_counts.index, fill_value=0)
+    assert vector_counts[1] == grid_counts[1]
+    assert vector_counts[2] == 6 * 36 < grid_counts[2]
+    assert vector_counts[3] == 0 < grid_counts[3]
+
+
+def test_members_with_different_whc_nodata(synthetic_files):
+    from benchmarkfunctions import synthetic_profile
+    from rasterfunctions import monthly_path, read_raster, write_raster
+
+    files = synthetic_files
+    # WHC of member "b": data where the default WHC has none, and none at some pixels of station 1
+    whc_b = np.where(np.isnan(files.whc), 120, files.whc * 0.8)
+    whc_b[6:8, 20:26] = np.nan
+    whc_b_path = str(files.folder / "whc_b.tif")
+    write_raster(whc_b_path, whc_b, synthetic_profile(files.shape))
+
+    variables = ("eprec", "aet", "perc", "wyield")
+    members = [{"name": "a"}, {"name": "b", "whc": whc_b_path}]
+    tables = ef.run_ensemble_pipeline(files.reader, files.whc_path, 0.9, str(files.folder / "ensemble"), members,
+                                      "2000-01", "2002-12", save_vars=("perc",), station_index=files.station_index,
+                                      station_vars=variables, whc_scale=1)
+
+    for member, whc_path in [("a", files.whc_path), ("b", whc_b_path)]:
+        out_dir = str(files.folder / "tam" / member)
+        _, expected = run_pipeline(files.reader, whc_path, 0.9, out_dir, "2000-01", "2002-12", save_vars=("perc",),
+                                   whc_scale=1, station_index=files.station_index, station_vars=variables,
+                                   valid_pixels=True)
+        for var in variables:
+            pd.testing.assert_frame_equal(tables[member][var], expected[var], rtol=1e-6)
+        for year, month in [(2000, 1), (2001, 7), (2002, 12)]:
+            np.testing.assert_array_equal(
+                read_raster(monthly_path(str(files.folder / "ensemble" / member / "perc"), "perc", year, month)),
+                read_raster(monthly_path(out_dir + "/perc", "perc", year, month)))
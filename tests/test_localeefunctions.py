@@ -0,0 +1,7 @@
+from localeefunctions import check_local_water_balance
+
+
+def test_local_water_balance_matches_run_tam():
+    max_diff = check_local_water_balance(shape=(20, 30), n_months=36)
+
+    assert max(max_diff.values()) < 1e-3
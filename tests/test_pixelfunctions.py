@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import pixelfunctions as pf
+from wbfunctions import run_tam, tam_vars
+
+def run_both_modes(synthetic, k=0.9):
+    whc, reader, periods = synthetic.whc, synthetic.reader, synthetic.periods
+    grid, vector = {}, {}
+    index = pf.pixel_index_from_inputs(whc, reader, periods[0])
+
+    def keep_grid(year, month, wb):
+        grid[(year, month)] = {var: wb[var].copy() for var in tam_vars}
+
+    def keep_vector(year, month, wb):
+        vector[(year, month)] = {var: pf.to_grid(index, wb[var]) for var in tam_vars}
+
+    run_tam(reader, whc, k, periods, on_month=keep_grid)
+    run_tam(pf.vector_reader(reader, index), pf.to_vector(index, whc), k, periods, on_month=keep_vector)
+
+    excluded = np.ones(synthetic.shape, dtype=bool)
+    excluded.reshape(-1)[index["pixels"]] = False
+    return grid, vector, excluded
+
+
+def test_pixel_index_excludes_nan_whc_and_first_month_inputs(synthetic):
+    index = pf.pixel_index_from_inputs(synthetic.whc, synthetic.reader, synthetic.periods[0])
+
+    assert index["shape"] == synthetic.shape
+    assert index["pixels"].size == synthetic.whc.size - 25 - 12
+
+
+@pytest.mark.parametrize("var", tam_vars)
+def test_vector_mode_matches_grid_mode_at_indexed_pixels(synthetic, var):
+    grid, vector, excluded = run_both_modes(synthetic)
+
+    for period in synthetic.periods:
+        np.testing.assert_array_equal(vector[period][var][~excluded], grid[period][var][~excluded])
+        assert np.isnan(vector[period][var][excluded]).all()
+
+
+def test_grid_mode_outputs_at_excluded_pixels(synthetic):
+    grid, vector, excluded = run_both_modes(synthetic)
+    first_month_nan = (slice(0, 5), slice(0, 5))
+    whc_nan = (slice(10, 13), slice(10, 14))
+    periods = synthetic.periods
+
+    def finite(var, where, periods=periods):
+        return sum(int(np.isfinite(grid[period][var][where]).sum()) for period in periods)
+
+    # The state is NaN at every excluded pixel
+    assert finite("sstor", excluded) == 0
+    # A NaN input of the first month propagates through bflow and wyield
+    assert finite("bflow", first_month_nan) == finite("wyield", first_month_nan) == 0
+    # eprec (ppt - q) and perc (0 in dry months) have values once the inputs do, unlike in the vector mode
+    assert finite("eprec", first_month_nan, periods[:1]) == 0
+    assert finite("eprec", first_month_nan, periods[1:]) == 25 * (len(periods) - 1)
+    assert finite("perc", first_month_nan, periods[1:]) > 0
+    assert finite("eprec", whc_nan) == 12 * len(periods)
+    assert finite("aet", whc_nan) > 0
+    assert finite("perc", whc_nan) > 0
+
+
+def test_to_grid_and_to_vector_round_trip():
+    rng = np.random.default_rng(1)
+    grid = rng.random((20, 30)).astype(np.float32)
+    grid[3, 4] = np.nan
+    index = pf.build_pixel_index(grid)
+
+    vector = pf.to_vector(index, grid)
+    assert vector.size == grid.size - 1
+    np.testing.assert_array_equal(pf.to_grid(index, vector), grid)
+    assert pf.to_vector(index, np.float32(0.9)) == np.float32(0.9)
+
+
+def test_save_and_load_pixel_index(tmp_path):
+    index = pf.build_pixel_index(np.where(np.eye(4, 6) > 0, 1.0, np.nan))
+    path = str(tmp_path / "index" / "pixels.npz")
+    pf.save_pixel_index(path, index)
+
+    loaded = pf.load_pixel_index(path)
+    assert loaded["shape"] == (4, 6)
+    np.testing.assert_array_equal(loaded["pixels"], index["pixels"])
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import watershedfunctions as wf
+
+shapely = pytest.importorskip("shapely")
+
+
+@pytest.fixture
+def watersheds():
+    # 1 contains 2, which contains 3; 4 lies outside of them
+    ids = np.array([1, 2, 3, 4])
+    geoms = np.array([shapely.box(0, 0, 10, 10), shapely.box(0, 0, 5, 5), shapely.box(1, 1, 2, 2),
+                      shapely.box(20, 0, 25, 5)])
+    return ids, geoms
+
+
+def test_nesting_tree(watersheds):
+    tree, pairs = wf.nesting_tree(*watersheds)
+
+    assert tree["depth"].tolist() == [0, 1, 2, 0]
+    assert tree["n_contained"].tolist() == [2, 1, 0, 0]
+    assert tree["n_children"].tolist() == [1, 1, 0, 0]
+    assert tree.loc[3, "parent"] == 2 and tree.loc[2, "parent"] == 1 and np.isnan(tree.loc[1, "parent"])
+    assert set(zip(pairs["container"], pairs["contained"])) == {(1, 2), (1, 3), (2, 3)}
+    assert wf.non_containing(tree) == [3, 4]
+
+
+def test_downstream_chains_cut_circular_references():
+    downstream = pd.Series({3: 2, 2: 1, 1: np.nan, 5: 6, 6: 5})
+
+    chains = wf.downstream_chains(downstream)
+    assert chains[3] == [2, 1]
+    assert chains[2] == [1]
+    assert chains[5] == [6] and chains[6] == [] # The cycle 5 -> 6 -> 5 is cut
+
+
+def test_check_nesting(watersheds):
+    tree, pairs = wf.nesting_tree(*watersheds)
+    # 5 is not in the layer
+    downstream = pd.Series({3: 2, 2: 1, 4: 1, 1: 5})
+
+    check = wf.check_nesting(tree, pairs, downstream).set_index(["station", "downstream_station"])["contained"]
+    assert check[(3, 2)] and check[(3, 1)] and check[(2, 1)]
+    assert not check[(4, 1)]
+    assert 5 not in check.index.get_level_values("downstream_station")
+    assert len(check) == 4
+
+
+def test_check_nesting_without_any_containment():
+    ids = np.array([1, 2])
+    tree, pairs = wf.nesting_tree(ids, np.array([shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1)]))
+
+    check = wf.check_nesting(tree, pairs, pd.Series({1: 2}))
+    assert check.to_dict("records") == [{"station": 1, "downstream_station": 2, "contained": False}]
+
+
+def test_nesting_tree_with_identical_watersheds():
+    # Two stations at the same outlet: 1 and 2 contain each other, and both contain 3
+    ids = np.array([1, 2, 3])
+    geoms = np.array([shapely.box(0, 0, 10, 10), shapely.box(0, 0, 10, 10), shapely.box(1, 1, 2, 2)])
+
+    tree, pairs = wf.nesting_tree(ids, geoms)
+
+    assert np.isnan(tree.loc[1, "parent"]) and tree.loc[2, "parent"] == 1 and tree.loc[3, "parent"] == 2
+    assert tree["depth"].tolist() == [0, 1, 2]
+    assert tree["n_contained"].tolist() == [2, 2, 0]
+    assert {(1, 2), (2, 1)} <= set(zip(pairs["container"], pairs["contained"]))
+
+
+def test_nesting_tree_without_nesting():
+    tree, pairs = wf.nesting_tree(np.array([1, 2]), np.array([shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1)]))
+
+    assert tree["depth"].tolist() == [0, 0]
+    assert pairs.empty
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from wbfunctions import (allocate_buffers, check_tam_step, daily_k_factors, daily_k_reference, daily_k_step,
+                         prepare_whc, tam_step, tam_step_reference, tam_vars)
+
+
+def synthetic_month(rng, shape, i):
+    season = np.float32(1 + 0.8 * np.sin(2 * np.pi * i / 12))
+    ppt = (rng.gamma(1.2, 60, shape) * season).astype(np.float32)
+    pet = (rng.uniform(0, 180, shape) * (2 - season)).astype(np.float32)
+    q = (ppt * rng.uniform(0, 0.5, shape)).astype(np.float32)
+    return ppt, pet, q
+
+
+@pytest.mark.parametrize("clamp", [True, False])
+def test_tam_step_matches_reference_with_nan_and_zero_whc(clamp):
+    rng = np.random.default_rng(0)
+    shape = (30, 40)
+    whc = prepare_whc(rng.uniform(0, 400000, shape).round())
+    whc[:3] = np.nan # NoData
+    whc[3:6] = 0 # No soil storage
+    k = rng.uniform(0.2, 0.99, shape).astype(np.float32)
+    one_minus_k = np.float32(1) - k
+
+    wb = allocate_buffers(whc)
+    sstor_ant, bflow_ant = wb["sstor"].copy(), wb["bflow"].copy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(36):
+            ppt, pet, q = synthetic_month(rng, shape, i)
+            ppt[6:8, :5] = np.nan # Inputs without data
+            wb["ppt"][...], wb["pet"][...], wb["q"][...] = ppt, pet, q
+
+            tam_step(wb, whc, k, one_minus_k, clamp)
+            ref = tam_step_reference(ppt, pet, q, whc, sstor_ant, bflow_ant, k, clamp)
+
+            for var in tam_vars:
+                np.testing.assert_allclose(wb[var], ref[var], rtol=1e-5, atol=1e-3, equal_nan=True, err_msg=var)
+
+            sstor_ant, bflow_ant = ref["sstor"], ref["bflow"]
+
+    # No soil storage: the state stays NaN (0 / 0) or 0, and the percolation takes all the surplus
+    assert np.isnan(wb["sstor"][:3]).all()
+    assert not (wb["sstor"][3:6] > 0).any()
+
+
+@pytest.mark.parametrize("clamp", [True, False])
+def test_check_tam_step(clamp):
+    max_diff = check_tam_step(shape=(20, 30), n_months=60, clamp=clamp)
+
+    assert set(max_diff) == set(tam_vars)
+    assert max(max_diff.values()) < 1e-2
+
+
+@pytest.mark.parametrize("k", [0.5, 0.99, 1.0])
+@pytest.mark.parametrize("n_days", [28, 29, 30, 31])
+def test_daily_k_step_matches_daily_loop(k, n_days):
+    rng = np.random.default_rng(1)
+    shape = (10, 20)
+    perc = rng.gamma(1.0, 30, shape).astype(np.float32)
+    perc[0, :5] = 0
+    state = rng.uniform(0, 50, shape).astype(np.float32)
+    k_grid = np.full(shape, k, dtype=np.float32)
+
+    ref_month, ref_state = daily_k_reference(perc.astype(np.float64), state.astype(np.float64), k, n_days)
+    bflow_month, tmp = np.empty_like(perc), np.empty_like(perc)
+    daily_k_step(perc, state, n_days, daily_k_factors(k_grid), bflow_month, tmp)
+
+    np.testing.assert_allclose(bflow_month, ref_month, rtol=1e-5, atol=1e-3)
+    np.testing.assert_allclose(state, ref_state, rtol=1e-5, atol=1e-4)
+
+
+def test_daily_k_factors_limit_at_k_one():
+    kn, geom = daily_k_factors(np.float32(1.0))[30]
+
+    assert kn == 1
+    assert geom == 30
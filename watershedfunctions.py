@@ -0,0 +1,312 @@
+# Functions to analyze the GRDC drainage areas (watersheds) with shapely instead of arcpy
+# The nesting of the watersheds (7.3.identify_not_contained_polygons) is found with an STR-tree of bounding boxes,
+# so only the candidate pairs whose boxes intersect are tested (with prepared geometries)
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# Function to read the polygons of a layer (e.g., CSS-WATERSHEDS-MERGE_FINAL_SELECTION.shp) and their IDs
+def read_watersheds(path, id_field="grdcno_int"):
+
+    import shapely
+    from pyogrio.raw import read
+
+    _, _, geometry, field_data = read(path, columns=[id_field])
+    return np.asarray(field_data[0]), shapely.from_wkb(geometry)
+
+
+# Function to find all the (container, contained) pairs of watersheds
+def containment_pairs(geoms):
+    """
+    Returns (container, contained) positions such that geoms[contained] is within geoms[container]
+    (geom2.within(geom1) of 7.3). Each polygon is only tested against the polygons whose bounding box lies in its own.
+    """
+    import shapely
+
+    shapely.prepare(geoms)
+    tree = shapely.STRtree(geoms)
+    container, contained = tree.query(geoms, predicate="contains")
+
+    keep = container != contained
+    return container[keep], contained[keep]
+
+
+# Function to build the nesting hierarchy of the watersheds
+def nesting_tree(ids, geoms):
+    """
+    Parent/child containment tree: the parent of a watershed is the smallest watershed containing it.
+
+    Returns (tree, pairs):
+        tree: DataFrame indexed by ID with parent (NaN for outermost watersheds), depth (0 for outermost), area,
+              n_children and n_contained (all the watersheds within it)
+        pairs: DataFrame [container, contained] with every containment relation
+    """
+    import shapely
+
+    ids = np.asarray(ids)
+    area = shapely.area(geoms)
+    container, contained = containment_pairs(geoms)
+
+    # Smallest container of each contained watershed. Identical watersheds (e.g., two stations at the same outlet)
+    # contain each other, so only the one with the lower position can be the parent of the other (and it is the
+    # one with the higher position that is the parent of the watersheds within both)
+    mutual = np.isin(contained * ids.size + container, container * ids.size + contained)
+    eligible = ~mutual | (container < contained)
+    candidates, children = container[eligible], contained[eligible]
+    order = np.lexsort((-candidates, area[candidates], children))
+    candidates, children = candidates[order], children[order]
+    first = np.ones(children.size, dtype=bool)
+    first[1:] = children[1:] != children[:-1]
+    parent = np.full(ids.size, -1)
+    parent[children[first]] = candidates[first]
+
+    # Depth by following the parents level by level (as many levels as the deepest nesting)
+    depth = np.zeros(ids.size, dtype=np.int64)
+    current = parent.copy()
+    while (current >= 0).any():
+        if depth.max() > ids.size:
+            raise ValueError("Cycle in the parents of the nesting tree")
+        depth += current >= 0
+        current = np.where(current >= 0, parent[np.maximum(current, 0)], -1)
+
+    tree = pd.DataFrame({
+        "parent": pd.Series(ids[np.maximum(parent, 0)]).where(parent >= 0).to_numpy(),
+        "depth": depth,
+        "area": area,
+        "n_children": np.bincount(parent[parent >= 0], minlength=ids.size),
+        "n_contained": np.bincount(container, minlength=ids.size),
+    }, index=pd.Index(ids, name="grdcno_int"))
+    pairs = pd.DataFrame({"container": ids[container], "contained": ids[contained]})
+
+    return tree, pairs
+
+
+# Function to get the IDs of the watersheds that do not contain other watersheds
+def non_containing(tree):
+    return sorted(tree.index[tree["n_contained"] == 0])
+
+
+# Function to save the non-containing watersheds as 7.3 does (non_containing_grdcno_int.csv)
+def save_non_containing(tree, out_folder, id_field="grdcno_int"):
+
+    path = os.path.join(out_folder, f"non_containing_{id_field}.csv")
+    pd.DataFrame({id_field: non_containing(tree)}).to_csv(path, index_label="Index")
+    return path
+
+
+# Function to follow the Next_Downstream_Station chains of 4.4a for all the stations
+def downstream_chains(downstream):
+    """
+    Returns {station: [downstream stations, nearest first]}. Each station is visited once: the chain of a
+    station is itself plus the chain of its downstream station (circular references are cut).
+
+    Args:
+        downstream: Series indexed by station with its Next_Downstream_Station (NaN if none)
+    """
+    downstream = downstream.dropna()
+    chains = {}
+
+    for start in downstream.index:
+        path = []
+        current = start
+        while current not in chains and current in downstream.index and current not in path:
+            path.append(current)
+            current = downstream[current]
+
+        tail = chains.get(current, [] if current in path else [current])
+        for station in reversed(path):
+            chains[station] = [station] + tail if station not in tail else tail
+            tail = chains[station]
+
+    return {station: chain[1:] for station, chain in chains.items()}
+
+
+# Function to check the containment tree against the downstream chains
+def check_nesting(tree, pairs, downstream):
+    """
+    Every station of the downstream chain of a station should contain its watershed.
+    Returns a DataFrame [station, downstream_station, contained] with one row per (station, downstream) pair
+    whose both watersheds are in the tree.
+
+    Args:
+        tree, pairs: Output of nesting_tree
+        downstream: Series indexed by station with its Next_Downstream_Station (see downstream_chains)
+    """
+    known = set(tree.index)
+    relations = set(zip(pairs["container"], pairs["contained"]))
+
+    rows = []
+    for station, chain in downstream_chains(downstream).items():
+        for down in chain:
+            if station in known and down in known:
+                rows.append((station, down, (down, station) in relations))
+
+    return pd.DataFrame(rows, columns=["station", "downstream_station", "contained"])
+
+
+# Function to run the nesting analysis of a layer (7.3.identify_not_contained_polygons)
+def run_nesting(input_fc, out_folder=None, id_field="grdcno_int", headers=None):
+    """
+    Args:
+        input_fc: Layer with the drainage areas (e.g., CSS-WATERSHEDS-MERGE_FINAL_SELECTION.shp)
+        out_folder: Folder of non_containing_{id_field}.csv and nesting_tree_{id_field}.csv (default: layer folder)
+        id_field: ID field of the stations
+        headers: Optional DataFrame indexed by station with Next_Downstream_Station (see stationfunctions.load_grdc_folder)
+                 to check the tree against the downstream chains
+    """
+    out_folder = out_folder or os.path.dirname(input_fc)
+    ids, geoms = read_watersheds(input_fc, id_field)
+    print(f"Loaded {len(ids)} polygons")
+
+    tree, pairs = nesting_tree(ids, geoms)
+    save_non_containing(tree, out_folder, id_field)
+    tree.to_csv(os.path.join(out_folder, f"nesting_tree_{id_field}.csv"))
+
+    print(f"\nResults:")
+    print(f"Polygons that do NOT contain any other polygon ({id_field}): {(tree['n_contained'] == 0).sum()}")
+    print(f"Polygons found to contain others: {(tree['n_contained'] > 0).sum()}")
+
+    check = None
+    if headers is not None:
+        # Same type of IDs as the layer (GRDC headers are read as text)
+        downstream = headers["Next_Downstream_Station"].dropna()
+        downstream = pd.Series(downstream.to_numpy().astype(ids.dtype), index=downstream.index.to_numpy().astype(ids.dtype))
+        check = check_nesting(tree, pairs, downstream)
+        print(f"Downstream relations not matched by the containment tree: {(~check['contained']).sum()} of {len(check)}")
+
+    return tree, pairs, check
+
+
+# Function to find the pairs of watersheds that partially overlap (neither contains the other)
+def overlapping_pairs(geoms):
+
+    import shapely
+
+    shapely.prepare(geoms)
+    first, second = shapely.STRtree(geoms).query(geoms, predicate="overlaps")
+    return first, second
+
+
+# Function to get the rows and columns (first, last + 1) of a grid covering some bounds
+def bounds_rows_cols(bounds, transform, shape):
+
+    xmin, ymin, xmax, ymax = bounds
+    cols, rows = ~transform * (np.array([xmin, xmax]), np.array([ymax, ymin]))
+    r0, r1 = int(np.floor(rows.min())), int(np.ceil(rows.max()))
+    c0, c1 = int(np.floor(cols.min())), int(np.ceil(cols.max()))
+    return max(0, r0), max(0, c0), min(shape[0], r1), min(shape[1], c1)
+
+
+# Function to rasterize all the drainage areas at once into disjoint incremental sub-basins
+def rasterize_sub_basins(ids, geoms, ref_raster):
+    """
+    One pass on the grid of the reference raster (cell centers, as PolygonToRaster with "CELL_CENTER"): watersheds
+    are burned from the largest to the smallest, so each pixel gets the smallest watershed containing it. The pixels
+    with the same label form an incremental sub-basin, and the members of a sub-basin are its watershed plus all the
+    watersheds containing it (see nesting_tree). Watersheds that partially overlap others are burned once more on
+    their own window and split the labels they cover into new sub-basins, so the memberships stay exact.
+
+    Args:
+        ids: Station IDs (e.g., grdcno_int)
+        geoms: Drainage-area polygons (see read_watersheds), in the CRS of the reference raster
+        ref_raster: Reference raster of the TerraClimate grid (e.g., ppt_2023_1.tif)
+
+    Returns (labels, window, membership):
+        labels: int32 array of the window with the sub-basin of each pixel (0 outside all the watersheds)
+        window: (row_off, col_off, height, width) of the reference grid covering all the watersheds
+        membership: DataFrame [station, sub_basin] with one row per station and sub-basin within its watershed
+    """
+    import shapely
+    from rasterio import features, windows
+    from rasterfunctions import raster_profile
+
+    ids = np.asarray(ids)
+    ref = raster_profile(ref_raster)
+    ny, nx = ref["height"], ref["width"]
+
+    # Window of the reference grid covering all the watersheds
+    r0, c0, r1, c1 = bounds_rows_cols(shapely.total_bounds(geoms), ref["transform"], (ny, nx))
+    window = (r0, c0, r1 - r0, c1 - c0)
+    transform = windows.transform(windows.Window(c0, r0, c1 - c0, r1 - r0), ref["transform"])
+
+    # Single burn, largest first (labels 1..n are positions + 1)
+    order = np.argsort(-shapely.area(geoms), kind="stable")
+    labels = features.rasterize(((geoms[i], i + 1) for i in order), out_shape=(window[2], window[3]),
+                                transform=transform, fill=0, dtype="int32")
+
+    # Members of each label: its watershed and the watersheds containing it
+    container, contained = containment_pairs(geoms)
+    members = [{i} for i in range(len(ids))]
+    for i, j in zip(container, contained):
+        members[j].add(i)
+    members = [None] + members
+
+    # Partially overlapping watersheds split the labels they cover
+    first, _ = overlapping_pairs(geoms)
+    for p in np.unique(first):
+        pr0, pc0, pr1, pc1 = bounds_rows_cols(shapely.bounds(geoms[p]), transform, labels.shape)
+        if pr1 <= pr0 or pc1 <= pc0:
+            continue
+
+        block = labels[pr0:pr1, pc0:pc1]
+        inside = features.geometry_mask([geoms[p]], out_shape=block.shape, invert=True,
+                                        transform=windows.transform(windows.Window(pc0, pr0, pc1 - pc0, pr1 - pr0), transform))
+        covered = np.unique(block[inside])
+        remap = {}
+        for label in covered:
+            if label == 0:
+                members.append({p})
+            elif p in members[label]:
+                continue
+            else:
+                members.append(members[label] | {p})
+            remap[label] = len(members) - 1
+
+        if remap:
+            old = np.fromiter(remap.keys(), dtype=np.int64)
+            new = np.fromiter(remap.values(), dtype=np.int64)
+            pos = np.searchsorted(old, block[inside])
+            hit = old[np.minimum(pos, old.size - 1)] == block[inside]
+            values = block[inside]
+            values[hit] = new[pos[hit]]
+            block[inside] = values
+
+    # Compact labels (1..n_sub_basins) of the sub-basins with at least one pixel
+    used = np.unique(labels[labels > 0])
+    lookup = np.zeros(len(members), dtype=np.int32)
+    lookup[used] = np.arange(1, used.size + 1, dtype=np.int32)
+    labels = lookup[labels]
+
+    pairs = [(ids[i], sub_basin) for sub_basin, label in enumerate(used, start=1) for i in sorted(members[label])]
+    membership = pd.DataFrame(pairs, columns=["station", "sub_basin"]).sort_values(["station", "sub_basin"], kind="stable")
+
+    return labels, window, membership.reset_index(drop=True)
+
+
+# Function to rasterize the drainage areas of a layer (4.5.drainage_areas_rasterization)
+def run_rasterization(input_fc, ref_raster, out_folder, id_field="grdcno_int"):
+    """
+    Saves sub_basins.tif (labels of the window of the reference grid) and station_sub_basins.csv (membership),
+    and returns the station index (see zonalfunctions.station_index_from_labels).
+    """
+    import rasterio
+    from rasterio import windows
+    from rasterfunctions import raster_profile
+    from zonalfunctions import station_index_from_labels
+
+    ids, geoms = read_watersheds(input_fc, id_field)
+    print(f"Rasterizing {len(ids)} drainage areas......")
+    labels, window, membership = rasterize_sub_basins(ids, geoms, ref_raster)
+
+    ref = raster_profile(ref_raster)
+    profile = ref.copy()
+    profile.update(driver="GTiff", count=1, dtype="int32", nodata=0, height=window[2], width=window[3], compress="deflate",
+                   transform=windows.transform(windows.Window(window[1], window[0], window[3], window[2]), ref["transform"]))
+    with rasterio.open(os.path.join(out_folder, "sub_basins.tif"), "w", **profile) as dst:
+        dst.write(labels, 1)
+    membership.to_csv(os.path.join(out_folder, "station_sub_basins.csv"), index=False)
+
+    print(f"\t{labels.max()} sub-basins for {membership['station'].nunique()} stations")
+    return station_index_from_labels(ids, labels, window, membership)
@@ -0,0 +1,328 @@
+# Zonal statistics of all the watersheds at once
+# The drainage areas rasterized by 4.5.drainage_areas_rasterization ({st}_DA.tif) are turned once into a sparse
+# station x pixel matrix (CSR). Then COUNT/MEAN of every station for one month is a sparse matrix-vector product,
+# and for all the months of a year a sparse matrix-matrix product
+# Nested and overlapping watersheds are handled naturally, since a pixel can belong to many rows of the matrix
+# With the incremental sub-basins of watershedfunctions.rasterize_sub_basins, each pixel is added once to its sub-basin
+# and the stations add up their sub-basins
+
+import os
+import numpy as np
+import pandas as pd
+
+from rasterfunctions import raster_profile, read_raster, monthly_path
+from telemetryfunctions import stage_span
+
+
+# Function to locate a raster snapped to the reference grid (row and column offsets)
+def grid_offset(transform, ref_transform):
+
+    col_off = int(round((transform.c - ref_transform.c) / ref_transform.a))
+    row_off = int(round((transform.f - ref_transform.f) / ref_transform.e))
+    return row_off, col_off
+
+
+# Function to build the station index from the station rows and grid pixels (flat indices) of its members
+def station_index_from_members(sts_ids, rows, pixels, shape):
+    """
+    Returns a dictionary with:
+        stations: station IDs (one per matrix row)
+        window: (row_off, col_off, height, width) of the reference grid containing all the members
+        pixels: flat indices (within "window") of the pixels used by at least one station
+        matrix: CSR matrix (stations x pixels) of ones
+    """
+    from scipy import sparse
+
+    rows = np.asarray(rows, dtype=np.int64)
+    pixels = np.asarray(pixels, dtype=np.int64)
+    nx = shape[1]
+
+    if pixels.size == 0:
+        window = (0, 0, 0, 0)
+        used, cols = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    else:
+        # Bounding window of all the drainage areas, to read only that part of every monthly raster
+        r, c = np.divmod(pixels, nx)
+        window = (int(r.min()), int(c.min()), int(r.max() - r.min() + 1), int(c.max() - c.min() + 1))
+        local = (r - window[0]) * window[3] + (c - window[1])
+        used, cols = np.unique(local, return_inverse=True)
+
+    matrix = sparse.csr_matrix((np.ones(rows.size, dtype=np.float64), (rows, cols)), shape=(len(sts_ids), used.size))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    return {"stations": np.asarray(sts_ids), "window": window, "pixels": used, "matrix": matrix}
+
+
+# Function to build the station index from the rasterized drainage areas ({st}_DA.tif)
+def build_station_index(raster_dir, sts_ids, ref_raster):
+    """
+    Read every {st}_DA.tif once and build the sparse station x pixel matrix.
+
+    Args:
+        raster_dir: Folder with the rasterized drainage areas (Final_Rasters)
+        sts_ids: Station IDs (e.g., grdcno_int)
+        ref_raster: Reference raster of the TerraClimate grid (e.g., ppt_2023_1.tif)
+    """
+    import rasterio
+
+    ref = raster_profile(ref_raster)
+    ny, nx = ref["height"], ref["width"]
+    rows, pixels = [], []
+
+    for i, st in enumerate(sts_ids):
+        path = os.path.join(raster_dir, f"{st}_DA.tif")
+        if not os.path.exists(path):
+            print(f"\tWarning: Drainage area raster of station {st} not found")
+            continue
+
+        with rasterio.open(path) as src:
+            r0, c0 = grid_offset(src.transform, ref["transform"])
+            r, c = np.nonzero(src.read_masks(1)) # Pixels with data belong to the drainage area
+
+        r, c = r + r0, c + c0
+        inside = (r >= 0) & (r < ny) & (c >= 0) & (c < nx)
+        rows.append(np.full(inside.sum(), i, dtype=np.int64))
+        pixels.append(r[inside].astype(np.int64) * nx + c[inside])
+
+    rows = np.concatenate(rows) if rows else []
+    pixels = np.concatenate(pixels) if pixels else []
+
+    return station_index_from_members(sts_ids, rows, pixels, (ny, nx))
+
+
+# Function to build the station index from incremental sub-basin labels (see watershedfunctions.rasterize_sub_basins)
+def station_index_from_labels(sts_ids, labels, window, membership):
+    """
+    Same dictionary as station_index_from_members, plus:
+        sub_basins: sub-basin (0..n-1) of each indexed pixel
+        membership: CSR matrix (stations x sub-basins) of ones
+    Each pixel belongs to one sub-basin only, so zonal_statistics goes through every pixel once and then adds
+    the sub-basins of each station. "matrix" (membership of the pixels) is kept for the other uses of the index.
+
+    Args:
+        sts_ids: Station IDs (one per matrix row)
+        labels: Array of the window with the sub-basin of each pixel (1..n, 0 outside all the watersheds)
+        window: (row_off, col_off, height, width) of "labels" in the reference grid
+        membership: DataFrame [station, sub_basin] of the sub-basins within the watershed of each station
+    """
+    from scipy import sparse
+
+    flat = np.asarray(labels).reshape(-1)
+    pixels = np.flatnonzero(flat > 0)
+    sub_basins = flat[pixels].astype(np.int64) - 1
+    n_sub = int(flat.max()) if flat.size else 0
+
+    position = {st: i for i, st in enumerate(sts_ids)}
+    rows = membership["station"].map(position)
+    known = rows.notna().to_numpy()
+    member = sparse.csr_matrix((np.ones(known.sum()), (rows[known].astype(np.int64), membership["sub_basin"].to_numpy()[known] - 1)),
+                               shape=(len(sts_ids), n_sub))
+
+    index = {"stations": np.asarray(sts_ids), "window": tuple(int(v) for v in window), "pixels": pixels}
+    return add_sub_basins(index, sub_basins, member)
+
+
+# Function to complete an index of sub-basins with the sub-basin x pixel matrix and the station x pixel matrix
+def add_sub_basins(index, sub_basins, membership):
+
+    from scipy import sparse
+
+    index["sub_basins"] = sub_basins
+    index["membership"] = membership
+    index["sub_basin_matrix"] = sparse.csr_matrix((np.ones(sub_basins.size), (sub_basins, np.arange(sub_basins.size))),
+                                                  shape=(membership.shape[1], sub_basins.size))
+    index["matrix"] = (membership @ index["sub_basin_matrix"]).tocsr()
+    return index
+
+
+# Function to save the station index (NPZ), so it is built only once
+def save_station_index(path, index):
+
+    if "membership" in index:
+        m = index["membership"]
+        np.savez_compressed(path, stations=index["stations"], window=np.asarray(index["window"]), pixels=index["pixels"],
+                            sub_basins=index["sub_basins"], data=m.data, indices=m.indices, indptr=m.indptr, shape=np.asarray(m.shape))
+        return
+
+    m = index["matrix"]
+    np.savez_compressed(path, stations=index["stations"], window=np.asarray(index["window"]), pixels=index["pixels"],
+                        data=m.data, indices=m.indices, indptr=m.indptr, shape=np.asarray(m.shape))
+
+
+# Function to load a station index saved with save_station_index
+def load_station_index(path):
+
+    from scipy import sparse
+
+    with np.load(path) as f:
+        matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        index = {"stations": f["stations"], "window": tuple(int(v) for v in f["window"]), "pixels": f["pixels"], "matrix": matrix}
+
+        # Index of sub-basins: the stored matrix is the membership (stations x sub-basins)
+        if "sub_basins" in f:
+            return add_sub_basins(index, f["sub_basins"], matrix)
+
+        return index
+
+
+# Function to convert the indexed pixels into flat indices of the full grid
+def grid_pixels(index, shape):
+
+    r0, c0, _, w = index["window"]
+    r, c = np.divmod(index["pixels"], w)
+    return (r + r0) * shape[1] + (c + c0)
+
+
+# Function to gather the values of the indexed pixels from a full-grid (or window) array
+def gather_pixels(index, array, windowed=False):
+
+    if not windowed:
+        return np.asarray(array).reshape(-1).take(grid_pixels(index, np.shape(array)))
+    return np.ascontiguousarray(array).reshape(-1)[index["pixels"]]
+
+
+# Function to calculate COUNT and SUM of the valid values of every station
+def zonal_sums(index, values, columns=None):
+    """
+    Returns (count, total) as float64, with shape (stations,) or (stations, months).
+
+    Args:
+        index: Station index (see build_station_index)
+        values: Values of the indexed pixels, (pixels,) or (pixels, months)
+        columns: Optional slice of the indexed pixels of "values" (e.g., the pixels of a block of rows), so the
+                 sums of consecutive blocks can be added up
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+
+    if "membership" in index:
+        # Sums of the sub-basins (each pixel once), then of the sub-basins of each station
+        pixels = index["sub_basin_matrix"] if columns is None else index["sub_basin_matrix"][:, columns]
+        count = index["membership"] @ (pixels @ valid.astype(np.float64))
+        total = index["membership"] @ (pixels @ np.where(valid, values, 0))
+    else:
+        matrix = index["matrix"] if columns is None else index["matrix"][:, columns]
+        count = matrix @ valid.astype(np.float64)
+        total = matrix @ np.where(valid, values, 0)
+
+    return count, total
+
+
+# Function to calculate COUNT and MEAN of every station
+def zonal_statistics(index, values):
+    """
+    Zonal COUNT and MEAN ignoring NoData (as ZonalStatisticsAsTable with "DATA").
+
+    Args:
+        index: Station index (see build_station_index)
+        values: Values of the indexed pixels, (pixels,) for one month or (pixels, months)
+
+    Returns (count, mean) with shape (stations,) or (stations, months). MEAN is NaN where COUNT is 0
+    """
+    count, total = zonal_sums(index, values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+
+    return count.astype(np.int64), np.where(count > 0, mean, np.nan)
+
+
+# Function to calculate the zonal statistics of a variable for all the months of a year
+def zonal_statistics_year(index, folder, var, year, serial_id="grdcno_int", months=range(1, 12 + 1)):
+    """
+    Returns a DataFrame with the layout of 6.4a.zonal_statistics_from_raster-arcpy: [serial_id, YEAR, MONTH, COUNT, MEAN]
+    """
+    values = np.empty((index["pixels"].size, len(months)), dtype=np.float32)
+    for j, month in enumerate(months):
+        values[:, j] = gather_pixels(index, read_raster(monthly_path(folder, var, year, month), window=index["window"]), windowed=True)
+
+    count, mean = zonal_statistics(index, values)
+
+    n_sts = len(index["stations"])
+    df = pd.DataFrame({
+        serial_id: np.repeat(index["stations"], len(months)),
+        "YEAR": year,
+        "MONTH": np.tile(np.asarray(months), n_sts),
+        "COUNT": count.reshape(-1),
+        "MEAN": mean.reshape(-1),
+    })
+
+    # As ZonalStatisticsAsTable, stations without data are not reported
+    return df[df["COUNT"] > 0].reset_index(drop=True)
+
+
+# Function to build the long-format table [serial_id, YEAR, MONTH, COUNT, MEAN] from (stations, months) arrays
+def zonal_table(index, count, mean, periods, serial_id="grdcno_int"):
+
+    n_sts, n_months = len(index["stations"]), len(periods)
+    years = np.asarray([p[0] for p in periods])
+    months = np.asarray([p[1] for p in periods])
+
+    df = pd.DataFrame({
+        serial_id: np.repeat(index["stations"], n_months),
+        "YEAR": np.tile(years, n_sts),
+        "MONTH": np.tile(months, n_sts),
+        "COUNT": np.asarray(count).reshape(-1),
+        "MEAN": np.asarray(mean).reshape(-1),
+    })
+
+    # Same order as the yearly files of 6.4a (station by station within each year)
+    df = df[df["COUNT"] > 0].sort_values(["YEAR", serial_id, "MONTH"], kind="stable")
+    return df.reset_index(drop=True)
+
+
+# Function to save a long-format table as yearly files ({var}_zonal_statistics_{year}.csv), as 6.4a does
+def save_zonal_table(df, out_folder, var):
+
+    for year, df_year in df.groupby("YEAR"):
+        df_year.to_csv(os.path.join(out_folder, f"{var}_zonal_statistics_{year}.csv"), index=False)
+
+
+def worker_zonal_year(args):
+    """
+    Worker function to calculate and save the zonal statistics of a single year.
+
+    Args:
+        args: Tuple containing (index_path, folder, var, year, out_folder, serial_id)
+    """
+    index_path, folder, var, year, out_folder, serial_id = args
+    index = load_station_index(index_path)
+
+    with stage_span("zonal", "task", task=year, items=12 * len(index["stations"]), unit="station-months"):
+        df = zonal_statistics_year(index, folder, var, year, serial_id)
+        output_path = os.path.join(out_folder, f"{var}_zonal_statistics_{year}.csv")
+        df.to_csv(output_path, index=False)
+
+    return f"Year {year} completed successfully"
+
+
+# Function to calculate the zonal statistics of a variable for many years ({var}_zonal_statistics_{year}.csv)
+def run_zonal_statistics(index_path, folder, var, years, out_folder=None, serial_id="grdcno_int", processes=1):
+    """
+    Same outputs as 6.4a.zonal_statistics_from_raster-arcpy, reading each monthly raster once for all the stations.
+
+    Args:
+        index_path: Station index saved with save_station_index
+        folder: Folder with {var}_{year}_{month}.tif
+        var: Variable name (e.g., "wyield")
+        years: Years to process
+        out_folder: Folder of the CSV files (default: "folder")
+        processes: Number of processes (one year per task)
+    """
+    from multiprocessing import Pool
+
+    out_folder = out_folder or folder
+    worker_args = [(index_path, folder, var, year, out_folder, serial_id) for year in years]
+
+    with stage_span("zonal", years=len(worker_args)):
+        if processes == 1:
+            results = [worker_zonal_year(args) for args in worker_args]
+        else:
+            with Pool(processes=processes) as pool:
+                results = pool.map(worker_zonal_year, worker_args)
+
+    for result in results:
+        print(result)
+
+    return results